@@ -0,0 +1,61 @@
+"""
+Concurrency benchmark for the /chat endpoint.
+
+Fires a fixed number of /chat requests at a running server for increasing numbers of
+concurrent clients and reports requests per second for each level. With the async RAG
+path the throughput should keep growing with the number of clients instead of flattening at 1.
+
+usage: python benchmarks/chat_concurrency.py --url http://localhost:8000 --clients 1,2,4,8,16
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+
+
+async def login(client, username, password):
+    response = await client.post("/auth/jwt/login", data={"username": username, "password": password})
+    response.raise_for_status()
+    return response.json()["access_token"]
+
+
+async def run_level(client, token, prompts, clients, requests_per_client):
+    latencies = []
+
+    async def worker(worker_id):
+        for i in range(requests_per_client):
+            prompt = prompts[(worker_id + i) % len(prompts)]
+            start = time.perf_counter()
+            response = await client.post("/chat", json={"prompt": prompt, "history": []},
+                                         headers={"Authorization": f"Bearer {token}"})
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker(n) for n in range(clients)])
+    elapsed = time.perf_counter() - start
+    return len(latencies) / elapsed, statistics.median(latencies)
+
+
+async def main(args):
+    prompts = args.prompts.split("|")
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout) as client:
+        token = await login(client, args.username, args.password)
+        print(f"{'clients':>8} {'req/s':>8} {'p50 (s)':>8}")
+        for clients in [int(c) for c in args.clients.split(",")]:
+            rps, p50 = await run_level(client, token, prompts, clients, args.requests)
+            print(f"{clients:>8} {rps:>8.2f} {p50:>8.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--username", default="user@gmail.com")
+    parser.add_argument("--password", default="1111")
+    parser.add_argument("--clients", default="1,2,4,8,16")
+    parser.add_argument("--requests", type=int, default=4, help="requests per client per level")
+    parser.add_argument("--timeout", type=float, default=180)
+    parser.add_argument("--prompts", default="普拿疼的用法用量是什麼?|康緒平緩釋膠囊的適應症?|泰克胃通的副作用有哪些?")
+    asyncio.run(main(parser.parse_args()))
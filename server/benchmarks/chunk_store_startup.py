@@ -0,0 +1,77 @@
+"""
+Cold startup time and RSS of loading the chunks from the pickle versus opening the ChunkStore.
+
+Writes a synthetic corpus of label chunks in both formats, then every measurement runs in a fresh
+interpreter, like a newly started uvicorn worker, and reads 10 chunks like one retrieval would.
+
+usage (from the server folder): python -m benchmarks.chunk_store_startup --chunks 200000
+"""
+import argparse
+import os
+import pickle
+import random
+import subprocess
+import sys
+import tempfile
+
+from langchain_core.documents import Document
+
+from rag.chunk_store import ChunkStore
+
+MEASURE = """
+import pickle, random, sys, time
+start = time.perf_counter()
+if sys.argv[1] == "pickle":
+    chunks = []
+    with open(sys.argv[2], "rb") as f:
+        while True:
+            try:
+                chunks.extend(pickle.load(f))
+            except EOFError:
+                break
+else:
+    from rag.chunk_store import ChunkStore
+    chunks = ChunkStore(sys.argv[2])
+texts = [chunks[i].page_content for i in random.sample(range(len(chunks)), 10)]
+elapsed = time.perf_counter() - start
+# ru_maxrss would include the parent's peak from before the fork, read the current RSS instead
+rss = next(int(line.split()[1]) for line in open("/proc/self/status") if line.startswith("VmRSS"))
+print(elapsed, rss / 1024)
+"""
+
+
+def make_chunks(n, rng):
+    chunks = []
+    for i in range(n):
+        text = "".join(chr(rng.randrange(0x4e00, 0x9fff)) for _ in range(300))
+        chunks.append(Document(page_content=text, metadata={"source": f"rag/data/衛署藥製字第{i:06d}號-藥品{i}.md",
+                                                             "id": f"{i:032x}"}))
+    return chunks
+
+
+def measure(kind, path):
+    output = subprocess.run([sys.executable, "-c", MEASURE, kind, path], capture_output=True, text=True,
+                            check=True, cwd=os.getcwd()).stdout.split()
+    return float(output[0]), float(output[1])
+
+
+def main(args):
+    chunks = make_chunks(args.chunks, random.Random(42))
+    with tempfile.TemporaryDirectory() as directory:
+        pickle_path = os.path.join(directory, "chunks.pickle")
+        with open(pickle_path, "wb") as f:
+            pickle.dump(chunks, f)
+        store_path = os.path.join(directory, "chunks.sqlite")
+        ChunkStore(store_path).extend(chunks)
+        del chunks
+
+        print(f"{'format':>10} {'startup (s)':>12} {'RSS (MB)':>13}")
+        for kind, path in [("pickle", pickle_path), ("chunkstore", store_path)]:
+            (elapsed, rss) = measure(kind, path)
+            print(f"{kind:>10} {elapsed:>12.2f} {rss:>13.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunks", type=int, default=200000)
+    main(parser.parse_args())
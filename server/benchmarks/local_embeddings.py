@@ -0,0 +1,82 @@
+"""
+Throughput and latency of the local ONNX Runtime embedding provider (embedding_provider=local).
+
+Reports texts per second when embedding the label chunks of rag/data the way ingestion does (embed_documents
+with vectorize_batch_size texts per call, from several threads), p50/p99 of a single embed_query and of
+embed_query from many concurrent threads, which the dynamic batching combines into batches.
+
+usage (from the server folder): python -m benchmarks.local_embeddings --model intfloat/multilingual-e5-small
+"""
+import argparse
+import glob
+import random
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_core.documents.base import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from rag.onnx_models import OnnxEmbeddings
+
+
+def load_texts(data_dir):
+    splitter = RecursiveCharacterTextSplitter(chunk_size=512, chunk_overlap=80)
+    docs = []
+    for path in sorted(glob.glob(f"{data_dir}/*.md")):
+        with open(path, encoding="utf-8") as f:
+            docs.append(Document(page_content=f.read(), metadata={"source": path}))
+    return [chunk.page_content for chunk in splitter.split_documents(docs)]
+
+
+def percentiles(latencies):
+    latencies = sorted(latencies)
+    return statistics.median(latencies), latencies[max(int(len(latencies) * 0.99) - 1, 0)]
+
+
+def main(args):
+    rng = random.Random(42)
+    texts = load_texts(args.data_dir)
+    texts = (texts * (args.texts // len(texts) + 1))[:args.texts]
+    queries = [text[:24] for text in rng.sample(texts, min(args.queries, len(texts)))]
+
+    print(f"{'batch':>6} {'threads':>7} {'ingest texts/s':>15} {'query p50 (ms)':>15} {'query p99 (ms)':>15} "
+          f"{'concurrent p50':>15} {'concurrent p99':>15}")
+    for batch_size in [int(size) for size in args.batch_sizes.split(",")]:
+        embeddings = OnnxEmbeddings(args.model, quantize=not args.fp32, threads=args.threads,
+                                    max_batch_size=batch_size, max_wait=args.max_wait)
+        embeddings.embed_documents(texts[:batch_size])
+
+        # Ingestion: vectorize_chunks sends batches of texts from a few threads
+        start = time.perf_counter()
+        batches = [texts[i:i + args.request_size] for i in range(0, len(texts), args.request_size)]
+        with ThreadPoolExecutor(max_workers=args.ingest_workers) as pool:
+            list(pool.map(embeddings.embed_documents, batches))
+        ingest_rate = len(texts) / (time.perf_counter() - start)
+
+        def timed_query(query):
+            start = time.perf_counter()
+            embeddings.embed_query(query)
+            return (time.perf_counter() - start) * 1000
+
+        single = percentiles([timed_query(query) for query in queries])
+        with ThreadPoolExecutor(max_workers=args.clients) as pool:
+            concurrent = percentiles(list(pool.map(timed_query, queries)))
+        print(f"{batch_size:>6} {args.threads or 0:>7} {ingest_rate:>15.1f} {single[0]:>15.2f} {single[1]:>15.2f} "
+              f"{concurrent[0]:>15.2f} {concurrent[1]:>15.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data-dir", default="rag/data")
+    parser.add_argument("--model", default="intfloat/multilingual-e5-small")
+    parser.add_argument("--fp32", action="store_true", help="don't quantize the model to int8")
+    parser.add_argument("--threads", type=int, default=None, help="ONNX Runtime threads, default one per core")
+    parser.add_argument("--batch-sizes", default="8,32,64")
+    parser.add_argument("--max-wait", type=float, default=0.005)
+    parser.add_argument("--texts", type=int, default=2000)
+    parser.add_argument("--request-size", type=int, default=64, help="texts per embed_documents call")
+    parser.add_argument("--ingest-workers", type=int, default=4)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--clients", type=int, default=16)
+    main(parser.parse_args())
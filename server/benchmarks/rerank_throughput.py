@@ -0,0 +1,94 @@
+"""
+Pairs per second of the cross-encoder reranker per backend (torch, ONNX Runtime fp32, ONNX Runtime int8) and
+batch size, plus the latency of reranking a retrieval result with a cold and a warm pair score cache.
+
+Documents are chunks of the label markdown in rag/data, queries are random spans of them. Backends whose
+packages are not installed are skipped.
+
+usage (from the server folder): python -m benchmarks.rerank_throughput --model BAAI/bge-reranker-base
+"""
+import argparse
+import glob
+import random
+import time
+
+from langchain_core.documents.base import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from rag.ScoredCrossEncoderReranker import ScoredCrossEncoderReranker, PairScoreCache
+
+
+def load_chunks(data_dir):
+    splitter = RecursiveCharacterTextSplitter(chunk_size=512, chunk_overlap=80)
+    docs = []
+    for path in sorted(glob.glob(f"{data_dir}/*.md")):
+        with open(path, encoding="utf-8") as f:
+            docs.append(Document(page_content=f.read(), metadata={"source": path}))
+    chunks = splitter.split_documents(docs)
+    for i, chunk in enumerate(chunks):
+        chunk.metadata["id"] = str(i)
+    return chunks
+
+
+def load_backends(args):
+    backends = {}
+    try:
+        from langchain_community.cross_encoders import HuggingFaceCrossEncoder
+        backends["torch"] = lambda: HuggingFaceCrossEncoder(model_name=args.model)
+    except ImportError:
+        pass
+    from rag.onnx_models import OnnxCrossEncoder
+    backends["onnx fp32"] = lambda: OnnxCrossEncoder(args.model, quantize=False, threads=args.threads)
+    backends["onnx int8"] = lambda: OnnxCrossEncoder(args.model, quantize=True, threads=args.threads)
+    return backends
+
+
+def main(args):
+    rng = random.Random(42)
+    chunks = load_chunks(args.data_dir)
+    queries = []
+    for _ in range(args.queries):
+        text = rng.choice(chunks).page_content
+        start = rng.randrange(max(1, len(text) - 16))
+        queries.append(text[start:start + 16])
+
+    print(f"{'backend':>10} {'batch':>6} {'pairs/s':>9} {'cold (ms)':>10} {'warm (ms)':>10}")
+    for name, load in load_backends(args).items():
+        try:
+            model = load()
+        except Exception as e:
+            print(f"{name:>10} skipped: {e}")
+            continue
+        for batch_size in [int(size) for size in args.batch_sizes.split(",")]:
+            reranker = ScoredCrossEncoderReranker(model=model, top_n=3, batch_size=batch_size)
+            # Warm up
+            reranker.compress_documents(rng.sample(chunks, min(args.candidates, len(chunks))), queries[0])
+
+            n_pairs = 0
+            start = time.perf_counter()
+            for query in queries:
+                candidates = rng.sample(chunks, min(args.candidates, len(chunks)))
+                reranker.compress_documents(candidates, query)
+                n_pairs += len(candidates)
+            elapsed = time.perf_counter() - start
+
+            # The same retrieval result twice, the second time every pair comes from the cache
+            reranker.cache = PairScoreCache()
+            candidates = rng.sample(chunks, min(args.candidates, len(chunks)))
+            latencies = []
+            for _ in range(2):
+                start = time.perf_counter()
+                reranker.compress_documents(candidates, queries[0])
+                latencies.append((time.perf_counter() - start) * 1000)
+            print(f"{name:>10} {batch_size:>6} {n_pairs / elapsed:>9.1f} {latencies[0]:>10.1f} {latencies[1]:>10.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data-dir", default="rag/data")
+    parser.add_argument("--model", default="BAAI/bge-reranker-base")
+    parser.add_argument("--batch-sizes", default="8,32,64")
+    parser.add_argument("--queries", type=int, default=20)
+    parser.add_argument("--candidates", type=int, default=50)
+    parser.add_argument("--threads", type=int, default=None)
+    main(parser.parse_args())
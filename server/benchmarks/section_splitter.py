@@ -0,0 +1,94 @@
+"""
+Split throughput of MarkdownSectionSplitter versus RecursiveCharacterTextSplitter on the label markdown in
+rag/data, and retrieval latency of the BM25 stage with and without a section filter.
+
+For the retrieval part the section split labels are replicated --copies times, each query is the title of a
+section plus a few words of one of its chunks, it counts as on topic when all of the top k chunks are from
+the asked for section.
+
+usage (from the server folder): python -m benchmarks.section_splitter --copies 2000
+"""
+import argparse
+import glob
+import random
+import statistics
+import time
+
+import numpy as np
+from langchain_core.documents.base import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from rag.section_splitter import MarkdownSectionSplitter
+from rag.sparse_index import SparseIndex
+
+
+def load_docs(data_dir):
+    docs = []
+    for path in sorted(glob.glob(f"{data_dir}/*.md")):
+        with open(path, encoding="utf-8") as f:
+            docs.append(Document(page_content=f.read(), metadata={"source": path}))
+    return docs
+
+
+def bench_split(name, splitter, docs, repeat):
+    n_chars = sum(len(doc.page_content) for doc in docs) * repeat
+    start = time.perf_counter()
+    for _ in range(repeat):
+        chunks = splitter.split_documents(docs)
+    elapsed = time.perf_counter() - start
+    print(f"{name:>32} {len(chunks):>7} {n_chars / elapsed / 1e6:>10.2f}")
+
+
+def bench_search(name, index, queries, k, sections, positions):
+    latencies, on_topic = [], 0
+    for query, section in queries:
+        allowed = positions[section] if positions is not None else None
+        start = time.perf_counter()
+        result = index.search(query, k, allowed=allowed)
+        latencies.append((time.perf_counter() - start) * 1000)
+        on_topic += bool(result) and all(sections[doc_id] == section for doc_id, _ in result)
+    latencies.sort()
+    print(f"{name:>32} {statistics.median(latencies):>9.2f} {latencies[int(len(latencies) * 0.99) - 1]:>9.2f} "
+          f"{on_topic / len(queries):>9.3f}")
+
+
+def main(args):
+    docs = load_docs(args.data_dir)
+    section_splitter = MarkdownSectionSplitter(chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap)
+    print(f"{'splitter':>32} {'chunks':>7} {'Mchar/s':>10}")
+    bench_split("MarkdownSectionSplitter", section_splitter, docs, args.repeat)
+    bench_split("RecursiveCharacterTextSplitter", RecursiveCharacterTextSplitter(
+        chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap, add_start_index=True), docs, args.repeat)
+
+    chunks = [chunk for chunk in section_splitter.split_documents(docs) if "section" in chunk.metadata] * args.copies
+    sections = [chunk.metadata["section"] for chunk in chunks]
+    positions = {}
+    for position, section in enumerate(sections):
+        positions.setdefault(section, []).append(position)
+    positions = {section: np.asarray(ids, dtype=np.int64) for section, ids in positions.items()}
+    index = SparseIndex.build([chunk.page_content for chunk in chunks], tokenizer="cjk")
+
+    rng = random.Random(42)
+    queries = []
+    for _ in range(args.queries):
+        chunk = rng.choice(chunks)
+        body = chunk.page_content.split("\n", 1)[-1]
+        start = rng.randrange(max(1, len(body) - 8))
+        queries.append((f"{chunk.metadata['section']} {body[start:start + 8]}", chunk.metadata["section"]))
+
+    print(f"\n{len(chunks)} chunks, {len(positions)} sections")
+    print(f"{'BM25':>32} {'p50 (ms)':>9} {'p99 (ms)':>9} {'on topic':>9}")
+    bench_search("unfiltered", index, queries, args.k, sections, None)
+    bench_search("section filter", index, queries, args.k, sections, positions)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data-dir", default="rag/data")
+    parser.add_argument("--chunk-size", type=int, default=512)
+    parser.add_argument("--chunk-overlap", type=int, default=80)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--copies", type=int, default=2000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=4)
+    main(parser.parse_args())
@@ -0,0 +1,85 @@
+"""
+Compare the vectorized SparseIndex (cjk tokenizer) with langchain's BM25Retriever on latency and recall.
+
+The corpus is synthetic: chunks are stitched together from random lines of the label markdown files in
+rag/data, each query is a short random span of one chunk and counts as recalled when that chunk is in
+the top k. BM25Retriever takes very long to build for big corpora, use --baseline-max to skip it there.
+
+usage (from the server folder): python -m benchmarks.sparse_retrieval --sizes 10000,100000,1000000
+"""
+import argparse
+import glob
+import random
+import statistics
+import time
+
+from langchain_community.retrievers import BM25Retriever
+
+from rag.sparse_index import SparseIndex
+
+
+def load_lines(data_dir):
+    lines = []
+    for path in glob.glob(f"{data_dir}/*.md"):
+        with open(path, encoding="utf-8") as f:
+            lines.extend(line.strip() for line in f if len(line.strip()) > 10)
+    return lines
+
+
+def make_corpus(lines, size, rng):
+    return [" ".join(rng.sample(lines, 3)) for _ in range(size)]
+
+
+def make_queries(corpus, n, rng):
+    queries = []
+    for _ in range(n):
+        target = rng.randrange(len(corpus))
+        text = corpus[target]
+        start = rng.randrange(max(1, len(text) - 12))
+        queries.append((text[start:start + 12], target))
+    return queries
+
+
+def bench(name, build, search, corpus, queries, k):
+    start = time.perf_counter()
+    engine = build(corpus)
+    build_time = time.perf_counter() - start
+
+    latencies, hits = [], 0
+    for query, target in queries:
+        start = time.perf_counter()
+        result = search(engine, query, k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        hits += target in result
+    latencies.sort()
+    print(f"{name:>14} {len(corpus):>9} {build_time:>9.1f} {statistics.median(latencies):>9.2f} "
+          f"{latencies[int(len(latencies) * 0.99) - 1]:>9.2f} {hits / len(queries):>9.3f}")
+
+
+def main(args):
+    rng = random.Random(42)
+    lines = load_lines(args.data_dir)
+    print(f"{'engine':>14} {'chunks':>9} {'build (s)':>9} {'p50 (ms)':>9} {'p99 (ms)':>9} {'recall@' + str(args.k):>9}")
+    for size in [int(size) for size in args.sizes.split(",")]:
+        corpus = make_corpus(lines, size, rng)
+        queries = make_queries(corpus, args.queries, rng)
+
+        bench("SparseIndex", lambda texts: SparseIndex.build(texts, tokenizer="cjk"),
+              lambda index, query, k: {doc_id for doc_id, _ in index.search(query, k)}, corpus, queries, args.k)
+
+        if size <= args.baseline_max:
+            def build_baseline(texts):
+                return BM25Retriever.from_texts(texts, metadatas=[{"i": i} for i in range(len(texts))], k=args.k)
+            bench("BM25Retriever", build_baseline,
+                  lambda retriever, query, k: {doc.metadata["i"] for doc in retriever.invoke(query)},
+                  corpus, queries, args.k)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data-dir", default="rag/data")
+    parser.add_argument("--sizes", default="10000,100000,1000000")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--baseline-max", type=int, default=100000)
+    main(parser.parse_args())
@@ -0,0 +1,57 @@
+"""
+Median latency of ahandle_user_interaction with and without use_speculative_execution.
+
+Runs in-process against the RAG helper configured in rag/.env, every question is asked as a
+follow-up so the fetch-new decision, the rewrite loop (when enabled) and the answer are all exercised.
+
+usage (from the server folder): python -m benchmarks.speculative_latency --runs 10
+"""
+import argparse
+import asyncio
+import logging
+import os
+import platform
+import statistics
+import sys
+import time
+
+from dotenv import load_dotenv
+
+HISTORY = [
+    {"role": "human", "content": "普拿疼的用法用量是什麼?"},
+    {"role": "assistant", "content": "成人每次1至2錠，每日不超過4次。"},
+]
+
+
+async def measure(raghelper, questions, runs):
+    latencies = []
+    for i in range(runs):
+        question = questions[i % len(questions)]
+        start = time.perf_counter()
+        await raghelper.ahandle_user_interaction(question, HISTORY)
+        latencies.append(time.perf_counter() - start)
+    return statistics.median(latencies)
+
+
+async def main(args):
+    if platform.system() == "Linux":
+        __import__('pysqlite3')
+        sys.modules['sqlite3'] = sys.modules.pop('pysqlite3')
+    from rag.RAGHelper_cloud import RAGHelperCloud
+
+    logging.basicConfig(level=logging.WARNING)
+    raghelper = RAGHelperCloud(logging.getLogger(__name__))
+    questions = args.questions.split("|")
+
+    for mode in ["False", "True"]:
+        os.environ["use_speculative_execution"] = mode
+        median = await measure(raghelper, questions, args.runs)
+        print(f"use_speculative_execution={mode}: median {median:.2f}s over {args.runs} runs")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--questions", default="那它有哪些副作用?|康緒平緩釋膠囊的適應症?|孕婦可以吃嗎?")
+    load_dotenv(dotenv_path="rag/.env")
+    asyncio.run(main(parser.parse_args()))
@@ -1,6 +1,12 @@
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.encoders import jsonable_encoder
 from rag.RAGHelper_cloud import RAGHelperCloud
+from rag.deadline import Deadline, DeadlineExceeded
+from rag.ingest_jobs import IngestionJobManager
+from rag.batching import CoalescingEmbeddings
+from rag.manifest import normalize_source
 from fastapi import FastAPI, HTTPException, Depends
+from starlette.concurrency import run_in_threadpool
 import platform
 from accounts.db import User, create_db_and_tables
 from accounts.schemas import UserCreate, UserRead, UserUpdate
@@ -10,6 +16,8 @@ from fastapi.middleware.cors import CORSMiddleware
 from middleware import TimeoutMiddleware
 from pydantic import BaseModel
 import logging
+import json
+import glob
 import os
 from dotenv import load_dotenv
 import uvicorn
@@ -26,6 +34,9 @@ if platform.system() == "Linux":
 async def lifespan(app: FastAPI):
     # Not needed if you setup a migration system like Alembic
     await create_db_and_tables()
+    # Only a process that serves requests loads the indexes and models, not the uvicorn supervisor of several
+    # workers nor a second import of this module
+    create_rag_helper()
     yield
 
 
@@ -38,7 +49,7 @@ app.add_middleware(TimeoutMiddleware, timeout=120)
 # Define CORS settings
 origins = ["*"]  # Allow requests from any origin
 
-# Add CORS middleware
+# Add CORS middleware, it is pure ASGI like our TimeoutMiddleware so /chat/stream is not buffered
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -78,16 +89,41 @@ os.environ["TOKENIZERS_PARALLELISM"] = "false"
 # Load environment variables from .env.en file
 load_dotenv(dotenv_path="rag/.env")
 
+raghelper = None
+ingestion_jobs = None
+
+
 # Instantiate the RAG Helper class based on the environment configuration
-if any(os.getenv(key) == "True" for key in ["use_openai", "use_gemini", "use_azure", "use_ollama"]):
-    logger.info("Instantiating the cloud RAG helper.")
-    raghelper = RAGHelperCloud(logger)
+def create_rag_helper():
+    global raghelper, ingestion_jobs
+    if any(os.getenv(key) == "True" for key in ["use_openai", "use_gemini", "use_azure", "use_ollama"]):
+        logger.info("Instantiating the cloud RAG helper.")
+        raghelper = RAGHelperCloud(logger)
+        ingestion_jobs = IngestionJobManager(raghelper, batch_size=int(os.getenv("ingest_batch_size", "8")),
+                                             processes=int(os.getenv("ingest_processes", "0")) or None)
+        if os.getenv("sync_on_startup") == "True":
+            ingestion_jobs.submit_sync()
 
 
 class Document(BaseModel):
     filename: str
 
 
+def valid_filetype(filename):
+    file_types = ["md", "pdf", "txt", "csv", "docx", "pptx", "xml", "json"]
+    return any(filename.endswith(ext) for ext in file_types)
+
+
+def data_file_path(filename):
+    # The form the initial load and /sync use for the chunk sources and the manifest, e.g. rag/data/x.md
+    return normalize_source(os.path.join(os.getenv('data_directory'), filename))
+
+
+def inside_data_directory(filename):
+    data_dir = os.path.abspath(os.getenv('data_directory'))
+    return os.path.abspath(os.path.join(data_dir, filename)).startswith(data_dir + os.sep)
+
+
 @app.post("/add_local_document", tags=['RAG'])
 async def add_document(doc: Document, user: User = Depends(current_active_user)):
     """
@@ -104,16 +140,87 @@ async def add_document(doc: Document, user: User = Depends(current_active_user))
     if not filename:
         raise HTTPException(status_code=400, detail="Filename is required")
 
-    file_types = ["md", "pdf", "txt", "csv", "docx", "pptx", "xml", "json"]
-    if not any(filename.endswith(ext) for ext in file_types):
+    if not valid_filetype(filename):
         raise HTTPException(status_code=400, detail="invalid filetype")
 
+    if not inside_data_directory(filename):
+        raise HTTPException(status_code=400, detail=f"{filename} is outside the data directory")
+
     logger.info(f"Adding document {filename}")
-    raghelper.addDocument(filename)
+    await run_in_threadpool(raghelper.addDocument, data_file_path(filename))
 
     return {"filename": filename}
 
 
+class IngestRequest(BaseModel):
+    filenames: List[str] = []
+    pattern: Optional[str] = None  # glob relative to the data directory, e.g. "衛部藥輸/*.md"
+
+
+@app.post("/ingest", tags=['RAG'])
+async def ingest(request: IngestRequest, user: User = Depends(current_active_user)):
+    """
+    Queue many documents for ingestion by a background worker.
+
+    This endpoint expects a JSON payload with a list of filenames and/or a glob pattern, both relative
+    to the data directory. Ingestion runs in batches in the background, use /ingest/{job_id} to follow it.
+
+    Returns:
+        JSON response with the job id and the number of files queued.
+    """
+    data_dir = os.path.abspath(os.getenv('data_directory'))
+    filenames = list(request.filenames)
+    if request.pattern:
+        filenames += [os.path.relpath(path, data_dir)
+                      for path in glob.glob(os.path.join(data_dir, request.pattern), recursive=True)
+                      if os.path.isfile(path)]
+    filenames = list(dict.fromkeys(filenames))
+
+    if not filenames:
+        raise HTTPException(status_code=400, detail="No files to ingest")
+    for filename in filenames:
+        if not inside_data_directory(filename):
+            raise HTTPException(status_code=400, detail=f"{filename} is outside the data directory")
+        if not valid_filetype(filename):
+            raise HTTPException(status_code=400, detail=f"invalid filetype: {filename}")
+
+    # Same paths as the initial load uses for the chunk sources and the manifest
+    job = ingestion_jobs.submit([data_file_path(filename) for filename in filenames])
+    logger.info(f"Queued ingestion job {job.id} with {len(filenames)} files")
+    return {"job_id": job.id, "files": len(filenames)}
+
+
+@app.get("/ingest/{job_id}", tags=['RAG'])
+async def ingest_status(job_id: str, user: User = Depends(current_active_user)):
+    """
+    Report the progress of a bulk ingestion job.
+
+    Returns:
+        JSON response with the status, files and chunks processed, throughput and errors of the job.
+    """
+    job = ingestion_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+
+@app.post("/sync", tags=['RAG'])
+async def sync(user: User = Depends(current_active_user)):
+    """
+    Bring the indexes in line with the data directory.
+
+    Files are compared with the manifest (size, mtime and content hash) of what was ingested: added and
+    modified files are re-chunked and re-embedded, the chunks of deleted files are removed from Chroma and
+    the sparse index. Runs as a background job, use /ingest/{job_id} to follow it.
+
+    Returns:
+        JSON response with the job id.
+    """
+    job = ingestion_jobs.submit_sync()
+    logger.info(f"Queued sync job {job.id}")
+    return {"job_id": job.id}
+
+
 class ChatRequest(BaseModel):
     prompt: str
     history: list = []
@@ -134,51 +241,48 @@ class ChatResponse(BaseModel):
     documents: List[DocumentResponse]
     rewritten: bool
     question: str
+    skipped: List[str] = []  # optional stages skipped to stay within the latency budget
+    provenance_id: Optional[str] = None  # with deferred provenance, fetch the scores from /provenance/{id}
 
 
-@app.post("/chat", response_model=ChatResponse, tags=['RAG'])
-async def chat(request: ChatRequest, user: User = Depends(current_active_user)):
-    """
-    Handle chat interactions with the RAG system.
+def format_documents(docs):
+    return [{
+        's': doc.metadata['source'],
+        'c': doc.page_content,
+        **({'pk': doc.metadata['pk']} if 'pk' in doc.metadata else {}),
+        **({'provenance': float(doc.metadata['provenance'])} if 'provenance' in doc.metadata else {})
+    } for doc in docs if 'source' in doc.metadata]
 
-    This endpoint processes the user's prompt, retrieves relevant documents,
-    and returns the assistant's reply along with conversation history.
 
-    Returns:
-        JSON response containing the assistant's reply, history, documents, and other metadata.
-    """
+def build_history(thread, response):
+    # Populate history for other LLMs
+    new_history = [{"role": msg[0], "content": msg[1].format_map(response)} for msg in thread]
+    new_history.append({"role": "assistant", "content": response['answer']})
+    return new_history
+
+
+def build_chat_response(request: ChatRequest, thread, response, deadline: Deadline):
     prompt = request.prompt
-    history = request.history
     original_docs = request.docs
     docs = original_docs
-
-    # Get the LLM response
-    (new_history, response) = raghelper.handle_user_interaction(prompt, history)
     if not docs or 'docs' in response:
         docs = response['docs']
-    # Populate history for other LLMs
-    new_history = [{"role": msg[0], "content": msg[1].format_map(response)} for msg in new_history]
-    new_history.append({"role": "assistant", "content": response['answer']})
-    reply = response['answer']
 
     # Format documents
     if not original_docs or 'docs' in response:
-        new_docs = [{
-            's': doc.metadata['source'],
-            'c': doc.page_content,
-            **({'pk': doc.metadata['pk']} if 'pk' in doc.metadata else {}),
-            **({'provenance': float(doc.metadata['provenance'])} if 'provenance' in doc.metadata else {})
-        } for doc in docs if 'source' in doc.metadata]
+        new_docs = format_documents(docs)
     else:
         new_docs = docs
 
     # Build the response dictionary
     response_dict = {
-        "reply": reply,
-        "history": new_history,
+        "reply": response['answer'],
+        "history": build_history(thread, response),
         "documents": new_docs,
         "rewritten": False,
-        "question": prompt
+        "question": prompt,
+        "skipped": deadline.skipped,
+        "provenance_id": response.get('provenance_id')
     }
 
     # Check for rewritten question
@@ -189,6 +293,121 @@ async def chat(request: ChatRequest, user: User = Depends(current_active_user)):
     return response_dict
 
 
+@app.post("/chat", response_model=ChatResponse, tags=['RAG'])
+async def chat(request: ChatRequest, user: User = Depends(current_active_user)):
+    """
+    Handle chat interactions with the RAG system.
+
+    This endpoint processes the user's prompt, retrieves relevant documents,
+    and returns the assistant's reply along with conversation history.
+
+    Returns:
+        JSON response containing the assistant's reply, history, documents, and other metadata.
+    """
+    deadline = Deadline.from_env()
+
+    # Get the LLM response, without blocking the event loop for other requests
+    try:
+        (new_history, response) = await raghelper.ahandle_user_interaction(request.prompt, request.history, deadline)
+    except DeadlineExceeded:
+        raise HTTPException(status_code=504, detail="Latency budget exceeded")
+
+    return build_chat_response(request, new_history, response, deadline)
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.post("/chat/stream", tags=['RAG'])
+async def chat_stream(request: ChatRequest, user: User = Depends(current_active_user)):
+    """
+    Streaming variant of /chat using server-sent events.
+
+    Events are sent in this order:
+        documents: the retrieved documents, as soon as retrieval has finished (only when new documents are fetched)
+        token: a chunk of the answer, as the LLM emits it
+        provenance: the provenance score per document, in the order of the documents event
+        done: the full ChatResponse payload
+    With deferred provenance (provenance_deferred=True) the provenance event follows the done event instead,
+    once the background worker has scored the documents.
+        error: sent instead of done when the latency budget ran out
+
+    Returns:
+        A text/event-stream response.
+    """
+    deadline = Deadline.from_env()
+
+    async def event_stream():
+        try:
+            async for event in raghelper.astream_user_interaction(request.prompt, request.history, deadline):
+                yield stream_event(request, event, deadline)
+        except DeadlineExceeded:
+            yield sse_event("error", {"detail": "Latency budget exceeded", "skipped": deadline.skipped})
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+def stream_event(request: ChatRequest, event, deadline: Deadline):
+    (event, data) = event
+    if event == "docs":
+        return sse_event("documents", format_documents(data))
+    elif event == "token":
+        return sse_event("token", {"t": data})
+    elif event == "provenance":
+        return sse_event("provenance", [doc['provenance'] if 'provenance' in doc else None
+                                        for doc in format_documents(data)])
+    elif event == "done":
+        (new_history, response) = data
+        return sse_event("done", jsonable_encoder(build_chat_response(request, new_history, response, deadline)))
+
+
+@app.get("/provenance/{provenance_id}", tags=['RAG'])
+async def provenance(provenance_id: str, wait: float = 0, user: User = Depends(current_active_user)):
+    """
+    Fetch the deferred provenance scores of a chat response.
+
+    With wait > 0 the request waits up to that many seconds for the scores to be computed.
+
+    Returns:
+        JSON response with the status and, once done, the chunk id and provenance score of every document,
+        in the order of the documents of the chat response.
+    """
+    result = await raghelper.provenance_worker.fetch(provenance_id, wait=min(wait, 60)) \
+        if raghelper.provenance_worker is not None else None
+    if result is None:
+        raise HTTPException(status_code=404, detail="Provenance not found")
+    return result
+
+
+@app.get("/stats", tags=['RAG'])
+async def stats(user: User = Depends(current_active_user)):
+    """
+    Report the effectiveness of the caches in front of the RAG pipeline.
+
+    Returns:
+        JSON response with the counters of every enabled cache.
+    """
+    response = {"index_version": raghelper.index_version}
+    if raghelper.answer_cache is not None:
+        response["answer_cache"] = raghelper.answer_cache.stats()
+    if hasattr(raghelper.embeddings, "stats"):
+        response["embeddings"] = raghelper.embeddings.stats()
+    coalescer = raghelper.embeddings
+    while coalescer is not None and not isinstance(coalescer, CoalescingEmbeddings):
+        coalescer = getattr(coalescer, "embeddings", None)
+    if coalescer is not None:
+        response["query_coalescing"] = coalescer.stats()
+    if raghelper.rerank_cache is not None:
+        response["rerank_cache"] = raghelper.rerank_cache.stats()
+    if raghelper.provenance_worker is not None:
+        response["provenance"] = raghelper.provenance_worker.stats()
+    if raghelper.single_flight is not None:
+        response["single_flight"] = raghelper.single_flight.stats()
+    return response
+
+
 # Response model for list of document filenames
 class DocumentsResponse(BaseModel):
     files: List[str]
@@ -244,4 +463,6 @@ async def get_document(doc_request: DocumentRequest, user: User = Depends(curren
 
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    # Several workers need the import string, each worker imports main and runs the lifespan itself
+    uvicorn.run("main:app" if workers > 1 else app, host="0.0.0.0", port=8000, workers=workers)
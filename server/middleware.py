@@ -1,16 +1,33 @@
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.requests import Request
 from starlette.responses import Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 import asyncio
 
 
-class TimeoutMiddleware(BaseHTTPMiddleware):
-    def __init__(self, app, timeout: int = 60):
-        super().__init__(app)
+# Pure ASGI middleware, unlike BaseHTTPMiddleware it does not buffer the response body so streamed
+# responses pass through untouched. On timeout the work underneath is cancelled.
+class TimeoutMiddleware:
+    def __init__(self, app: ASGIApp, timeout: int = 60):
+        self.app = app
         self.timeout = timeout
 
-    async def dispatch(self, request: Request, call_next) -> Response:
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        response_started = False
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
         try:
-            return await asyncio.wait_for(call_next(request), timeout=self.timeout)
+            await asyncio.wait_for(self.app(scope, receive, send_wrapper), timeout=self.timeout)
         except asyncio.TimeoutError:
-            return Response("Request timed out", status_code=504)
+            if not response_started:
+                await Response("Request timed out", status_code=504)(scope, receive, send)
+            else:
+                # Headers are already out (streaming), all we can do is end the body
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
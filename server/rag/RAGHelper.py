@@ -1,12 +1,15 @@
 import os
-import re
 
-from tqdm import tqdm
-import hashlib
+from .ScoredCrossEncoderReranker import ScoredCrossEncoderReranker, PairScoreCache
+from .onnx_models import OnnxCrossEncoder
+from .vectorize import vectorize_chunks, Checkpoint
+from .sparse_index import SparseIndexRetriever, load_or_build_sparse_index
+from .chunk_store import ChunkStore
+from .locks import file_lock
+from .manifest import scan_files, normalize_source
+from .drug_dictionary import DrugDictionary, drug_entries
+from .ingest_pipeline import prepare_chunks, make_text_splitter, discover_files, iter_chunk_batches
 
-from .ScoredCrossEncoderReranker import ScoredCrossEncoderReranker
-
-from langchain_core.documents.base import Document
 from langchain.retrievers import EnsembleRetriever
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_experimental.text_splitter import SemanticChunker
@@ -16,17 +19,14 @@ from langchain.retrievers import ContextualCompressionRetriever
 from langchain.retrievers.document_compressors import FlashrankRerank
 from langchain_community.cross_encoders import HuggingFaceCrossEncoder
 
-from langchain_community.document_loaders import PyPDFLoader, UnstructuredMarkdownLoader
-from langchain_community.document_loaders import PyPDFDirectoryLoader
+from langchain_community.document_loaders import PyPDFLoader
 from langchain_community.document_loaders import JSONLoader
-from langchain_community.document_loaders import DirectoryLoader
 from langchain_community.document_loaders import Docx2txtLoader
 from langchain_community.document_loaders import TextLoader
 from langchain_community.document_loaders import UnstructuredExcelLoader
 from langchain_community.document_loaders import UnstructuredPowerPointLoader
 from langchain_community.document_loaders.csv_loader import CSVLoader
 
-from lxml import etree
 import pickle
 
 
@@ -46,196 +46,150 @@ def formatDocuments(docs):
         doc_strings.append(f"藥品名:{drug_name} 說明書內容: {doc.page_content}\n藥品名:{drug_name} 文件內容結束")
     return "\n\n<NEWDOC>\n\n".join(doc_strings)
 
-def extract_source(filename):
-    # 移除路徑和文件擴展名
-    base_name = filename.split("\\")[-1].replace('.md', '')
-
-    # 使用正則表達式分割文件名
-    parts = re.split(r'[\-]', base_name)
-
-    # 過濾掉空字符串
-    parts = [part.strip()[:30] for part in parts if part.strip()]
-    return " ".join(parts)
-
 
 class RAGHelper:
+    def prepare_chunks(self, docs):
+        return prepare_chunks(self.text_splitter, docs)
+
+    # Chunks pickled by earlier versions, the first pickle holds the initial chunks and every following one
+    # a delta added by addDocument
+    def read_chunks_pickle(self, document_chunks_pickle):
+        chunks = []
+        with open(document_chunks_pickle, 'rb') as f:
+            while True:
+                try:
+                    chunks.extend(pickle.load(f))
+                except EOFError:
+                    break
+        return chunks
+
+    # Drug names and license numbers of the labels, recorded as chunks are added. Stores from before the
+    # dictionary existed are filled in once from the chunks.
+    def load_drug_dictionary(self):
+        if len(self.chunked_documents) > 0 and not self.chunked_documents.drugs():
+            for start in range(0, len(self.chunked_documents), 10000):
+                self.chunked_documents.update_drugs(drug_entries(self.chunked_documents[start:start + 10000]))
+        self.drug_dictionary = DrugDictionary()
+        self.drug_dictionary.add(self.chunked_documents.drugs())
+
+    def load_sparse_retriever(self):
+        self.sparse_index = load_or_build_sparse_index(os.getenv("sparse_index_path", "rag/bm25_index"),
+                                                       self.chunked_documents,
+                                                       tokenizer=os.getenv("sparse_tokenizer", "cjk"))
+        self.deleted_count = self.chunked_documents.deleted_count()
+        self.sparse_index.set_deleted(self.chunked_documents.deleted_positions())
+        self.sparse_retriever = SparseIndexRetriever(index=self.sparse_index, documents=self.chunked_documents,
+                                                     k=int(os.getenv("sparse_k", "4")))
+
+    # Upsert chunks into Chroma under their content hash IDs. Chunks that are already in the collection are
+    # skipped and, with use_embedding_cache, chunks embedded before (e.g. prior to a rebuild) are not re-embedded.
+    # With a checkpoint, chunks written by an earlier interrupted run are skipped without asking Chroma.
+    def add_to_vector_store(self, chunks, show_progress=False, checkpoint=None):
+        unique_chunks = list({doc.metadata['id']: doc for doc in chunks}.values())
+        if checkpoint is not None:
+            unique_chunks = [doc for doc in unique_chunks if doc.metadata['id'] not in checkpoint.ids]
+        ids = [doc.metadata['id'] for doc in unique_chunks]
+        existing = set()
+        for start in range(0, len(ids), 500):
+            existing.update(self.db.get(ids=ids[start:start + 500], include=[])['ids'])
+        new_chunks = [doc for doc in unique_chunks if doc.metadata['id'] not in existing]
+
+        vectorize_chunks(
+            self.db._collection,
+            self.embeddings,
+            new_chunks,
+            batch_size=int(os.getenv("vectorize_batch_size", "64")),
+            max_workers=int(os.getenv("vectorize_workers", "4")),
+            requests_per_second=float(os.getenv("vectorize_requests_per_second", "0")),
+            checkpoint=checkpoint,
+            show_progress=show_progress
+        )
+
     # Loads the data and chunks it into an ensemble retriever
     def loadData(self):
-        persist_directory = f"{os.getenv('persist_directory')}"
-        document_chunks_pickle = f"{os.getenv('document_chunks_pickle')}"
+        # With several uvicorn workers only one of them builds the indexes at a time, the others wait and
+        # then map the same files
+        self.lock_path = f"{os.getenv('chunk_store_path', 'rag/chunks.sqlite')}.lock"
+        with file_lock(self.lock_path):
+            self.load_indexes()
+
+        # Set up the vector retriever
+        retriever = self.db.as_retriever(
+            search_type="mmr", search_kwargs={'k': int(os.getenv("vector_store_k"))}
+        )
+
+        # Now combine them to do hybrid retrieval
+        self.ensemble_retriever = EnsembleRetriever(
+            retrievers=[self.sparse_retriever, retriever], weights=[0.5, 0.5]
+        )
+        # Set up the reranker
+        self.rerank_retriever = None
+        self.rerank_cache = None
+        if os.getenv("rerank") == "True":
+            self.compressor = self.make_compressor()
+
+            self.rerank_retriever = ContextualCompressionRetriever(
+                base_compressor=self.compressor, base_retriever=self.ensemble_retriever
+            )
 
-        if os.path.exists(document_chunks_pickle):
-            with open(document_chunks_pickle, 'rb') as f:
-                self.chunked_documents = pickle.load(f)
+    # Cross-encoder reranker, scored in batches of rerank_batch_size with the scores of (query, chunk) pairs
+    # cached, on torch or, with rerank_backend=onnx, on ONNX Runtime with int8 weights
+    def make_compressor(self):
+        if os.getenv("rerank_model") == "flashrank":
+            model_name = os.getenv("flashrank_model", None)
+            return FlashrankRerank(top_n=int(os.getenv("rerank_k")), model=model_name)
+        if os.getenv("rerank_backend") == "onnx":
+            model = OnnxCrossEncoder(
+                os.getenv("rerank_model"),
+                quantize=os.getenv("rerank_quantize", "True") == "True",
+                threads=int(os.getenv("onnx_threads", "0")) or None
+            )
         else:
-            # Load PDF files if need be
-            docs = []
-            data_dir = os.getenv('data_directory')
-            file_types = os.getenv("file_types").split(",")
-            if "pdf" in file_types:
-                loader = PyPDFDirectoryLoader(data_dir)
-                docs = docs + loader.load()
-            # Load JSON
-            if "json" in file_types:
-                text_content = True
-                if os.getenv("json_text_content").lower() == 'false':
-                    text_content = False
-                loader_kwargs = {
-                    'jq_schema': os.getenv("json_schema"),
-                    'text_content': text_content
-                }
-                loader = DirectoryLoader(
-                    path=data_dir,
-                    glob="*.json",
-                    loader_cls=JSONLoader,
-                    loader_kwargs=loader_kwargs,
-                    recursive=True,
-                    show_progress=True,
-                )
-                docs = docs + loader.load()
-            # Load TXT
-            if "txt" in file_types:
-                loader = DirectoryLoader(
-                    path=data_dir,
-                    glob="*.txt",
-                    loader_cls=TextLoader,
-                    recursive=True,
-                    show_progress=True,
-                )
-                docs = docs + loader.load()
-            # Load CSV
-            if "csv" in file_types:
-                loader = DirectoryLoader(
-                    path=data_dir,
-                    glob="*.csv",
-                    loader_cls=CSVLoader,
-                    recursive=True,
-                    show_progress=True,
-                )
-                docs = docs + loader.load()
-            # Load MS Word
-            if "docx" in file_types:
-                loader = DirectoryLoader(
-                    path=data_dir,
-                    glob="*.docx",
-                    loader_cls=Docx2txtLoader,
-                    recursive=True,
-                    show_progress=True,
-                )
-                docs = docs + loader.load()
-            # Load MS Excel
-            if "xlsx" in file_types:
-                loader = DirectoryLoader(
-                    path=data_dir,
-                    glob="*.xlsx",
-                    loader_cls=UnstructuredExcelLoader,
-                    recursive=True,
-                    show_progress=True,
-                )
-                docs = docs + loader.load()
-            # load md
-            if "md" in file_types:
-                loader = DirectoryLoader(
-                    path=data_dir,
-                    glob="*.md",
-                    loader_cls=UnstructuredMarkdownLoader,
-                    recursive=True,
-                    show_progress=True,
-                )
-                docs = docs + loader.load()
-            # Load MS PPT
-            if "pptx" in file_types:
-                loader = DirectoryLoader(
-                    path=data_dir,
-                    glob="*.pptx",
-                    loader_cls=UnstructuredPowerPointLoader,
-                    recursive=True,
-                    show_progress=True,
-                )
-                docs = docs + loader.load()
-            # Load XML, which is nasty
-            if "xml" in file_types:
-                loader = DirectoryLoader(
-                    path=data_dir,
-                    glob="*.xml",
-                    loader_cls=TextLoader,
-                    recursive=True,
-                    show_progress=True,
-                )
-                xmldocs = loader.load()
-                newdocs = []
-                for index, doc in enumerate(xmldocs):
-                    xmltree = etree.fromstring(doc.page_content.encode('utf-8'))
-                    elements = xmltree.xpath(os.getenv("xml_xpath"))
-                    elements = [etree.tostring(element, pretty_print=True).decode() for element in elements]
-                    metadata = doc.metadata
-                    metadata['index'] = index
-                    newdocs = newdocs + [Document(page_content=doc, metadata=metadata) for doc in elements]
-                docs = docs + newdocs
-
-            if os.getenv('splitter') == 'RecursiveCharacterTextSplitter':
-                if os.getenv("use_blank_line_as_separator") == "True":
-                    self.text_splitter = RecursiveCharacterTextSplitter(
-                        chunk_size=int(os.getenv('chunk_size')),
-                        chunk_overlap=int(os.getenv('chunk_overlap')),
-                        length_function=len,
-                        keep_separator=True,
-                        separators=[
-                            r'\n\s*\n',
-                            r"\n \n",
-                            r"\n\n",
-                            r"\n",
-                            r" ",
-                        ],
-                        is_separator_regex=True
-                    )
-                else:
-                    self.text_splitter = RecursiveCharacterTextSplitter(
-                        chunk_size=int(os.getenv('chunk_size')),
-                        chunk_overlap=int(os.getenv('chunk_overlap')),
-                        length_function=len,
-                        keep_separator=True,
-                        separators=[
-                            "\n \n",
-                            "\n\n",
-                            "\n",
-                            ".",
-                            "!",
-                            "?",
-                            " ",
-                            ",",
-                            "\u200b",  # Zero-width space
-                            "\uff0c",  # Fullwidth comma
-                            "\u3001",  # Ideographic comma
-                            "\uff0e",  # Fullwidth full stop
-                            "\u3002",  # Ideographic full stop
-                            "",
-                        ],
-                    )
-            elif os.getenv('splitter') == 'SemanticChunker':
-                breakpoint_threshold_amount = None
-                number_of_chunks = None
-                if os.getenv('breakpoint_threshold_amount') != 'None':
-                    breakpoint_threshold_amount = float(os.getenv('breakpoint_threshold_amount'))
-                if os.getenv('number_of_chunks') != 'None':
-                    number_of_chunks = int(os.getenv('number_of_chunks'))
-                self.text_splitter = SemanticChunker(
-                    self.embeddings,
-                    breakpoint_threshold_type=os.getenv('breakpoint_threshold_type'),
-                    breakpoint_threshold_amount=breakpoint_threshold_amount,
-                    number_of_chunks=number_of_chunks
-                )
+            model = HuggingFaceCrossEncoder(model_name=os.getenv("rerank_model"))
+        if int(os.getenv("rerank_cache_size", "10000")) > 0:
+            self.rerank_cache = PairScoreCache(int(os.getenv("rerank_cache_size", "10000")))
+        return ScoredCrossEncoderReranker(
+            model=model,
+            top_n=int(os.getenv("rerank_k")),
+            batch_size=int(os.getenv("rerank_batch_size", "32")),
+            cache=self.rerank_cache
+        )
 
-            # Add a hash as ID to each document chunk's metadata and source to content
-            self.chunked_documents = [
-                Document(page_content=extract_source(doc.metadata['source']) + doc.page_content,
-                         metadata={**doc.metadata, 'id': hashlib.md5(doc.page_content.encode()).hexdigest()})
-                for doc in self.text_splitter.split_documents(docs)
-            ]
+    # Opens the chunk store, vector store and sparse index, building whatever is missing
+    def load_indexes(self):
+        persist_directory = f"{os.getenv('persist_directory')}"
+        document_chunks_pickle = f"{os.getenv('document_chunks_pickle')}"
 
-            # Store the chunks
-            with open(document_chunks_pickle, 'wb') as f:
-                pickle.dump(self.chunked_documents, f)
+        # A new chunk store is written completely before it appears at chunk_store_path
+        chunk_store_path = os.getenv('chunk_store_path', 'rag/chunks.sqlite')
+        loaded = None
+        if not ChunkStore.exists(chunk_store_path) and os.path.exists(document_chunks_pickle):
+            # Migrate the chunks of an existing pickle
+            chunks = self.read_chunks_pickle(document_chunks_pickle)
+            ChunkStore.build(chunk_store_path, [chunks])
+            # Its files are taken as ingested the way they are now, sync only reloads the ones that change later
+            sources = dict.fromkeys(normalize_source(doc.metadata['source']) for doc in chunks
+                                    if doc.metadata.get('source'))
+            loaded = [source for source in sources if os.path.isfile(source)]
+        elif not ChunkStore.exists(chunk_store_path):
+            # Stream the data directory through the ingestion pipeline, only one batch of chunks is held at a time
+            self.text_splitter = make_text_splitter(self.embeddings)
+            filenames = discover_files(os.getenv('data_directory'), os.getenv("file_types").split(","))
+            loaded = []
+            ChunkStore.build(chunk_store_path, iter_chunk_batches(
+                filenames,
+                processes=int(os.getenv("ingest_processes", "0")) or None,
+                # SemanticChunker calls the embedding model, it stays in this process
+                text_splitter=self.text_splitter if os.getenv('splitter') == 'SemanticChunker' else None,
+                loaded=loaded
+            ))
+
+        # Opening the chunk store reads nothing, chunks are only loaded when retrieved
+        self.chunked_documents = ChunkStore(chunk_store_path)
+        if loaded is not None:
+            # Record what was ingested, later syncs only reload the files that changed
+            self.chunked_documents.update_manifest(scan_files(loaded, {}))
+        self.load_drug_dictionary()
 
         if os.getenv("vector_store") == "chroma":
             if os.getenv("vector_store_initial_load") == "True":
@@ -245,11 +199,14 @@ class RAGHelper:
                     collection_name=os.getenv("vector_store_collection"),
                 )
 
-                # Add the documents 1 by 1 so we can track progress
-                with tqdm(total=len(self.chunked_documents), desc="Vectorizing documents") as pbar:
-                    for d in self.chunked_documents:
-                        self.db.add_documents([d])
-                        pbar.update(1)
+                # Resume from the checkpoint of an interrupted load, if any, and drop it once complete
+                checkpoint = Checkpoint(os.getenv("vectorize_checkpoint", "rag/vectorize.checkpoint"))
+                deleted = set(self.chunked_documents.deleted_positions())
+                for start in range(0, len(self.chunked_documents), 10000):
+                    chunks = [doc for position, doc in enumerate(self.chunked_documents[start:start + 10000], start)
+                              if position not in deleted]
+                    self.add_to_vector_store(chunks, show_progress=True, checkpoint=checkpoint)
+                checkpoint.clear()
             else:
                 # Load chunked documents into the Milvus index
                 self.db = Chroma(
@@ -258,40 +215,12 @@ class RAGHelper:
                     collection_name=os.getenv("vector_store_collection"),
                 )
 
-            # When we use Chroma, we have an in-memory BM25 retriever
-            self.sparse_retriever = BM25Retriever.from_texts(
-                [x.page_content for x in self.chunked_documents],
-                metadatas=[x.metadata for x in self.chunked_documents]
-            )
+            # When we use Chroma, BM25 runs on our own inverted index, built once and memory-mapped afterwards
+            self.load_sparse_retriever()
         else:
             raise Exception(
                 "Only chroma are supported as vector stores! Please set vector_store in your .env.en.postgres file.")
 
-        # Set up the vector retriever
-        retriever = self.db.as_retriever(
-            search_type="mmr", search_kwargs={'k': int(os.getenv("vector_store_k"))}
-        )
-
-        # Now combine them to do hybrid retrieval
-        self.ensemble_retriever = EnsembleRetriever(
-            retrievers=[self.sparse_retriever, retriever], weights=[0.5, 0.5]
-        )
-        # Set up the reranker
-        self.rerank_retriever = None
-        if os.getenv("rerank") == "True":
-            if os.getenv("rerank_model") == "flashrank":
-                model_name = os.getenv("flashrank_model", None)
-                self.compressor = FlashrankRerank(top_n=int(os.getenv("rerank_k")), model=model_name)
-            else:
-                self.compressor = ScoredCrossEncoderReranker(
-                    model=HuggingFaceCrossEncoder(model_name=os.getenv("rerank_model")),
-                    top_n=int(os.getenv("rerank_k"))
-                )
-
-            self.rerank_retriever = ContextualCompressionRetriever(
-                base_compressor=self.compressor, base_retriever=self.ensemble_retriever
-            )
-
     # no use
     def addDocument(self, filename):
         if filename.lower().endswith('pdf'):
@@ -388,13 +317,7 @@ class RAGHelper:
             )
 
         if os.getenv("rerank") == "True":
-            if os.getenv("rerank_model") == "flashrank":
-                self.compressor = FlashrankRerank(top_n=int(os.getenv("rerank_k")))
-            else:
-                self.compressor = ScoredCrossEncoderReranker(
-                    model=HuggingFaceCrossEncoder(model_name=os.getenv("rerank_model")),
-                    top_n=int(os.getenv("rerank_k"))
-                )
+            self.compressor = self.make_compressor()
 
             self.rerank_retriever = ContextualCompressionRetriever(
                 base_compressor=self.compressor, base_retriever=self.ensemble_retriever
@@ -1,30 +1,26 @@
 import os
 
-from .provenance import compute_rerank_provenance
+from .provenance import compute_rerank_provenance_batch, VectorSimilarityAttribution
+from .provenance_worker import ProvenanceWorker, ProvenanceStore
 # from .provenance import (compute_llm_provenance_cloud, compute_rerank_provenance, DocumentSimilarityAttribution)
-from .ScoredCrossEncoderReranker import ScoredCrossEncoderReranker
 from .RAGHelper import RAGHelper
 from .RAGHelper import formatDocuments
+from .deadline import Deadline, DeadlineExceeded
+from .answer_cache import normalize_question
+from .single_flight import SingleFlight, LLMCallCounter, config_fingerprint
+from .answer_cache import AnswerCache
+from .ingest_pipeline import load_file, make_text_splitter, discover_files
+from .manifest import scan_files, diff_manifest, normalize_source
+from .drug_dictionary import drug_entries
+from .section_splitter import detect_sections
+from .sparse_index import SparseIndexRetriever
+from .locks import file_lock
 
-from langchain.retrievers import EnsembleRetriever
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_experimental.text_splitter import SemanticChunker
 from .get_embeddings import get_embedding_function
 from langchain.prompts import ChatPromptTemplate
 from langchain.schema.runnable import RunnablePassthrough
-from langchain_community.retrievers import BM25Retriever
-from langchain.retrievers import ContextualCompressionRetriever
-from langchain.retrievers.document_compressors import FlashrankRerank
 from langchain_core.output_parsers import StrOutputParser
-from langchain_community.cross_encoders import HuggingFaceCrossEncoder
-
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_community.document_loaders import JSONLoader
-from langchain_community.document_loaders import Docx2txtLoader
-from langchain_community.document_loaders import UnstructuredExcelLoader
-from langchain_community.document_loaders import UnstructuredPowerPointLoader
-from langchain_community.document_loaders import UnstructuredMarkdownLoader
-from langchain_community.document_loaders.csv_loader import CSVLoader
+from langchain.retrievers import EnsembleRetriever, ContextualCompressionRetriever
 
 from langchain_openai import ChatOpenAI
 from langchain_google_genai import ChatGoogleGenerativeAI
@@ -32,7 +28,28 @@ from langchain_openai import AzureChatOpenAI
 from langchain_ollama.llms import OllamaLLM
 
 import re
-import pickle
+import time
+import numpy as np
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+def response_text(response):
+    if hasattr(response, 'content'):
+        response = response.content
+    elif hasattr(response, 'answer'):
+        response = response.answer
+    elif 'answer' in response:
+        response = response["answer"]
+    return response
+
+
+# The fetch-new and rewrite-ask chains are instructed to answer with yes or no
+def is_yes(response):
+    response = re.sub(r'\W+ ', '', response_text(response))
+    return response.lower().startswith('yes')
 
 
 def combine_results(inputs):
@@ -50,6 +67,20 @@ def combine_results(inputs):
         }
 
 
+# Requests sharing a single-flight answer got it within the first one's budget, they report what it skipped
+def inherit_skipped(deadline, skipped):
+    for stage in skipped:
+        deadline.skip(stage)
+
+
+# Settings that change the answer to a question, part of the single-flight key
+FLIGHT_CONFIG_KEYS = [
+    "use_openai", "openai_model_name", "use_gemini", "gemini_model_name", "use_azure", "use_ollama", "ollama_model",
+    "rag_instruction", "rag_question_initial", "use_rewrite_loop", "use_re2", "re2_prompt", "rerank", "rerank_k",
+    "rerank_model", "vector_store_k", "sparse_k", "use_drug_fast_path", "use_section_filter", "provenance_method",
+]
+
+
 class RAGHelperCloud(RAGHelper):
     def __init__(self, logger):
         if os.getenv("use_openai") == "True":
@@ -71,11 +102,42 @@ class RAGHelperCloud(RAGHelper):
         elif os.getenv("use_ollama") == "True":
             self.llm = OllamaLLM(model=os.getenv("ollama_model"))
 
+        # Counts the LLM calls of single-flight computations
+        self.llm = self.llm.with_config(callbacks=[LLMCallCounter()])
+
         self.embeddings = get_embedding_function()
 
-        # Load the data
+        # Bounded pool for the blocking stages (retrieval, reranking, provenance) of the async path
+        self.executor = ThreadPoolExecutor(max_workers=int(os.getenv("rag_executor_workers", "4")),
+                                           thread_name_prefix="rag")
+
+        # Load the data, index_version is bumped whenever the corpus changes
+        self.index_version = 0
+        self.ingest_lock = threading.Lock()
+        self.overlay_sync_interval = float(os.getenv("overlay_sync_interval", "5"))
+        # sections -> (index version, positions of their chunks)
+        self.section_positions = {}
+        self.next_overlay_sync = 0.0
         self.loadData()
 
+        # Identical first-turn questions asked at the same time share one computation
+        self.single_flight = None
+        if os.getenv("use_single_flight") == "True":
+            self.single_flight = SingleFlight()
+            self.flight_config = config_fingerprint(FLIGHT_CONFIG_KEYS, os.environ)
+
+        # Cache of answers to first-turn questions
+        self.answer_cache = None
+        if os.getenv("use_answer_cache") == "True":
+            self.answer_cache = AnswerCache(
+                self.embeddings,
+                max_size=int(os.getenv("answer_cache_size", "1000")),
+                ttl=float(os.getenv("answer_cache_ttl", "3600")),
+                threshold=float(os.getenv("answer_cache_threshold", "0.95")),
+                # A similar question about another drug must not get this drug's answer
+                entities=self.drug_dictionary.match
+            )
+
         # Create the RAG chain for determining if we need to fetch new documents
         rag_thread = [
             ('system', os.getenv('rag_fetch_new_instruction')),
@@ -90,8 +152,18 @@ class RAGHelperCloud(RAGHelper):
 
         # For provenance
         if os.getenv("provenance_method") == "similarity":
-            pass
-            # self.attributor = DocumentSimilarityAttribution()
+            self.attributor = VectorSimilarityAttribution(self.embeddings, self.db._collection)
+        # Deferred provenance is scored by a background worker, in batches across requests
+        self.provenance_worker = None
+        if os.getenv("provenance_deferred") == "True" and \
+                os.getenv("provenance_method") in ['rerank', 'attention', 'similarity', 'llm']:
+            self.provenance_worker = ProvenanceWorker(
+                self.score_provenance,
+                batch_size=int(os.getenv("provenance_batch_size", "64")),
+                max_wait=float(os.getenv("provenance_max_wait", "0.02")),
+                store=ProvenanceStore(os.getenv("provenance_store_path", "rag/provenance.sqlite"),
+                                      ttl=float(os.getenv("provenance_store_ttl", "86400")))
+            )
 
         # Also create the rewrite loop LLM chain, if need be
         self.rewrite_ask_chain = None
@@ -103,14 +175,8 @@ class RAGHelperCloud(RAGHelper):
                 ('human', os.getenv('rewrite_query_question'))
             ]
             rewrite_ask_prompt = ChatPromptTemplate.from_messages(rewrite_ask_thread)
-            rewrite_ask_llm_chain = rewrite_ask_prompt | self.llm
-            context_retriever = self.ensemble_retriever
-            if os.getenv("rerank") == "True":
-                context_retriever = self.rerank_retriever
-            self.rewrite_ask_chain = (
-                    {"context": context_retriever | formatDocuments, "question": RunnablePassthrough()} |
-                    rewrite_ask_llm_chain
-            )
+            # The context is filled in from the docs we already retrieved for the question
+            self.rewrite_ask_chain = rewrite_ask_prompt | self.llm
 
             # Next the chain to ask the LLM for the actual rewrite(s)
             rewrite_thread = [
@@ -123,56 +189,122 @@ class RAGHelperCloud(RAGHelper):
                     rewrite_llm_chain
             )
 
-    def handle_rewrite(self, user_query):
+    def get_context_retriever(self):
+        if os.getenv("rerank") == "True":
+            return self.rerank_retriever
+        return self.ensemble_retriever
+
+    async def run_blocking(self, func, *args):
+        # Run CPU-bound or blocking work (BM25, embeddings, reranking) on our bounded executor
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args))
+
+    # Fast path for questions that mention a drug or license number: rank only the chunks of the matching
+    # labels by BM25 instead of a hybrid search and rerank over the whole corpus
+    def retrieve_drug(self, user_query, section_filter=None):
+        if os.getenv("use_drug_fast_path") != "True":
+            return None
+        sources = self.drug_dictionary.match(user_query)
+        if not sources or len(sources) > int(os.getenv("drug_fast_path_max_labels", "3")):
+            return None
+        positions = [position for position, _ in self.chunked_documents.live_chunks(sources)]
+        if section_filter is not None:
+            # Only the asked for sections of the label, if it has them
+            in_sections = np.intersect1d(positions, section_filter[1]).tolist()
+            positions = in_sections or positions
+        scores = self.sparse_index.score(user_query)
+        positions = [position for position in positions if position < len(scores)]
+        if not positions:
+            return None
+        positions.sort(key=lambda position: (-scores[position], position))
+        return [self.chunked_documents[position]
+                for position in positions[:int(os.getenv("drug_fast_path_k", "3"))]]
+
+    # The label sections a question is about (e.g. 用法及用量 for dosage questions) and the positions of their
+    # chunks, None when there is no clear intent or the chunks were not split by MarkdownSectionSplitter
+    def section_filter(self, user_query):
+        if os.getenv("use_section_filter") != "True":
+            return None
+        sections = frozenset(detect_sections(user_query))
+        if not sections:
+            return None
+        cached = self.section_positions.get(sections)
+        if cached is None or cached[0] != self.index_version:
+            cached = (self.index_version,
+                      np.asarray(self.chunked_documents.section_positions(sections), dtype=np.int64))
+            self.section_positions[sections] = cached
+        return (sections, cached[1]) if len(cached[1]) else None
+
+    # Hybrid retrieval (and reranking) over the chunks of some sections only: BM25 only ranks their chunks,
+    # Chroma filters on the section metadata and the reranker only sees what is left
+    def build_section_retrievers(self, section_filter):
+        (sections, positions) = section_filter
+        sparse_retriever = SparseIndexRetriever(index=self.sparse_index, documents=self.chunked_documents,
+                                                k=self.sparse_retriever.k, allowed=positions)
+        retriever = self.db.as_retriever(
+            search_type="mmr", search_kwargs={'k': int(os.getenv("vector_store_k")),
+                                              'filter': {'section': {'$in': sorted(sections)}}}
+        )
+        ensemble_retriever = EnsembleRetriever(retrievers=[sparse_retriever, retriever], weights=[0.5, 0.5])
+        if self.rerank_retriever is None:
+            return ensemble_retriever, ensemble_retriever
+        return ensemble_retriever, ContextualCompressionRetriever(
+            base_compressor=self.compressor, base_retriever=ensemble_retriever
+        )
+
+    # Retrieval stage, run exactly once per question, its docs are shared by formatting, answering,
+    # the rewrite decision and provenance
+    def retrieve(self, user_query, deadline=None):
+        section_filter = self.section_filter(user_query)
+        docs = self.retrieve_drug(user_query, section_filter)
+        if docs:
+            return docs
+        if section_filter is not None:
+            (ensemble_retriever, context_retriever) = self.build_section_retrievers(section_filter)
+        else:
+            (ensemble_retriever, context_retriever) = (self.ensemble_retriever, self.get_context_retriever())
+        if os.getenv("rerank") == "True" and deadline is not None and not deadline.allows("rerank"):
+            # Not enough budget left for the cross-encoder, fall back to the top of the hybrid ranking
+            return ensemble_retriever.invoke(user_query)[:int(os.getenv("rerank_k"))]
+        return context_retriever.invoke(user_query)
+
+    def handle_rewrite(self, user_query, docs, deadline=None):
         # Check if we even need to rewrite or not
-        if os.getenv("use_rewrite_loop") == "True":
-            # Ask the LLM if we need to rewrite
-            response = self.rewrite_ask_chain.invoke(user_query)
-            if hasattr(response, 'content'):
-                response = response.content
-            elif hasattr(response, 'answer'):
-                response = response.answer
-            elif 'answer' in response:
-                response = response["answer"]
-            response = re.sub(r'\W+ ', '', response)
-            if response.lower().startswith('yes'):
+        if os.getenv("use_rewrite_loop") == "True" and (deadline is None or deadline.allows("rewrite")):
+            # Ask the LLM if we need to rewrite, based on the docs we already have
+            response = self.rewrite_ask_chain.invoke({"context": formatDocuments(docs), "question": user_query})
+            if is_yes(response):
                 # Start the rewriting into different alternatives
                 response = self.rewrite_chain.invoke(user_query)
 
-                if hasattr(response, 'content'):
-                    response = response.content
-                elif hasattr(response, 'answer'):
-                    response = response.answer
-                elif 'answer' in response:
-                    response = response["answer"]
-
-                # Show be split by newlines
-                return response
-            else:
-                # We do not need to rewrite
-                return user_query
-        else:
-            return user_query
-
-    # Main function to handle user interaction
-    def handle_user_interaction(self, user_query, history):
-        if len(history) == 0:
-            fetch_new_documents = True
-        else:
-            # Prompt for LLM
-            response = self.rag_fetch_new_chain.invoke(user_query)
-            if hasattr(response, 'content'):
-                response = response.content
-            elif hasattr(response, 'answer'):
-                response = response.answer
-            elif 'answer' in response:
-                response = response["answer"]
-            response = re.sub(r'\W+ ', '', response)
-            if response.lower().startswith('yes'):
-                fetch_new_documents = True
-            else:
-                fetch_new_documents = False
+                # Show be split by newlines, the old docs were deemed irrelevant so fetch for the rewrite
+                user_query = response_text(response)
+                return (user_query, self.retrieve(user_query, deadline))
+        return (user_query, docs)
 
+    async def ahandle_rewrite(self, user_query, docs, deadline):
+        if os.getenv("use_rewrite_loop") == "True" and deadline.allows("rewrite"):
+            response = await deadline.run(
+                self.rewrite_ask_chain.ainvoke({"context": formatDocuments(docs), "question": user_query})
+            )
+            if is_yes(response):
+                response = await deadline.run(self.rewrite_chain.ainvoke(user_query))
+                user_query = response_text(response)
+                return (user_query, await deadline.run(self.run_blocking(self.retrieve, user_query, deadline)))
+        return (user_query, docs)
+
+    def lookup_answer(self, user_query, history):
+        # Returns (cached, cache_key), cache_key is None when the question can't be cached
+        if self.answer_cache is None or len(history) > 0:
+            return (None, None)
+        return self.answer_cache.lookup(user_query, self.index_version)
+
+    def store_answer(self, cache_key, index_version, deadline, result):
+        # Don't cache answers that were degraded to meet the latency budget
+        if cache_key is not None and (deadline is None or not deadline.skipped):
+            self.answer_cache.store(cache_key, index_version, result)
+
+    def build_thread(self, history, fetch_new_documents):
         # Create prompt template based on whether we have history or not
         thread = [(x["role"], x["content"].replace("{", "(").replace("}", ")")) for x in history]
         if fetch_new_documents:
@@ -182,188 +314,407 @@ class RAGHelperCloud(RAGHelper):
             thread.append(('human', os.getenv('rag_question_initial')))
         else:
             thread.append(('human', os.getenv('rag_question_followup')))
+        return thread
+
+    # Main function to handle user interaction
+    def handle_user_interaction(self, user_query, history, deadline=None):
+        self.sync_overlay()
+        index_version = self.index_version
+        (cached, cache_key) = self.lookup_answer(user_query, history)
+        if cached is not None:
+            return cached
+
+        if len(history) == 0:
+            fetch_new_documents = True
+        elif deadline is not None and not deadline.allows("fetch_new"):
+            # No time to ask, fetching new documents is the safe choice
+            fetch_new_documents = True
+        else:
+            # Prompt for LLM
+            response = self.rag_fetch_new_chain.invoke(user_query)
+            fetch_new_documents = is_yes(response)
+
+        thread = self.build_thread(history, fetch_new_documents)
 
         # Create prompt from prompt template
         prompt = ChatPromptTemplate.from_messages(thread)
 
         # Create llm chain
-        llm_chain = prompt | self.llm
+        llm_chain = prompt | self.llm | StrOutputParser()
+
         if fetch_new_documents:
+            docs = self.retrieve(user_query, deadline)
             # Rewrite the question if needed
-            user_query = self.handle_rewrite(user_query)
-            context_retriever = self.ensemble_retriever
-            if os.getenv("rerank") == "True":
-                context_retriever = self.rerank_retriever
-
-            retriever_chain = {
-                "docs": context_retriever,
-                "context": context_retriever | formatDocuments,
-                "question": RunnablePassthrough()
-            }
-            llm_chain = prompt | self.llm | StrOutputParser()
-            rag_chain = (
-                    retriever_chain
-                    | RunnablePassthrough.assign(
-                answer=lambda x: llm_chain.invoke(
-                    {"docs": x["docs"], "context": x["context"], "question": x["question"]}
-                ))
-                    | combine_results
-            )
-        else:
-            retriever_chain = {
-                "question": RunnablePassthrough()
-            }
-            llm_chain = prompt | self.llm | StrOutputParser()
-            rag_chain = (
-                    retriever_chain
-                    | RunnablePassthrough.assign(
-                answer=lambda x: llm_chain.invoke(
-                    {"question": x["question"]}
-                ))
-                    | combine_results
-            )
+            (user_query, docs) = self.handle_rewrite(user_query, docs, deadline)
 
         # Check if we need to apply Re2 to mention the question twice
         if os.getenv("use_re2") == "True":
             user_query = f'{user_query}\n{os.getenv("re2_prompt")}{user_query}'
 
         # Invoke RAG pipeline
-        reply = rag_chain.invoke(user_query)
+        if fetch_new_documents:
+            context = formatDocuments(docs)
+            answer = llm_chain.invoke({"docs": docs, "context": context, "question": user_query})
+            reply = combine_results({"answer": answer, "docs": docs, "context": context, "question": user_query})
+        else:
+            answer = llm_chain.invoke({"question": user_query})
+            reply = combine_results({"answer": answer, "question": user_query})
 
         # See if we need to track provenance
-        if fetch_new_documents and os.getenv("provenance_method") in ['rerank', 'attention', 'similarity', 'llm']:
-            # Add the user question and the answer to our thread for provenance computation
-            answer = reply['answer']
-            context = reply['docs']
-
-            # Use the reranker but now on the answer (and potentially query too)
-            if os.getenv("provenance_method") == "rerank":
-                if not (os.getenv("rerank") == "True"):
-                    raise ValueError(
-                        "Provenance attribution is set to rerank but reranking is not enabled. Please choose another provenance method or turn on reranking.")
-                reranked_docs = compute_rerank_provenance(self.compressor, user_query, reply['docs'], answer)
-
-                # This is a bit of a hassle because reranked_docs is now reordered and we have no definitive key to use because of hybrid search.
-                # Note that we can't just return reranked_docs because the LLM may refer to "doc #1" in the order of the original scoring.
-                provenance_scores = []
-                for doc in context:
-                    # Find the document in reranked_docs
-                    reranked_score = \
-                        [d.metadata['relevance_score'] for d in reranked_docs if d.page_content == doc.page_content][0]
-                    provenance_scores.append(reranked_score)
-            # See if we need to do similarity-base provenance
-            elif os.getenv("provenance_method") == "similarity":
-                pass
-                # provenance_scores = self.attributor.compute_similarity(user_query, context, answer)
-            # See if we need to use LLM-based provenance
-            elif os.getenv("provenance_method") == "llm":
-                pass
-                # provenance_scores = compute_llm_provenance_cloud(self.llm, user_query, context, answer)
-
-            # Add the provenance scores
-            for i, score in enumerate(provenance_scores):
-                reply['docs'][i].metadata['provenance'] = score
+        if fetch_new_documents and self.provenance_worker is not None:
+            self.defer_provenance(user_query, reply)
+        elif fetch_new_documents and (deadline is None or deadline.allows("provenance")):
+            self.add_provenance(user_query, reply)
 
+        self.store_answer(cache_key, index_version, deadline, (thread, reply))
         return (thread, reply)
 
-    def addDocument(self, filename):
-        filename = os.path.join(os.getenv("data_directory"), filename)
-        if filename.lower().endswith('pdf'):
-            docs = PyPDFLoader(filename).load()
-        if filename.lower().endswith('json'):
-            docs = JSONLoader(
-                file_path=filename,
-                jq_schema=os.getenv("json_schema"),
-                text_content=os.getenv("json_text_content") == "True",
-            ).load()
-        if filename.lower().endswith('csv'):
-            docs = CSVLoader(filename).load()
-        if filename.lower().endswith('docx'):
-            docs = Docx2txtLoader(filename).load()
-        if filename.lower().endswith('xlsx'):
-            docs = UnstructuredExcelLoader(filename).load()
-        if filename.lower().endswith('pptx'):
-            docs = UnstructuredPowerPointLoader(filename).load()
-        if filename.lower().endswith('md'):
-            docs = UnstructuredMarkdownLoader(filename).load()
-
-        new_docs = docs
-
-        if os.getenv('splitter') == 'RecursiveCharacterTextSplitter':
-            self.text_splitter = RecursiveCharacterTextSplitter(
-                chunk_size=int(os.getenv('chunk_size')),
-                chunk_overlap=int(os.getenv('chunk_overlap')),
-                length_function=len,
-                keep_separator=True,
-                is_separator_regex=True,
-                separators=[
-                    r'\n\s*\n',
-                    "\n \n",
-                    "\n\n",
-                    "\n",
-                    ".",
-                    "!",
-                    "?",
-                    " ",
-                    ",",
-                    "\u200b",  # Zero-width space
-                    "\uff0c",  # Fullwidth comma
-                    "\u3001",  # Ideographic comma
-                    "\uff0e",  # Fullwidth full stop
-                    "\u3002",  # Ideographic full stop
-                    "",
-                ],
-            )
-        elif os.getenv('splitter') == 'SemanticChunker':
-            breakpoint_threshold_amount = None
-            number_of_chunks = None
-            if os.getenv('breakpoint_threshold_amount') != 'None':
-                breakpoint_threshold_amount = float(os.getenv('breakpoint_threshold_amount'))
-            if os.getenv('number_of_chunks') != 'None':
-                number_of_chunks = int(os.getenv('number_of_chunks'))
-            self.text_splitter = SemanticChunker(
-                self.embeddings,
-                breakpoint_threshold_type=os.getenv('breakpoint_threshold_type'),
-                breakpoint_threshold_amount=breakpoint_threshold_amount,
-                number_of_chunks=number_of_chunks
-            )
-
-        new_chunks = self.text_splitter.split_documents(new_docs)
+    # Async counterpart of everything in handle_user_interaction up to the answer generation,
+    # returns the thread, the answer chain and the inputs to invoke it with
+    async def aprepare_interaction(self, user_query, history, deadline):
+        if os.getenv("use_speculative_execution") == "True":
+            (fetch_new_documents, user_query, docs) = await self.aspeculate(user_query, history, deadline)
+        else:
+            if len(history) == 0:
+                fetch_new_documents = True
+            elif not deadline.allows("fetch_new"):
+                fetch_new_documents = True
+            else:
+                response = await deadline.run(self.rag_fetch_new_chain.ainvoke(user_query))
+                fetch_new_documents = is_yes(response)
 
-        self.chunked_documents = self.chunked_documents + new_chunks
+            if fetch_new_documents:
+                # Blocking retrieval can't be interrupted, on expiry we stop waiting and drop its result
+                docs = await deadline.run(self.run_blocking(self.retrieve, user_query, deadline))
+                (user_query, docs) = await self.ahandle_rewrite(user_query, docs, deadline)
 
-        invalid_chars = r'<>:"/\|?*'
-        valid_filename = re.sub(f"[{re.escape(invalid_chars)}]", "_",
-                                os.getenv('vector_store'))
-        # Store these too, for our sparse DB
-        with open(f"{valid_filename}_sparse.pickle", 'wb') as f:
-            pickle.dump(self.chunked_documents, f)
+        thread = self.build_thread(history, fetch_new_documents)
+        prompt = ChatPromptTemplate.from_messages(thread)
+        llm_chain = prompt | self.llm | StrOutputParser()
 
-        # Add to vector DB
-        self.db.add_documents(new_chunks)
+        if os.getenv("use_re2") == "True":
+            user_query = f'{user_query}\n{os.getenv("re2_prompt")}{user_query}'
 
-        # Add to BM25
-        bm25_retriever = BM25Retriever.from_texts(
-            [x.page_content for x in self.chunked_documents],
-            metadatas=[x.metadata for x in self.chunked_documents]
-        )
+        if fetch_new_documents:
+            inputs = {"docs": docs, "context": formatDocuments(docs), "question": user_query}
+        else:
+            inputs = {"question": user_query}
+        return (thread, llm_chain, inputs)
+
+    # Speculative version of the fetch-new / retrieve / rewrite sequence: retrieval for the original question,
+    # the fetch-new decision, the rewrite decision and the rewrite itself all start as soon as their inputs are
+    # there instead of one after the other. Results that turn out not to be needed are cancelled or dropped, so
+    # this trades extra LLM calls for latency. Returns (fetch_new_documents, user_query, docs).
+    async def aspeculate(self, user_query, history, deadline):
+        tasks = []
+
+        def start(awaitable):
+            task = asyncio.ensure_future(deadline.run(awaitable))
+            tasks.append(task)
+            return task
+
+        async def ask_rewrite(retrieve_task):
+            docs = await retrieve_task
+            return await self.rewrite_ask_chain.ainvoke({"context": formatDocuments(docs), "question": user_query})
+
+        try:
+            fetch_new_task = None
+            if len(history) > 0 and deadline.allows("fetch_new"):
+                fetch_new_task = start(self.rag_fetch_new_chain.ainvoke(user_query))
+            retrieve_task = start(self.run_blocking(self.retrieve, user_query, deadline))
+            rewrite_ask_task = None
+            if os.getenv("use_rewrite_loop") == "True" and deadline.allows("rewrite"):
+                rewrite_ask_task = start(ask_rewrite(retrieve_task))
+                rewrite_task = start(self.rewrite_chain.ainvoke(user_query))
+
+            if fetch_new_task is not None and not is_yes(await fetch_new_task):
+                return (False, user_query, None)
+
+            docs = await retrieve_task
+            if rewrite_ask_task is not None and is_yes(await rewrite_ask_task):
+                user_query = response_text(await rewrite_task)
+                docs = await deadline.run(self.run_blocking(self.retrieve, user_query, deadline))
+            return (True, user_query, docs)
+        finally:
+            # Drop whatever speculative work is still running
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    # Single-flight key of a first-turn question, None when it can't be shared
+    def flight_key(self, user_query, history, index_version):
+        if self.single_flight is None or len(history) > 0:
+            return None
+        return (normalize_question(user_query), self.flight_config, index_version)
+
+    # Async variant of handle_user_interaction, LLM calls are awaited and blocking stages run on our executor.
+    # All LLM calls are cancelled once the deadline expires, raising DeadlineExceeded.
+    async def ahandle_user_interaction(self, user_query, history, deadline=None):
+        deadline = deadline or Deadline()
+        await deadline.run(self.run_blocking(self.sync_overlay))
+        index_version = self.index_version
+        (cached, cache_key) = await deadline.run(self.run_blocking(self.lookup_answer, user_query, history))
+        if cached is not None:
+            return cached
+
+        flight_key = self.flight_key(user_query, history, index_version)
+        if flight_key is None:
+            return await self.aanswer(user_query, history, deadline, cache_key, index_version)
+        # Requests arriving while the same question is being answered wait for that answer, each within its own
+        # budget, the first one's deadline governs the computation
+        (result, skipped) = await deadline.run(self.single_flight.run(
+            flight_key, lambda: self.ashare_answer(user_query, history, deadline, cache_key, index_version)
+        ))
+        inherit_skipped(deadline, skipped)
+        return result
+
+    # The flight result: the answer and the stages the first request's deadline skipped to produce it
+    async def ashare_answer(self, user_query, history, deadline, cache_key, index_version):
+        result = await self.aanswer(user_query, history, deadline, cache_key, index_version)
+        return (result, list(deadline.skipped))
+
+    # Everything after the answer cache lookup, the part identical questions share
+    async def aanswer(self, user_query, history, deadline, cache_key, index_version):
+        (thread, llm_chain, inputs) = await self.aprepare_interaction(user_query, history, deadline)
+
+        answer = await deadline.run(llm_chain.ainvoke(inputs))
+        reply = combine_results({**inputs, "answer": answer})
+        if "docs" in inputs and self.provenance_worker is not None:
+            self.defer_provenance(inputs["question"], reply)
+        elif "docs" in inputs and deadline.allows("provenance"):
+            await deadline.run(self.run_blocking(self.add_provenance, inputs["question"], reply))
+
+        self.store_answer(cache_key, index_version, deadline, (thread, reply))
+        return (thread, reply)
 
-        # Update full retriever too
-        retriever = self.db.as_retriever(search_type="mmr", search_kwargs={'k': int(os.getenv('vector_store_k'))})
-        self.ensemble_retriever = EnsembleRetriever(
-            retrievers=[bm25_retriever, retriever], weights=[0.5, 0.5]
-        )
+    # Streaming variant, yields ("docs", docs) as soon as retrieval is done, ("token", text) for every answer
+    # chunk the LLM emits, ("provenance", docs) once scored and finally ("done", (thread, reply)). With deferred
+    # provenance "done" comes first and ("provenance", docs) follows when the worker has scored the docs.
+    async def astream_user_interaction(self, user_query, history, deadline=None):
+        deadline = deadline or Deadline()
+        await deadline.run(self.run_blocking(self.sync_overlay))
+        index_version = self.index_version
+        (cached, cache_key) = await deadline.run(self.run_blocking(self.lookup_answer, user_query, history))
+        flight_key = self.flight_key(user_query, history, index_version)
+        joined = self.single_flight.join(flight_key) if cached is None and flight_key is not None else None
+        if joined is not None:
+            # The same question is being answered right now, replay that answer instead of streaming a new one
+            (cached, skipped) = await deadline.run(joined)
+            inherit_skipped(deadline, skipped)
+        if cached is not None:
+            # Replay the cached answer as a stream
+            (thread, reply) = cached
+            yield ("docs", reply["docs"])
+            yield ("token", reply["answer"])
+            if "provenance_id" in reply:
+                # Deferred, the done event has the provenance_id, the scores follow once the worker has them
+                yield ("done", cached)
+                async for event in self.await_provenance(reply, deadline):
+                    yield event
+                return
+            yield ("provenance", reply["docs"])
+            yield ("done", cached)
+            return
+
+        (thread, llm_chain, inputs) = await self.aprepare_interaction(user_query, history, deadline)
+        if "docs" in inputs:
+            yield ("docs", inputs["docs"])
+
+        chunks = []
+        async for chunk in deadline.iterate(llm_chain.astream(inputs)):
+            chunks.append(chunk)
+            yield ("token", chunk)
+
+        reply = combine_results({**inputs, "answer": "".join(chunks)})
+        if "docs" in inputs and self.provenance_worker is not None:
+            self.defer_provenance(inputs["question"], reply)
+            self.store_answer(cache_key, index_version, deadline, (thread, reply))
+            yield ("done", (thread, reply))
+            async for event in self.await_provenance(reply, deadline):
+                yield event
+            return
+
+        if "docs" in inputs and deadline.allows("provenance"):
+            await deadline.run(self.run_blocking(self.add_provenance, inputs["question"], reply))
+            yield ("provenance", reply["docs"])
+
+        self.store_answer(cache_key, index_version, deadline, (thread, reply))
+        yield ("done", (thread, reply))
+
+    # Yields ("provenance", docs) once the deferred provenance of the reply is scored, nothing when scoring
+    # fails, the job is no longer known or the deadline expires first
+    async def await_provenance(self, reply, deadline):
+        job = self.provenance_worker.get(reply["provenance_id"]) if self.provenance_worker is not None else None
+        if job is None:
+            return
+        try:
+            await deadline.run(self.provenance_worker.wait(job))
+        except DeadlineExceeded:
+            return
+        if job.status == "done":
+            yield ("provenance", reply["docs"])
+
+    def add_provenance(self, user_query, reply):
+        if os.getenv("provenance_method") not in ['rerank', 'attention', 'similarity', 'llm']:
+            return
+
+        # Add the user question and the answer to our thread for provenance computation
+        answer = reply['answer']
+        context = reply['docs']
+
+        provenance_scores = self.score_provenance([(user_query, context, answer)])[0]
+
+        # Add the provenance scores, in the order of the docs since the LLM may refer to "doc #1"
+        for i, score in enumerate(provenance_scores):
+            if score is not None:
+                reply['docs'][i].metadata['provenance'] = score
 
-        if os.getenv("rerank") == "True":
-            if os.getenv("rerank_model") == "flashrank":
-                self.compressor = FlashrankRerank(top_n=int(os.getenv("rerank_k")),
-                                                  model=os.getenv("flashrank_model", None))
-            else:
-                self.compressor = ScoredCrossEncoderReranker(
-                    model=HuggingFaceCrossEncoder(model_name=os.getenv("rerank_model")),
-                    top_n=int(os.getenv("rerank_k"))
-                )
+    # Queues the docs of a reply for provenance scoring by the background worker, the reply gets the id to
+    # fetch the scores with (/provenance/{id}), its docs get metadata['provenance'] once they are scored
+    def defer_provenance(self, user_query, reply):
+        job = self.provenance_worker.submit(user_query, reply['docs'], reply['answer'])
+        reply['provenance_id'] = job.id
+        return job
+
+    # Provenance scores for a batch of (query, docs, answer), per request in the order of its docs
+    def score_provenance(self, requests):
+        # Use the reranker but now on the answer (and potentially query too)
+        if os.getenv("provenance_method") == "rerank":
+            if not (os.getenv("rerank") == "True"):
+                raise ValueError(
+                    "Provenance attribution is set to rerank but reranking is not enabled. Please choose another provenance method or turn on reranking.")
+            # Scores are matched to the docs by chunk id, the reranker reorders them
+            return compute_rerank_provenance_batch(self.compressor, requests)
+        # See if we need to do similarity-base provenance
+        elif os.getenv("provenance_method") == "similarity":
+            return self.attributor.compute_similarity_batch(requests)
+        # See if we need to use LLM-based provenance
+        elif os.getenv("provenance_method") == "llm":
+            pass
+            # provenance_scores = compute_llm_provenance_cloud(self.llm, user_query, context, answer)
+        return [[None] * len(docs) for (_, docs, _) in requests]
+
+    def load_document(self, filename):
+        return load_file(filename)
+
+    def split_documents(self, new_docs):
+        self.text_splitter = make_text_splitter(self.embeddings)
+        return self.prepare_chunks(new_docs)
+
+    # Add chunks to every index incrementally, writers are serialized but readers never wait
+    def add_chunks(self, new_chunks):
+        with self.ingest_lock:
+            # Embedding is the slow part, workers starting up (which take the same file lock) only wait for
+            # the publish step
+            self.add_to_vector_store(new_chunks)
+            with file_lock(self.lock_path):
+                self._publish_chunks(new_chunks)
+
+    # The chunks have to be in the vector store already. Embedding is what fails (rate limits), when it does
+    # the chunk store and the sparse index are left as they are, a retry re-embeds only what is missing.
+    def _publish_chunks(self, new_chunks):
+        # Appended to the chunk store, existing chunks are never rewritten and the sparse retriever sees them.
+        # Chunks other workers appended in the meantime come first. The chunk store and the sparse index change
+        # together, BM25 doc ids are chunk store positions.
+        other_chunks = self.chunked_documents.extend(new_chunks)
+
+        # Add to BM25, goes into the delta segment of the index. The ensemble and the reranker stay as they are.
+        self.sparse_index.append([x.page_content for x in other_chunks + new_chunks])
+
+        entries = drug_entries(new_chunks)
+        self.chunked_documents.update_drugs(entries)
+        self.drug_dictionary.add({**drug_entries(other_chunks), **entries})
+
+        # The corpus changed, this invalidates cached answers
+        self.index_version += 1
+
+    # Add the chunks of (re)loaded files in place of the chunks these files had before and record them in the
+    # manifest, so a changed file does not leave its old chunks behind
+    def add_file_chunks(self, filenames, new_chunks):
+        with self.ingest_lock:
+            if new_chunks:
+                self.add_to_vector_store(new_chunks)
+            with file_lock(self.lock_path):
+                stale_chunks = self.chunked_documents.live_chunks(filenames)
+                if new_chunks:
+                    self._publish_chunks(new_chunks)
+                self._remove_chunks(stale_chunks, filenames)
+                self.chunked_documents.update_manifest(scan_files(filenames, {}))
+
+    def remove_files(self, filenames):
+        with self.ingest_lock, file_lock(self.lock_path):
+            self._remove_chunks(self.chunked_documents.live_chunks(filenames), filenames)
+            self.chunked_documents.remove_from_manifest(filenames)
+
+    # Removes the chunks (of the files sources) from every index
+    def _remove_chunks(self, chunks, sources=()):
+        if not chunks:
+            return
+        # Tombstones in the chunk store and the sparse index, positions stay valid
+        positions = [position for position, _ in chunks]
+        self.chunked_documents.delete(positions)
+        self.sparse_index.delete(positions)
+
+        # A vector is shared by all chunks with the same content hash, drop it once none of them is left
+        ids = {chunk_id for _, chunk_id in chunks}
+        ids.update(self.source_vector_ids(sources))
+        orphaned_ids = list(ids - self.chunked_documents.live_ids(ids))
+        for start in range(0, len(orphaned_ids), 500):
+            self.db.delete(ids=orphaned_ids[start:start + 500])
+
+        self.index_version += 1
+
+    # Ids of the vectors of the files sources. Vectors loaded before chunk ids were content hashes have random
+    # ids and are only found this way, their source may have been recorded with Windows separators.
+    def source_vector_ids(self, sources):
+        forms = sorted({form for source in sources
+                        for form in (normalize_source(source), normalize_source(source).replace("/", "\\"))})
+        ids = set()
+        for start in range(0, len(forms), 500):
+            ids.update(self.db.get(where={"source": {"$in": forms[start:start + 500]}}, include=[])["ids"])
+        return ids
+
+    # Compare data_directory with the manifest, returns the added or modified files and the deleted ones.
+    # Files that were only touched (same content hash) just get their manifest entry updated.
+    def diff_files(self):
+        previous = self.chunked_documents.manifest()
+        filenames = discover_files(os.getenv('data_directory'), os.getenv("file_types").split(","))
+        current = scan_files(filenames, previous)
+        (added, modified, deleted) = diff_manifest(previous, current)
+        self.chunked_documents.update_manifest({path: entry for path, entry in current.items()
+                                                if path in previous and entry != previous[path]
+                                                and path not in modified})
+        return added + modified, deleted
+
+    # All workers map the same chunk store and sparse index segment, what is mutable per worker is the small
+    # overlay on top: the sparse delta segment and its tombstones. Chunks other workers added or deleted are
+    # applied to it here, at most every overlay_sync_interval seconds. Chroma only sees them in this worker
+    # after a restart.
+    def sync_overlay(self):
+        now = time.monotonic()
+        if now < self.next_overlay_sync:
+            return
+        # Never wait for an ingestion batch of this worker (which embeds while holding the lock), it picks up
+        # the chunks of the other workers itself, the next request tries again
+        if not self.ingest_lock.acquire(blocking=False):
+            return
+        try:
+            self.next_overlay_sync = now + self.overlay_sync_interval
+            other_chunks = self.chunked_documents.refresh()
+            if other_chunks:
+                self.sparse_index.append([x.page_content for x in other_chunks])
+                self.drug_dictionary.add(drug_entries(other_chunks))
+                self.index_version += 1
+            # Chunks of files that were changed or removed through any worker
+            deleted_count = self.chunked_documents.deleted_count()
+            if deleted_count != self.deleted_count:
+                self.deleted_count = deleted_count
+                self.sparse_index.set_deleted(self.chunked_documents.deleted_positions())
+                self.index_version += 1
+        finally:
+            self.ingest_lock.release()
 
-            self.rerank_retriever = ContextualCompressionRetriever(
-                base_compressor=self.compressor, base_retriever=self.ensemble_retriever
-            )
+    def addDocument(self, filename):
+        new_chunks = self.split_documents(self.load_document(filename))
+        self.add_file_chunks([filename], new_chunks)
+        return len(new_chunks)
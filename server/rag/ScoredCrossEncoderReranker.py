@@ -1,7 +1,11 @@
 from __future__ import annotations
 
+import hashlib
+import heapq
 import operator
-from typing import Optional, Sequence
+import threading
+from collections import OrderedDict
+from typing import Any, Optional, Sequence
 
 from langchain_core.callbacks import Callbacks
 from langchain_core.documents import BaseDocumentCompressor, Document
@@ -9,6 +13,51 @@ from langchain_core.documents import BaseDocumentCompressor, Document
 from langchain.retrievers.document_compressors.cross_encoder import BaseCrossEncoder
 
 
+class PairScoreCache:
+    """LRU of cross-encoder scores keyed by (query hash, chunk id), shared by all requests of a worker."""
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.scores = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, keys):
+        found = {}
+        with self.lock:
+            for key in keys:
+                if key in self.scores:
+                    self.scores.move_to_end(key)
+                    found[key] = self.scores[key]
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, items):
+        with self.lock:
+            for key, score in items:
+                self.scores[key] = score
+                self.scores.move_to_end(key)
+            while len(self.scores) > self.max_size:
+                self.scores.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.scores),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+def chunk_id(doc):
+    # Chunks from the store carry their content hash as id, anything else is keyed by its content
+    return doc.metadata.get("id") or hashlib.md5(doc.page_content.encode()).hexdigest()
+
+
 class ScoredCrossEncoderReranker(BaseDocumentCompressor):
     """Document compressor that uses CrossEncoder for reranking."""
 
@@ -17,11 +66,43 @@ class ScoredCrossEncoderReranker(BaseDocumentCompressor):
       between the query and documents."""
     top_n: int = 3
     """Number of documents to return."""
+    batch_size: int = 32
+    """Number of pairs sent to the model at once."""
+    cache: Any = None
+    """Optional PairScoreCache, pairs scored before are not sent to the model again."""
 
     class Config:
         arbitrary_types_allowed = True
         extra = "forbid"
 
+    def score(self, documents: Sequence[Document], query: str) -> list:
+        """Scores of the (query, document) pairs, in the order of documents."""
+        return self.score_pairs([(query, doc) for doc in documents])
+
+    def score_pairs(self, pairs: Sequence[tuple]) -> list:
+        """Scores of (query, document) pairs, which may have different queries, in the order of pairs."""
+        query_hashes = {}
+        keys = []
+        for query, doc in pairs:
+            if query not in query_hashes:
+                query_hashes[query] = hashlib.sha256(query.encode("utf-8")).hexdigest()
+            keys.append((query_hashes[query], chunk_id(doc)))
+        scores = self.cache.get_many(list(dict.fromkeys(keys))) if self.cache is not None else {}
+
+        # Score every pair that is not cached once, in batches of at most batch_size
+        missing = {}
+        for key, (query, doc) in zip(keys, pairs):
+            if key not in scores and key not in missing:
+                missing[key] = (query, doc.page_content)
+        missing = list(missing.items())
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start:start + self.batch_size]
+            batch_scores = [float(score) for score in self.model.score([pair for _, pair in batch])]
+            scores.update(zip([key for key, _ in batch], batch_scores))
+            if self.cache is not None:
+                self.cache.put_many(zip([key for key, _ in batch], batch_scores))
+        return [scores[key] for key in keys]
+
     def compress_documents(
         self,
         documents: Sequence[Document],
@@ -39,7 +120,7 @@ class ScoredCrossEncoderReranker(BaseDocumentCompressor):
         Returns:
             A sequence of compressed documents.
         """
-        scores = self.model.score([(query, doc.page_content) for doc in documents])
-        docs_with_scores = list(zip(documents, scores))
-        result = sorted(docs_with_scores, key=operator.itemgetter(1), reverse=True)
-        return [doc.copy(update={"metadata": {**doc.metadata, "relevance_score": score}}) for doc, score in result[:self.top_n]]
\ No newline at end of file
+        scores = self.score(documents, query)
+        # Only the top n are copied, in the order of their score
+        result = heapq.nlargest(self.top_n, zip(documents, scores), key=operator.itemgetter(1))
+        return [doc.copy(update={"metadata": {**doc.metadata, "relevance_score": score}}) for doc, score in result]
@@ -0,0 +1,124 @@
+import re
+import time
+import threading
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+
+
+def normalize_question(question):
+    # Full-width to half-width, case and whitespace insensitive, ignore trailing punctuation like ？ or 。
+    question = unicodedata.normalize("NFKC", question).lower()
+    question = re.sub(r"\s+", " ", question).strip()
+    return re.sub(r"[\s?!.,;:。？！，、；：]+$", "", question)
+
+
+class AnswerCache:
+    """
+    LRU/TTL cache of (thread, reply) for first-turn questions.
+
+    Lookups try the normalized question text first and then fall back to the most similar cached
+    question embedding, provided its cosine similarity is at least the threshold and, with entities (a
+    function returning e.g. the drugs a question mentions), both questions are about the same entities.
+    Every entry belongs to an index version, the whole cache is dropped as soon as the corpus changes.
+    """
+
+    def __init__(self, embeddings, max_size=1000, ttl=3600, threshold=0.95, entities=None):
+        self.embeddings = embeddings
+        self.entities = entities
+        self.max_size = max_size
+        self.ttl = ttl
+        self.threshold = threshold
+        self.index_version = None
+        # normalized question -> (embedding, value, created, entities)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _embed(self, question):
+        vector = np.asarray(self.embeddings.embed_query(question), dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def _check_version(self, index_version):
+        if self.index_version != index_version:
+            if self.entries:
+                self.invalidations += 1
+            self.entries.clear()
+            self.index_version = index_version
+
+    def _expire(self):
+        now = time.monotonic()
+        for key in [key for key, (_, _, created, _) in self.entries.items() if now - created > self.ttl]:
+            del self.entries[key]
+
+    def lookup(self, question, index_version):
+        """Returns (value, key) on a hit and (None, key) on a miss, on a miss the key is to be passed to store."""
+        key = normalize_question(question)
+        with self.lock:
+            self._check_version(index_version)
+            self._expire()
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.exact_hits += 1
+                return (self.entries[key][1], (key, None, None))
+            candidates = list(self.entries.items())
+
+        # Questions that differ only in the drug they ask about embed almost the same
+        entities = frozenset(self.entities(question)) if self.entities is not None else frozenset()
+        candidates = [(candidate_key, entry) for candidate_key, entry in candidates if entry[3] == entities]
+
+        # Embedding the question is a remote call, don't hold the lock for it. The question as asked, not its
+        # normalized key, so retrieval finds the vector in the embedding cache instead of embedding it again
+        vector = self._embed(question)
+        if candidates:
+            matrix = np.stack([embedding for _, (embedding, _, _, _) in candidates])
+            similarities = matrix @ vector
+            best = int(np.argmax(similarities))
+            if similarities[best] >= self.threshold:
+                with self.lock:
+                    best_key = candidates[best][0]
+                    if best_key in self.entries and self.index_version == index_version:
+                        self.entries.move_to_end(best_key)
+                        self.semantic_hits += 1
+                        return (self.entries[best_key][1], (key, vector, entities))
+
+        with self.lock:
+            self.misses += 1
+        return (None, (key, vector, entities))
+
+    def store(self, lookup_key, index_version, value):
+        (key, vector, entities) = lookup_key
+        if vector is None:
+            vector = self._embed(key)
+            entities = frozenset(self.entities(key)) if self.entities is not None else frozenset()
+        with self.lock:
+            if self.index_version is not None and index_version < self.index_version:
+                # Computed against a corpus that has changed in the meantime
+                return
+            self._check_version(index_version)
+            self.entries[key] = (vector, value, time.monotonic(), entities)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self):
+        with self.lock:
+            self.entries.clear()
+            self.invalidations += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.exact_hits + self.semantic_hits + self.misses
+            return {
+                "size": len(self.entries),
+                "exact_hits": self.exact_hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "hit_rate": (self.exact_hits + self.semantic_hits) / lookups if lookups else 0.0,
+                "invalidations": self.invalidations,
+                "index_version": self.index_version,
+            }
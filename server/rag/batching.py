@@ -0,0 +1,110 @@
+import time
+import queue
+import threading
+from concurrent.futures import Future
+from typing import List
+
+from langchain_core.embeddings import Embeddings
+
+
+class MicroBatcher:
+    """
+    Dynamic batching for calls from many threads. Items are collected by a background thread into batches of
+    at most max_batch_size, waiting at most max_wait seconds after the first item for more to arrive, and passed
+    to process(items), which returns one result per item. Every caller gets the results of its own items.
+    """
+
+    def __init__(self, process, max_batch_size=32, max_wait=0.005, name="batcher"):
+        self.process = process
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.items = 0
+        self.largest_batch = 0
+        self.worker = threading.Thread(target=self._work, name=name, daemon=True)
+        self.worker.start()
+
+    def submit(self, item):
+        future = Future()
+        self.queue.put((item, future))
+        return future
+
+    def map(self, items):
+        """Results for the items, blocks until all of them are processed."""
+        futures = [self.submit(item) for item in items]
+        return [future.result() for future in futures]
+
+    def _work(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                # Whatever is queued already joins without waiting
+                try:
+                    batch.append(self.queue.get_nowait())
+                    continue
+                except queue.Empty:
+                    pass
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._run(batch)
+
+    def _run(self, batch):
+        with self.lock:
+            self.batches += 1
+            self.items += len(batch)
+            self.largest_batch = max(self.largest_batch, len(batch))
+        try:
+            results = self.process([item for item, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "batches": self.batches,
+                "items": self.items,
+                "mean_batch_size": self.items / self.batches if self.batches else 0.0,
+                "largest_batch": self.largest_batch,
+                "pending": self.queue.qsize(),
+            }
+
+
+class CoalescingEmbeddings(Embeddings):
+    """
+    Wraps an embeddings object so that embed_query calls arriving within max_wait seconds of each other are sent
+    as one embed_documents call (identical texts only once) and every caller gets its own vector back. Only for
+    providers that embed queries and documents alike (jina). embed_documents passes straight through.
+    """
+
+    def __init__(self, embeddings, max_batch_size=16, max_wait=0.003):
+        self.embeddings = embeddings
+        self.batcher = MicroBatcher(self.embed_batch, max_batch_size=max_batch_size, max_wait=max_wait,
+                                    name="query-coalescer")
+
+    def embed_batch(self, texts):
+        unique = list(dict.fromkeys(texts))
+        vectors = dict(zip(unique, self.embeddings.embed_documents(unique)))
+        return [vectors[text] for text in texts]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.batcher.submit(text).result()
+
+    def stats(self):
+        stats = self.batcher.stats()
+        # Provider calls saved compared to one call per query
+        return {**stats, "calls_saved": stats["items"] - stats["batches"]}
@@ -0,0 +1,262 @@
+import os
+import json
+import sqlite3
+import threading
+from collections.abc import Sequence
+
+from langchain_core.documents import Document
+
+from .drug_dictionary import parse_source
+from .manifest import normalize_source
+
+COLUMNS = ["id", "source", "drug_name", "start_index", "section"]
+
+
+def drug_name(source):
+    # Label files are named {license number}-{chinese product name}[-{indication}].md
+    return parse_source(source)[1]
+
+
+class ChunkStore(Sequence):
+    """
+    Append-only chunk store backed by SQLite, used in place of the list of chunk Documents.
+
+    Chunk ids, source, drug name, offsets and label section live in their own columns, the remaining metadata
+    as JSON and the text in a separate column, so opening the store loads nothing and a chunk's text is only
+    read when the chunk is accessed. Positions (0..len-1) are stable and match the sparse index document ids.
+
+    Several processes (uvicorn workers) can share one store, every instance only knows the rows up to its
+    own length until refresh() or extend() picks up what the others appended.
+
+    Chunks of removed or changed files are never deleted, only marked as deleted (tombstones) so positions
+    stay valid. They are still returned by position, retrievers filter them with deleted_positions().
+    """
+
+    def __init__(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        # Autocommit, extend() manages its own write transaction
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            "pos INTEGER PRIMARY KEY, id TEXT, source TEXT, drug_name TEXT, start_index INTEGER, "
+            "metadata TEXT, text TEXT, deleted INTEGER NOT NULL DEFAULT 0, section TEXT)"
+        )
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(chunks)")]
+        if "deleted" not in columns:
+            self.conn.execute("ALTER TABLE chunks ADD COLUMN deleted INTEGER NOT NULL DEFAULT 0")
+        if "section" not in columns:
+            self.conn.execute("ALTER TABLE chunks ADD COLUMN section TEXT")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS chunks_source ON chunks (source)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS chunks_section ON chunks (section)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS chunks_deleted ON chunks (pos) WHERE deleted = 1")
+        # Manifest of the ingested files
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, hash TEXT)"
+        )
+        # License number and product names per label file, for the drug dictionary
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS drugs (source TEXT PRIMARY KEY, license TEXT, name TEXT, english_name TEXT)"
+        )
+        # Sources recorded with Windows separators (chunks migrated from a pickle built on Windows)
+        self.conn.execute("UPDATE chunks SET source = replace(source, '\\', '/') WHERE instr(source, '\\') > 0")
+        self.conn.execute("UPDATE OR REPLACE drugs SET source = replace(source, '\\', '/') "
+                          "WHERE instr(source, '\\') > 0")
+        self.length = self.conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(path)
+
+    @classmethod
+    def build(cls, path, batches):
+        """Write batches of chunks to a new store that only appears at path once complete."""
+        tmp = f"{path}.tmp"
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(tmp + suffix):
+                os.remove(tmp + suffix)
+        store = cls(tmp)
+        for batch in batches:
+            store.extend(batch)
+        store.close()
+        os.replace(tmp, path)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def _to_document(self, row):
+        (chunk_id, source, _, start_index, section, metadata, text) = row
+        metadata = json.loads(metadata)
+        metadata.update({"id": chunk_id, "source": source})
+        if start_index is not None:
+            metadata["start_index"] = start_index
+        if section is not None:
+            metadata["section"] = section
+        return Document(page_content=text, metadata=metadata)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            (start, stop, step) = position.indices(self.length)
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            with self.lock:
+                rows = self.conn.execute(
+                    "SELECT id, source, drug_name, start_index, section, metadata, text FROM chunks "
+                    "WHERE pos >= ? AND pos < ? ORDER BY pos", (start, stop)
+                ).fetchall()
+            return [self._to_document(row) for row in rows]
+        if position < 0:
+            position += self.length
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT id, source, drug_name, start_index, section, metadata, text FROM chunks WHERE pos = ?", (position,)
+            ).fetchone()
+        if row is None:
+            raise IndexError(position)
+        return self._to_document(row)
+
+    def __iter__(self):
+        # One cursor over the whole table instead of a query per chunk
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT id, source, drug_name, start_index, section, metadata, text FROM chunks WHERE pos < ? ORDER BY pos",
+                (self.length,)
+            ).fetchall()
+        return (self._to_document(row) for row in rows)
+
+    def ids(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT id FROM chunks WHERE pos < ? ORDER BY pos", (self.length,))
+            return [row[0] or "" for row in rows]
+
+    def _rows_after(self, position):
+        rows = self.conn.execute(
+            "SELECT id, source, drug_name, start_index, section, metadata, text FROM chunks WHERE pos >= ? ORDER BY pos",
+            (position,)
+        ).fetchall()
+        return [self._to_document(row) for row in rows]
+
+    def refresh(self):
+        """Returns the chunks other processes appended since this instance last looked, in order."""
+        with self.lock:
+            others = self._rows_after(self.length)
+            self.length += len(others)
+        return others
+
+    def extend(self, chunks):
+        """
+        Append chunks, existing rows are never rewritten. Chunks other processes appended in the meantime come
+        before ours, these are returned so callers can keep their own indexes in the same order.
+        """
+        chunks = list(chunks)
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                others = self._rows_after(self.length)
+                rows = []
+                for position, doc in enumerate(chunks, start=self.length + len(others)):
+                    metadata = {key: value for key, value in doc.metadata.items() if key not in COLUMNS}
+                    source = normalize_source(doc.metadata["source"]) if doc.metadata.get("source") else None
+                    rows.append((position, doc.metadata.get("id"), source, drug_name(source) if source else None,
+                                 doc.metadata.get("start_index"), doc.metadata.get("section"),
+                                 json.dumps(metadata, ensure_ascii=False), doc.page_content))
+                self.conn.executemany(
+                    "INSERT INTO chunks (pos, id, source, drug_name, start_index, section, metadata, text) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows
+                )
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.length += len(others) + len(rows)
+        return others
+
+    def live_chunks(self, sources):
+        """(position, id) of the chunks of sources that are not deleted."""
+        sources = [normalize_source(source) for source in sources]
+        chunks = []
+        with self.lock:
+            for start in range(0, len(sources), 500):
+                batch = sources[start:start + 500]
+                chunks.extend(self.conn.execute(
+                    f"SELECT pos, id FROM chunks WHERE deleted = 0 AND source IN ({', '.join('?' * len(batch))})",
+                    batch
+                ).fetchall())
+        return chunks
+
+    def section_positions(self, sections):
+        """Positions of the chunks of any of the sections that are not deleted."""
+        sections = list(sections)
+        with self.lock:
+            return [row[0] for row in self.conn.execute(
+                f"SELECT pos FROM chunks WHERE deleted = 0 AND section IN ({', '.join('?' * len(sections))})",
+                sections
+            )]
+
+    def live_ids(self, ids):
+        """The ids that at least one chunk that is not deleted still has."""
+        ids = list(ids)
+        live = set()
+        with self.lock:
+            for start in range(0, len(ids), 500):
+                batch = ids[start:start + 500]
+                live.update(row[0] for row in self.conn.execute(
+                    f"SELECT DISTINCT id FROM chunks WHERE deleted = 0 AND id IN ({', '.join('?' * len(batch))})",
+                    batch
+                ))
+        return live
+
+    def _write_many(self, sql, rows):
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.executemany(sql, rows)
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def delete(self, positions):
+        self._write_many("UPDATE chunks SET deleted = 1 WHERE pos = ?", [(int(p),) for p in positions])
+
+    def deleted_count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM chunks WHERE deleted = 1").fetchone()[0]
+
+    def deleted_positions(self):
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT pos FROM chunks WHERE deleted = 1")]
+
+    def manifest(self):
+        """path -> (size, mtime, hash) of the files the chunks came from."""
+        with self.lock:
+            return {row[0]: tuple(row[1:]) for row in self.conn.execute("SELECT path, size, mtime, hash FROM files")}
+
+    def update_manifest(self, entries):
+        self._write_many("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                         [(normalize_source(path), *entry) for path, entry in entries.items()])
+
+    def remove_from_manifest(self, paths):
+        self._write_many("DELETE FROM files WHERE path = ?", [(normalize_source(path),) for path in paths])
+
+    def drugs(self):
+        """source -> (license, name, english name)"""
+        with self.lock:
+            return {row[0]: tuple(row[1:]) for row in self.conn.execute(
+                "SELECT source, license, name, english_name FROM drugs")}
+
+    def update_drugs(self, entries):
+        # Fields a later batch of chunks of the same file did not find are kept
+        self._write_many(
+            "INSERT INTO drugs VALUES (?, ?, ?, ?) ON CONFLICT (source) DO UPDATE SET "
+            "license = COALESCE(excluded.license, license), name = COALESCE(excluded.name, name), "
+            "english_name = COALESCE(excluded.english_name, english_name)",
+            [(normalize_source(source), *entry) for source, entry in entries.items()]
+        )
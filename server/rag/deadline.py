@@ -0,0 +1,75 @@
+import os
+import time
+import asyncio
+
+# Minimal time (in seconds) that has to be left on the budget for an optional stage to still run,
+# can be overridden per stage through deadline_reserve_<stage> in the .env
+DEFAULT_RESERVES = {
+    "fetch_new": 30.0,
+    "rewrite": 45.0,
+    "rerank": 20.0,
+    "provenance": 10.0,
+}
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class Deadline:
+    """Per-request latency budget, optional stages ask it whether they can still run."""
+
+    def __init__(self, budget=None):
+        # A budget of None means no deadline at all
+        self.expires_at = None if budget is None else time.monotonic() + budget
+        self.skipped = []
+
+    @classmethod
+    def from_env(cls):
+        budget = os.getenv("request_budget")
+        return cls(float(budget) if budget else None)
+
+    def remaining(self):
+        if self.expires_at is None:
+            return float("inf")
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def allows(self, stage):
+        """Whether the optional stage still fits the budget, stages that do not are recorded as skipped."""
+        reserve = float(os.getenv(f"deadline_reserve_{stage}", DEFAULT_RESERVES.get(stage, 0.0)))
+        if self.remaining() >= reserve:
+            return True
+        self.skip(stage)
+        return False
+
+    def skip(self, stage):
+        """Record a stage as skipped, once."""
+        if stage not in self.skipped:
+            self.skipped.append(stage)
+
+    def _timeout(self):
+        return None if self.expires_at is None else self.remaining()
+
+    async def run(self, awaitable):
+        """Await within the budget, the awaitable gets cancelled once the deadline expires."""
+        try:
+            return await asyncio.wait_for(awaitable, timeout=self._timeout())
+        except asyncio.TimeoutError:
+            raise DeadlineExceeded("Latency budget exceeded")
+
+    async def iterate(self, aiterable):
+        """Iterate an async iterator (e.g. an LLM token stream) within the budget."""
+        iterator = aiterable.__aiter__()
+        try:
+            while True:
+                try:
+                    item = await self.run(iterator.__anext__())
+                except StopAsyncIteration:
+                    return
+                yield item
+        finally:
+            if hasattr(iterator, "aclose"):
+                await iterator.aclose()
@@ -0,0 +1,152 @@
+import os
+import re
+import threading
+import unicodedata
+from collections import deque
+
+# 衛署藥製字第048875號, 衛部藥輸字第026XXX號, ...
+LICENSE_PATTERN = re.compile(r"[\u4e00-\u9fff]+字第\s*[0-9A-Za-z]+\s*號")
+# Dosage strength at the end of a product name, "康緒平緩釋膠囊 75 毫克" is asked for as "康緒平緩釋膠囊"
+# (applied to normalized names)
+STRENGTH_PATTERN = re.compile(r"[\s(]*[0-9][0-9.,/\s]*(毫克|公克|微克|毫升|公絲|mg|g|mcg|μg|ml|iu|%).*$")
+# Dosage form at the end of a product name (after the strength is removed), "康緒平緩釋膠囊" is also asked for
+# as "康緒平"
+FORM_PATTERN = re.compile(
+    r"\s*(緩釋|持續性藥效|長效|腸溶|膜衣|糖衣|口溶|口腔崩散|咀嚼|發泡|舌下|軟|硬|凍晶|外用)?\s*"
+    r"(膠囊|錠劑|錠|注射液|注射劑|軟膏|乳膏|凝膠|糖漿|口服液|內服液|懸液|懸浮液|滴眼液|點眼液|溶液|顆粒|散劑|散|"
+    r"粉劑|栓劑|貼片|噴霧劑|吸入劑|乳劑|洗劑)$"
+)
+FIELD_PATTERNS = {
+    "license": re.compile(r"許可證號\s*\n\s*(\S[^\n]*)"),
+    "name": re.compile(r"中文品名\s*\n\s*(\S[^\n]*)"),
+    "english_name": re.compile(r"英文品名\s*\n\s*(\S[^\n]*)"),
+}
+
+
+def normalize(text):
+    return unicodedata.normalize("NFKC", text).lower()
+
+
+def parse_source(source):
+    """License number and Chinese product name from a {許可證號}-{中文品名}[-{適應症}] label file name."""
+    parts = [part.strip() for part in re.split(r"[-_]", os.path.splitext(os.path.basename(source))[0])]
+    license = parts[0] if parts and LICENSE_PATTERN.fullmatch(parts[0]) else None
+    name = parts[1] if len(parts) > 1 and parts[1] else None
+    return license, name
+
+
+def drug_entries(chunks):
+    """
+    source -> (license, name, english name) for the label files of the chunks, parsed from the file name and,
+    where that falls short, the 許可證號/中文品名/英文品名 fields of the label.
+    """
+    entries = {}
+    for doc in chunks:
+        source = doc.metadata.get("source")
+        if not source:
+            continue
+        (license, name) = parse_source(source)
+        fields = dict(zip(["license", "name", "english_name"], entries.get(source, (license, name, None))))
+        for field, pattern in FIELD_PATTERNS.items():
+            if fields[field] is None:
+                match = pattern.search(doc.page_content)
+                if match:
+                    fields[field] = match.group(1).strip()
+        if any(fields.values()):
+            entries[source] = (fields["license"], fields["name"], fields["english_name"])
+    return entries
+
+
+def name_variants(license, name, english_name):
+    variants = set()
+    if license:
+        variants.add(normalize(license).replace(" ", ""))
+    if name:
+        name = normalize(name)
+        variants.add(name)
+        name = STRENGTH_PATTERN.sub("", name).strip()
+        variants.add(name)
+        variants.add(FORM_PATTERN.sub("", name).strip())
+    if english_name:
+        english_name = STRENGTH_PATTERN.sub("", normalize(english_name)).strip()
+        variants.add(english_name)
+        # The brand, "calmdown" for "calmdown sustained-release capsules"
+        brand = english_name.split(" ")[0]
+        if len(brand) >= 4:
+            variants.add(brand)
+    # Single characters and letters would match almost any question
+    return {variant for variant in variants if len(variant) >= 2 and (len(variant) >= 4 or not variant.isascii())}
+
+
+class AhoCorasick:
+    """Aho-Corasick automaton over characters, finds all occurrences of all patterns in one pass over the text."""
+
+    def __init__(self, patterns):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        for pattern, value in patterns.items():
+            state = 0
+            for char in pattern:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.output[state].append((len(pattern), value))
+
+        # Breadth first, the failure link of a state is the longest proper suffix that is also a prefix
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(char, 0)
+                self.output[next_state] = self.output[next_state] + self.output[self.fail[next_state]]
+
+    def find(self, text):
+        """Yields (start, end, value) for every occurrence of a pattern in text."""
+        state = 0
+        for i, char in enumerate(text):
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            for length, value in self.output[state]:
+                yield i + 1 - length, i + 1, value
+
+
+class DrugDictionary:
+    """
+    License numbers, Chinese and English product names of the labels, mapped to their label files. match()
+    finds the labels a question mentions with a single Aho-Corasick pass over the question.
+    """
+
+    def __init__(self):
+        self.names = {}
+        self.automaton = AhoCorasick({})
+        self.lock = threading.Lock()
+
+    def add(self, entries):
+        if not entries:
+            return
+        with self.lock:
+            for source, entry in entries.items():
+                for variant in name_variants(*entry):
+                    self.names.setdefault(variant, set()).add(source)
+            # Readers keep using the old automaton until the new one is swapped in
+            self.automaton = AhoCorasick({name: frozenset(sources) for name, sources in self.names.items()})
+
+    def match(self, query):
+        """Label files of the drugs mentioned in query, where names overlap the leftmost longest one wins."""
+        matches = sorted(self.automaton.find(normalize(query)), key=lambda match: (match[0], match[0] - match[1]))
+        sources = set()
+        end = 0
+        for (start, stop, match_sources) in matches:
+            if start >= end:
+                sources.update(match_sources)
+                end = stop
+        return sources
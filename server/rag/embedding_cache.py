@@ -0,0 +1,132 @@
+import os
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingStore:
+    """On-disk vector store keyed by (model, kind, text hash), backed by SQLite so all workers share it."""
+
+    def __init__(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "model TEXT NOT NULL, kind TEXT NOT NULL, hash TEXT NOT NULL, vector BLOB NOT NULL, "
+            "PRIMARY KEY (model, kind, hash))"
+        )
+        self.conn.commit()
+
+    def get_many(self, model, kind, hashes):
+        found = {}
+        with self.lock:
+            # Stay well below SQLite's limit on the number of host parameters
+            for start in range(0, len(hashes), 500):
+                batch = hashes[start:start + 500]
+                rows = self.conn.execute(
+                    f"SELECT hash, vector FROM embeddings WHERE model = ? AND kind = ? "
+                    f"AND hash IN ({','.join('?' * len(batch))})",
+                    [model, kind, *batch]
+                ).fetchall()
+                found.update({h: np.frombuffer(vector, dtype=np.float32) for h, vector in rows})
+        return found
+
+    def put_many(self, model, kind, items):
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, kind, hash, vector) VALUES (?, ?, ?, ?)",
+                [(model, kind, h, np.asarray(vector, dtype=np.float32).tobytes()) for h, vector in items]
+            )
+            self.conn.commit()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an embeddings object with an in-memory LRU in front of a persistent EmbeddingStore,
+    only texts that are in neither get sent to the underlying (paid) provider.
+    """
+
+    def __init__(self, embeddings, model_name, store, memory_size=10000):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.store = store
+        self.memory_size = memory_size
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _remember(self, key, vector):
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def _embed(self, kind, texts, embed_fn):
+        hashes = [text_hash(text) for text in texts]
+        vectors = {}
+        with self.lock:
+            for h in hashes:
+                if (kind, h) in self.memory:
+                    self.memory.move_to_end((kind, h))
+                    vectors[h] = self.memory[(kind, h)]
+                    self.memory_hits += 1
+
+        missing = list(dict.fromkeys(h for h in hashes if h not in vectors))
+        if missing:
+            on_disk = self.store.get_many(self.model_name, kind, missing)
+            vectors.update(on_disk)
+            with self.lock:
+                self.disk_hits += len(on_disk)
+
+        missing = [h for h in missing if h not in vectors]
+        if missing:
+            texts_by_hash = dict(zip(hashes, texts))
+            embedded = embed_fn([texts_by_hash[h] for h in missing])
+            embedded = [np.asarray(vector, dtype=np.float32) for vector in embedded]
+            self.store.put_many(self.model_name, kind, zip(missing, embedded))
+            vectors.update(zip(missing, embedded))
+            with self.lock:
+                self.misses += len(missing)
+
+        with self.lock:
+            for h in set(hashes):
+                self._remember((kind, h), vectors[h])
+        return [vectors[h].tolist() for h in hashes]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed("document", texts, self.embeddings.embed_documents)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed("query", [text], lambda texts: [self.embeddings.embed_query(texts[0])])[0]
+
+    def stats(self):
+        with self.lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+                "memory_size": len(self.memory),
+            }
+
+
+def uncached(embeddings):
+    """The embeddings inside any CachedEmbeddings, for texts that are not worth storing (e.g. answers)."""
+    while isinstance(embeddings, CachedEmbeddings):
+        embeddings = embeddings.embeddings
+    return embeddings
@@ -3,6 +3,10 @@ from langchain_community.embeddings import JinaEmbeddings, OllamaEmbeddings
 import os
 import dotenv
 
+from .embedding_cache import CachedEmbeddings, EmbeddingStore
+from .onnx_models import OnnxEmbeddings
+from .batching import CoalescingEmbeddings
+
 
 def get_embedding_function():
     dotenv.load_dotenv()
@@ -25,11 +29,36 @@ def get_embedding_function():
         embeddings = OllamaEmbeddings(
             model_name=os.getenv('embedding_model'),
         )
+    elif os.getenv('embedding_provider') == 'local':
+        # On this machine's CPU through ONNX Runtime, no embedding service needed
+        embeddings = OnnxEmbeddings(
+            os.getenv('embedding_model'),
+            quantize=os.getenv('local_embedding_quantize', 'True') == 'True',
+            threads=int(os.getenv('onnx_threads', '0')) or None,
+            max_batch_size=int(os.getenv('local_embedding_batch_size', '32')),
+            max_wait=float(os.getenv('local_embedding_max_wait', '0.005')),
+            query_prefix=os.getenv('local_embedding_query_prefix', ''),
+            document_prefix=os.getenv('local_embedding_document_prefix', '')
+        )
     else:
-        pass
-        # embeddings = HuggingFaceEmbeddings(
-        #     model_name=os.getenv('embedding_model'),
-        #     model_kwargs=model_kwargs
-        # )
+        raise ValueError(f"Unknown embedding_provider: {os.getenv('embedding_provider')}, "
+                         f"use jina, ollama or local")
+
+    # Concurrent queries share one request to the provider, the cache below wraps this so only misses get batched
+    if os.getenv('use_query_coalescing') == "True" and os.getenv('embedding_provider') == 'jina':
+        embeddings = CoalescingEmbeddings(
+            embeddings,
+            max_batch_size=int(os.getenv('query_coalescing_batch_size', '16')),
+            max_wait=float(os.getenv('query_coalescing_max_wait', '0.003'))
+        )
+
+    # Cache query and document embeddings in memory and on disk, shared by all workers
+    if os.getenv('use_embedding_cache') == "True":
+        embeddings = CachedEmbeddings(
+            embeddings,
+            model_name=os.getenv('embedding_model'),
+            store=EmbeddingStore(os.getenv('embedding_cache_path', 'rag/embedding_cache.sqlite')),
+            memory_size=int(os.getenv('embedding_cache_memory_size', '10000'))
+        )
 
     return embeddings
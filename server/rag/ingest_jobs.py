@@ -0,0 +1,131 @@
+import os
+import time
+import uuid
+import queue
+import logging
+import threading
+
+from .ingest_pipeline import split_files, make_text_splitter
+from .locks import file_lock
+
+logger = logging.getLogger(__name__)
+
+
+class IngestionJob:
+    def __init__(self, filenames, sync=False):
+        self.id = uuid.uuid4().hex
+        # A sync job finds its files (added or modified, deleted) by comparing the data directory to the manifest
+        self.sync = sync
+        self.filenames = filenames
+        self.deleted = []
+        self.status = "queued"
+        self.files_processed = 0
+        self.chunks_processed = 0
+        self.errors = []
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+
+    def to_dict(self):
+        elapsed = ((self.finished or time.time()) - self.started) if self.started else 0.0
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "sync": self.sync,
+            "files_total": len(self.filenames),
+            "files_deleted": len(self.deleted),
+            "files_processed": self.files_processed,
+            "chunks_processed": self.chunks_processed,
+            "files_per_second": self.files_processed / elapsed if elapsed > 0 else 0.0,
+            "chunks_per_second": self.chunks_processed / elapsed if elapsed > 0 else 0.0,
+            "errors": self.errors,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+
+class IngestionJobManager:
+    """
+    Runs bulk ingestion jobs one at a time on a background thread. Files are loaded and split in a pool of
+    processes (a bad file only fails itself) and added to the indexes in batches of batch_size files.
+    """
+
+    def __init__(self, raghelper, batch_size=8, processes=None):
+        self.raghelper = raghelper
+        self.batch_size = batch_size
+        self.processes = processes
+        self.jobs = {}
+        self.queue = queue.Queue()
+        self.worker = threading.Thread(target=self._work, name="ingest", daemon=True)
+        self.worker.start()
+
+    def submit(self, filenames):
+        job = IngestionJob(filenames)
+        self.jobs[job.id] = job
+        self.queue.put(job)
+        return job
+
+    def submit_sync(self):
+        job = IngestionJob([], sync=True)
+        self.jobs[job.id] = job
+        self.queue.put(job)
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            try:
+                self._run(job)
+            except Exception as e:
+                logger.exception(f"Ingestion job {job.id} failed")
+                job.errors.append({"file": None, "error": str(e)})
+                job.status = "failed"
+                job.finished = time.time()
+
+    def _add_batch(self, job, batch_files, batch_chunks):
+        if batch_files:
+            self.raghelper.add_file_chunks(batch_files, batch_chunks)
+        job.files_processed += len(batch_files)
+        job.chunks_processed += len(batch_chunks)
+
+    def _run(self, job):
+        job.status = "running"
+        job.started = time.time()
+        if job.sync:
+            # Only one worker syncs at a time, the others find nothing left to do. Not the lock of the indexes,
+            # that one is only taken to publish each batch, so workers starting up don't wait for the embedding.
+            with file_lock(f"{self.raghelper.lock_path}.sync"):
+                (job.filenames, job.deleted) = self.raghelper.diff_files()
+                self.raghelper.remove_files(job.deleted)
+                self._ingest(job)
+        else:
+            self._ingest(job)
+        job.status = "done"
+        job.finished = time.time()
+        logger.info(f"Ingestion job {job.id} done: {job.to_dict()}")
+
+    def _ingest(self, job):
+        # SemanticChunker calls the embedding model, it stays in this process
+        text_splitter = None
+        if os.getenv('splitter') == 'SemanticChunker':
+            text_splitter = make_text_splitter(self.raghelper.embeddings)
+
+        batch_files = []
+        batch_chunks = []
+        for filename, chunks, error in split_files(job.filenames, processes=self.processes,
+                                                   text_splitter=text_splitter):
+            if error is not None:
+                logger.warning(f"Could not ingest {filename}: {error}")
+                job.errors.append({"file": filename, "error": str(error)})
+                continue
+            batch_files.append(filename)
+            batch_chunks.extend(chunks)
+            if len(batch_files) >= self.batch_size:
+                self._add_batch(job, batch_files, batch_chunks)
+                batch_files = []
+                batch_chunks = []
+        self._add_batch(job, batch_files, batch_chunks)
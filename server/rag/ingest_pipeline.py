@@ -0,0 +1,244 @@
+"""
+Streaming ingestion: discover files -> load and split them in a process pool -> hash and dedupe -> write.
+
+Every stage is a generator, at most a bounded number of files is in flight so memory does not depend on the
+size of the corpus, and loading/splitting (UnstructuredMarkdownLoader in particular) scales with the cores.
+"""
+import os
+import re
+import time
+import hashlib
+import logging
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from langchain_core.documents.base import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from langchain_experimental.text_splitter import SemanticChunker
+
+from langchain_community.document_loaders import PyPDFLoader
+from langchain_community.document_loaders import JSONLoader
+from langchain_community.document_loaders import TextLoader
+from langchain_community.document_loaders import Docx2txtLoader
+from langchain_community.document_loaders import UnstructuredExcelLoader
+from langchain_community.document_loaders import UnstructuredPowerPointLoader
+from langchain_community.document_loaders import UnstructuredMarkdownLoader
+from langchain_community.document_loaders.csv_loader import CSVLoader
+
+from lxml import etree
+
+from .section_splitter import MarkdownSectionSplitter
+from .manifest import normalize_source
+
+logger = logging.getLogger(__name__)
+
+
+def extract_source(filename):
+    # 移除路徑和文件擴展名
+    base_name = filename.split("\\")[-1].replace('.md', '')
+
+    # 使用正則表達式分割文件名
+    parts = re.split(r'[\-]', base_name)
+
+    # 過濾掉空字符串
+    parts = [part.strip()[:30] for part in parts if part.strip()]
+    return " ".join(parts)
+
+
+def load_file(filename):
+    extension = filename.lower().rsplit(".", 1)[-1]
+    if extension == "pdf":
+        return PyPDFLoader(filename).load()
+    if extension == "json":
+        return JSONLoader(
+            file_path=filename,
+            jq_schema=os.getenv("json_schema"),
+            text_content=os.getenv("json_text_content", "True").lower() != "false",
+        ).load()
+    if extension == "txt":
+        return TextLoader(filename).load()
+    if extension == "csv":
+        return CSVLoader(filename).load()
+    if extension == "docx":
+        return Docx2txtLoader(filename).load()
+    if extension == "xlsx":
+        return UnstructuredExcelLoader(filename).load()
+    if extension == "md":
+        if os.getenv('splitter') == 'MarkdownSectionSplitter':
+            # The section splitter needs the headers
+            return TextLoader(filename, encoding="utf-8").load()
+        return UnstructuredMarkdownLoader(filename).load()
+    if extension == "pptx":
+        return UnstructuredPowerPointLoader(filename).load()
+    if extension == "xml":
+        # Load XML, which is nasty
+        docs = []
+        for doc in TextLoader(filename).load():
+            xmltree = etree.fromstring(doc.page_content.encode('utf-8'))
+            elements = xmltree.xpath(os.getenv("xml_xpath"))
+            elements = [etree.tostring(element, pretty_print=True).decode() for element in elements]
+            docs = docs + [Document(page_content=element, metadata=doc.metadata) for element in elements]
+        return docs
+    raise ValueError(f"Unsupported file type: {filename}")
+
+
+def make_text_splitter(embeddings=None):
+    if os.getenv('splitter') == 'SemanticChunker':
+        breakpoint_threshold_amount = None
+        number_of_chunks = None
+        if os.getenv('breakpoint_threshold_amount') != 'None':
+            breakpoint_threshold_amount = float(os.getenv('breakpoint_threshold_amount'))
+        if os.getenv('number_of_chunks') != 'None':
+            number_of_chunks = int(os.getenv('number_of_chunks'))
+        return SemanticChunker(
+            embeddings,
+            breakpoint_threshold_type=os.getenv('breakpoint_threshold_type'),
+            breakpoint_threshold_amount=breakpoint_threshold_amount,
+            number_of_chunks=number_of_chunks
+        )
+    if os.getenv('splitter') == 'MarkdownSectionSplitter':
+        return MarkdownSectionSplitter(chunk_size=int(os.getenv('chunk_size')),
+                                       chunk_overlap=int(os.getenv('chunk_overlap')))
+    if os.getenv("use_blank_line_as_separator") == "True":
+        return RecursiveCharacterTextSplitter(
+            chunk_size=int(os.getenv('chunk_size')),
+            chunk_overlap=int(os.getenv('chunk_overlap')),
+            length_function=len,
+            keep_separator=True,
+            separators=[
+                r'\n\s*\n',
+                r"\n \n",
+                r"\n\n",
+                r"\n",
+                r" ",
+            ],
+            is_separator_regex=True
+        )
+    return RecursiveCharacterTextSplitter(
+        chunk_size=int(os.getenv('chunk_size')),
+        chunk_overlap=int(os.getenv('chunk_overlap')),
+        length_function=len,
+        keep_separator=True,
+        separators=[
+            "\n \n",
+            "\n\n",
+            "\n",
+            ".",
+            "!",
+            "?",
+            " ",
+            ",",
+            "\u200b",  # Zero-width space
+            "\uff0c",  # Fullwidth comma
+            "\u3001",  # Ideographic comma
+            "\uff0e",  # Fullwidth full stop
+            "\u3002",  # Ideographic full stop
+            "",
+        ],
+    )
+
+
+def prepare_chunks(text_splitter, docs):
+    # Split documents into chunks, add the source to the content and use the hash of the resulting
+    # content as the chunk ID, so the same chunk always maps to the same vector store entry
+    chunks = []
+    for doc in text_splitter.split_documents(docs):
+        page_content = extract_source(doc.metadata['source']) + doc.page_content
+        chunks.append(Document(page_content=page_content,
+                               metadata={**doc.metadata, 'id': hashlib.md5(page_content.encode()).hexdigest()}))
+    return chunks
+
+
+def discover_files(data_dir, file_types):
+    """
+    Yields the paths of the files under data_dir with one of the file types, recursively and in a stable order,
+    in the form chunk sources and the manifest use (normalize_source).
+    """
+    extensions = {f".{file_type.strip().lower()}" for file_type in file_types}
+    for root, dirs, files in os.walk(data_dir):
+        dirs.sort()
+        for name in sorted(files):
+            if os.path.splitext(name)[1].lower() in extensions:
+                yield normalize_source(os.path.join(root, name))
+
+
+# Each worker process builds its splitter once
+_text_splitter = None
+
+
+def load_and_split(filename):
+    global _text_splitter
+    if _text_splitter is None:
+        _text_splitter = make_text_splitter()
+    return prepare_chunks(_text_splitter, load_file(filename))
+
+
+def split_files(filenames, processes=None, text_splitter=None):
+    """
+    Yields (filename, chunks, error) per file, in completion order. Files are loaded and split by a pool of
+    processes with at most 2 files per process in flight. With a text_splitter (needed for SemanticChunker,
+    which calls the embedding model) or processes=0 everything runs in this process instead.
+    """
+    if text_splitter is not None or processes == 0:
+        text_splitter = text_splitter or make_text_splitter()
+        for filename in filenames:
+            try:
+                yield filename, prepare_chunks(text_splitter, load_file(filename)), None
+            except Exception as e:
+                yield filename, [], e
+        return
+
+    processes = processes or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        pending = {}
+        remaining = iter(filenames)
+        while True:
+            for filename in remaining:
+                pending[pool.submit(load_and_split, filename)] = filename
+                if len(pending) >= processes * 2:
+                    break
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                filename = pending.pop(future)
+                try:
+                    yield filename, future.result(), None
+                except Exception as e:
+                    yield filename, [], e
+
+
+def dedupe(chunks, seen):
+    """Drops chunks whose id (content hash) is in seen, adding the others."""
+    unique = []
+    for doc in chunks:
+        if doc.metadata['id'] not in seen:
+            seen.add(doc.metadata['id'])
+            unique.append(doc)
+    return unique
+
+
+def iter_chunk_batches(filenames, batch_size=1000, processes=None, text_splitter=None, loaded=None):
+    """
+    Yields batches of about batch_size unique chunks for the files, files that fail are logged and skipped.
+    The files that were loaded are appended to the loaded list, if given.
+    """
+    seen = set()
+    batch = []
+    n_files = 0
+    start = time.perf_counter()
+    for filename, chunks, error in split_files(filenames, processes=processes, text_splitter=text_splitter):
+        if error is not None:
+            logger.warning(f"Could not load {filename}: {error}")
+            continue
+        n_files += 1
+        if loaded is not None:
+            loaded.append(filename)
+        batch.extend(dedupe(chunks, seen))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+    elapsed = time.perf_counter() - start
+    logger.info(f"Loaded and split {n_files} files into {len(seen)} unique chunks in {elapsed:.1f}s "
+                f"({n_files / elapsed if elapsed > 0 else 0.0:.1f} files/s)")
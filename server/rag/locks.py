@@ -0,0 +1,26 @@
+import os
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+@contextmanager
+def file_lock(path):
+    """
+    Exclusive lock shared by all processes using the same path, so only one uvicorn worker builds the
+    indexes while the others wait and then map the result. Without fcntl (Windows) this does not lock.
+    """
+    if fcntl is None:
+        yield
+        return
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
@@ -0,0 +1,39 @@
+import os
+import hashlib
+import posixpath
+
+
+def normalize_source(path):
+    """
+    The form file paths are recorded in (chunk sources, manifest, drugs): normalized with / as separator, so
+    paths recorded on Windows (rag\\data\\x.md) match the same file found on any OS.
+    """
+    return posixpath.normpath(path.replace("\\", "/"))
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_entry(path, previous=None):
+    """(size, mtime, hash) of a file, the hash is only computed again when size or mtime changed."""
+    stat = os.stat(path)
+    if previous is not None and previous[0] == stat.st_size and previous[1] == stat.st_mtime:
+        return previous
+    return (stat.st_size, stat.st_mtime, file_hash(path))
+
+
+def scan_files(filenames, previous):
+    return {filename: file_entry(filename, previous.get(filename)) for filename in filenames}
+
+
+def diff_manifest(previous, current):
+    """Returns the added, modified (different content hash) and deleted paths."""
+    added = [path for path in current if path not in previous]
+    modified = [path for path in current if path in previous and current[path][2] != previous[path][2]]
+    deleted = [path for path in previous if path not in current]
+    return added, modified, deleted
@@ -0,0 +1,119 @@
+"""
+CPU inference with ONNX Runtime for the transformer models we run locally.
+
+A model is exported to ONNX once (with optimum, which needs torch) and its weights are quantized to int8,
+both are kept in onnx_model_dir and later starts only need onnxruntime and the tokenizer. A directory that
+already has a model.onnx (and its tokenizer) can be used as model name directly.
+
+onnxruntime, transformers and, for exporting, optimum[onnxruntime] are optional dependencies.
+"""
+import os
+import re
+from typing import List, Tuple
+
+import numpy as np
+
+from langchain_core.embeddings import Embeddings
+from langchain.retrievers.document_compressors.cross_encoder import BaseCrossEncoder
+
+from .batching import MicroBatcher
+
+
+def onnx_model_path(model_name, task, quantize=True):
+    """Path of the (quantized) ONNX file for a Hugging Face model, exporting and quantizing it if needed."""
+    if os.path.isfile(os.path.join(model_name, "model.onnx")):
+        directory = model_name
+    else:
+        directory = os.path.join(os.getenv("onnx_model_dir", "rag/onnx"), re.sub(r"[^\w.-]", "_", model_name))
+        if not os.path.isfile(os.path.join(directory, "model.onnx")):
+            from optimum.exporters.onnx import main_export
+            main_export(model_name, output=directory, task=task)
+
+    path = os.path.join(directory, "model.onnx")
+    if quantize:
+        quantized = os.path.join(directory, "model_int8.onnx")
+        if not os.path.isfile(quantized):
+            # Dynamic quantization, int8 weights and activations quantized on the fly, no calibration data needed
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+            quantize_dynamic(path, quantized + ".tmp", weight_type=QuantType.QInt8)
+            os.replace(quantized + ".tmp", quantized)
+        path = quantized
+    return path
+
+
+def load_session(path, threads=None):
+    import onnxruntime as ort
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if threads:
+        options.intra_op_num_threads = threads
+    return ort.InferenceSession(path, sess_options=options, providers=["CPUExecutionProvider"])
+
+
+def load_tokenizer(path):
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(os.path.dirname(path))
+
+
+def run(session, tokenizer, *texts, max_length=512):
+    """Tokenizes one batch (of texts or of pairs) and returns the first output of the model."""
+    encoded = tokenizer(*texts, padding=True, truncation=True, max_length=max_length, return_tensors="np")
+    inputs = {i.name: encoded[i.name].astype(np.int64) for i in session.get_inputs() if i.name in encoded}
+    return session.run(None, inputs)[0], encoded
+
+
+class OnnxCrossEncoder(BaseCrossEncoder):
+    """Cross-encoder on ONNX Runtime, scores like HuggingFaceCrossEncoder (sentence-transformers' CrossEncoder)."""
+
+    def __init__(self, model_name, quantize=True, threads=None, max_length=512):
+        path = onnx_model_path(model_name, "text-classification", quantize=quantize)
+        self.session = load_session(path, threads=threads)
+        self.tokenizer = load_tokenizer(path)
+        self.max_length = max_length
+
+    def score(self, text_pairs: List[Tuple[str, str]]) -> List[float]:
+        if not text_pairs:
+            return []
+        (logits, _) = run(self.session, self.tokenizer, [query for query, _ in text_pairs],
+                          [text for _, text in text_pairs], max_length=self.max_length)
+        if logits.shape[1] == 1:
+            # Single relevance logit, sentence-transformers applies a sigmoid
+            return (1 / (1 + np.exp(-logits[:, 0]))).tolist()
+        # (not relevant, relevant) models like bert-multilingual-passage-reranking-msmarco
+        return logits[:, 1].tolist()
+
+
+class OnnxEmbeddings(Embeddings):
+    """
+    Sentence embeddings on ONNX Runtime (mean pooled and normalized, like sentence-transformers), for
+    deployments without an embedding service. Texts of concurrent calls are batched dynamically, up to
+    max_batch_size texts or max_wait seconds. E5 style models want prefixes like "query: " and "passage: ".
+    """
+
+    def __init__(self, model_name, quantize=True, threads=None, max_length=512, max_batch_size=32,
+                 max_wait=0.005, query_prefix="", document_prefix=""):
+        path = onnx_model_path(model_name, "feature-extraction", quantize=quantize)
+        self.session = load_session(path, threads=threads)
+        self.tokenizer = load_tokenizer(path)
+        self.max_length = max_length
+        self.query_prefix = query_prefix
+        self.document_prefix = document_prefix
+        self.batcher = MicroBatcher(self.encode, max_batch_size=max_batch_size, max_wait=max_wait,
+                                    name="onnx-embeddings")
+
+    def encode(self, texts):
+        (hidden, encoded) = run(self.session, self.tokenizer, texts, max_length=self.max_length)
+        # Mean over the tokens that are not padding
+        mask = encoded["attention_mask"][..., None].astype(np.float32)
+        vectors = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        return vectors.tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.batcher.map([self.document_prefix + text for text in texts])
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.batcher.map([self.query_prefix + text])[0]
+
+    def stats(self):
+        return {"batcher": self.batcher.stats()}
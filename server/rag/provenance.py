@@ -1,7 +1,13 @@
 import os
 import re
+import threading
+from collections import OrderedDict
+
 import numpy as np
 
+from .ScoredCrossEncoderReranker import ScoredCrossEncoderReranker, chunk_id
+from .embedding_cache import uncached
+
 from langchain.prompts import ChatPromptTemplate
 
 # This is a clever little function that attempts to compute the attribution of each document retrieved from the RAG store towards the generated answer.
@@ -15,15 +21,119 @@ from langchain.prompts import ChatPromptTemplate
 #
 # This is by no means a foolproof way to attribute towards each of the documents properly but it is _a_ way.
 
+def include_query():
+    # The .env templates call it provenance_include_query
+    return os.getenv("attribute_include_query", os.getenv("provenance_include_query")) == "True"
+
+
+def provenance_query(query, answer):
+    if include_query():
+        return query + "\n" + answer
+    return answer
+
+
 def compute_rerank_provenance(reranker, query, documents, answer):
-    if os.getenv("attribute_include_query") == "True":
-        full_text = query + "\n" + answer
-    else:
-        full_text = answer
+    full_text = provenance_query(query, answer)
 
     # Score the documents, this will return the same document list but now with a relevance_score in metadata
     scored_documents = reranker.compress_documents(documents, full_text)
     return scored_documents
+
+
+# Provenance scores for a batch of (query, documents, answer) requests, per request a list of scores in the order
+# of its documents. A cross-encoder reranker scores the pairs of all requests together, other rerankers (flashrank)
+# one request at a time with the scores matched back by chunk id.
+def compute_rerank_provenance_batch(reranker, requests):
+    if isinstance(reranker, ScoredCrossEncoderReranker):
+        pairs = [(provenance_query(query, answer), doc) for (query, documents, answer) in requests for doc in documents]
+        scores = iter(reranker.score_pairs(pairs))
+        return [[next(scores) for _ in documents] for (_, documents, _) in requests]
+
+    results = []
+    for (query, documents, answer) in requests:
+        scored = {chunk_id(doc): float(doc.metadata['relevance_score'])
+                  for doc in compute_rerank_provenance(reranker, query, documents, answer)}
+        results.append([scored.get(chunk_id(doc)) for doc in documents])
+    return results
+
+
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.where(norms > 0, norms, 1.0)
+
+
+class VectorSimilarityAttribution:
+    """
+    Similarity based provenance on the chunk vectors already in the vector store, only the answers (and with
+    include_query the queries, which the embedding cache usually has) are embedded. Chunk vectors are kept in
+    an LRU keyed by chunk id, chunks missing from the vector store are embedded like they would be on ingest.
+    """
+
+    def __init__(self, embeddings, collection, memory_size=10000):
+        self.embeddings = embeddings
+        # Every answer is new, keeping their vectors would only fill the embedding cache
+        self.answer_embeddings = uncached(embeddings)
+        self.collection = collection
+        self.memory_size = memory_size
+        self.vectors = OrderedDict()
+        self.lock = threading.Lock()
+
+    def chunk_vectors(self, documents):
+        """Normalized vectors of the documents, one row per document."""
+        by_id = {chunk_id(doc): doc for doc in documents}
+        found = {}
+        with self.lock:
+            for doc_id in by_id:
+                if doc_id in self.vectors:
+                    self.vectors.move_to_end(doc_id)
+                    found[doc_id] = self.vectors[doc_id]
+
+        missing = [doc_id for doc_id in by_id if doc_id not in found]
+        if missing:
+            stored = self.collection.get(ids=missing, include=["embeddings"])
+            for doc_id, vector in zip(stored["ids"], stored["embeddings"]):
+                found[doc_id] = vector
+            missing = [doc_id for doc_id in missing if doc_id not in found]
+        if missing:
+            found.update(zip(missing, self.embeddings.embed_documents([by_id[doc_id].page_content
+                                                                       for doc_id in missing])))
+
+        with self.lock:
+            for doc_id in by_id:
+                found[doc_id] = normalize_rows(np.asarray(found[doc_id], dtype=np.float32))
+                self.vectors[doc_id] = found[doc_id]
+                self.vectors.move_to_end(doc_id)
+            while len(self.vectors) > self.memory_size:
+                self.vectors.popitem(last=False)
+        return np.stack([found[chunk_id(doc)] for doc in documents])
+
+    def compute_similarity_batch(self, requests):
+        """Scores per (query, documents, answer) request in the order of its documents, summing to 1."""
+        if not any(documents for (_, documents, _) in requests):
+            return [[] for _ in requests]
+        answers = normalize_rows(np.asarray(
+            self.answer_embeddings.embed_documents([answer for (_, _, answer) in requests]), dtype=np.float32
+        ))
+        if include_query():
+            queries = normalize_rows(np.asarray([self.embeddings.embed_query(query) for (query, _, _) in requests],
+                                                dtype=np.float32))
+            # Average of the similarities to the answer and to the query
+            answers = (answers + queries) / 2
+
+        # One product for the whole batch: every document against the answer of its request
+        matrix = self.chunk_vectors([doc for (_, documents, _) in requests for doc in documents])
+        owners = np.repeat(np.arange(len(requests)), [len(documents) for (_, documents, _) in requests])
+        similarities = np.einsum("ij,ij->i", matrix, answers[owners])
+
+        results = []
+        start = 0
+        for (_, documents, _) in requests:
+            # A negative similarity means no attribution at all
+            scores = np.clip(similarities[start:start + len(documents)], 0.0, None)
+            start += len(documents)
+            total = scores.sum()
+            results.append((scores / total if total > 0 else scores).tolist())
+        return results
 """
 import torch
 from sentence_transformers import SentenceTransformer
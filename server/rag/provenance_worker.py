@@ -0,0 +1,213 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import queue
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+
+from .ScoredCrossEncoderReranker import chunk_id
+
+logger = logging.getLogger(__name__)
+
+
+class ProvenanceJob:
+    def __init__(self, query, docs, answer):
+        self.id = uuid.uuid4().hex
+        self.query = query
+        self.docs = docs
+        self.answer = answer
+        self.ids = [chunk_id(doc) for doc in docs]
+        self.status = "queued"
+        # chunk id -> provenance score
+        self.scores = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self.done = threading.Event()
+        self.waiters = []
+
+    def to_dict(self):
+        return {
+            "provenance_id": self.id,
+            "status": self.status,
+            "documents": [{"id": doc_id, "provenance": self.scores.get(doc_id)} for doc_id in self.ids]
+            if self.scores is not None else [],
+            "error": self.error,
+            "created": self.created,
+            "finished": self.finished,
+        }
+
+
+class ProvenanceStore:
+    """Finished provenance jobs keyed by provenance id, backed by SQLite so all workers can serve them."""
+
+    def __init__(self, path, ttl=86400):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS provenance (id TEXT PRIMARY KEY, finished REAL NOT NULL, result TEXT NOT NULL)"
+        )
+        self.conn.commit()
+
+    def get(self, job_id):
+        with self.lock:
+            row = self.conn.execute("SELECT result FROM provenance WHERE id = ?", [job_id]).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def put_many(self, results):
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO provenance (id, finished, result) VALUES (?, ?, ?)",
+                [(result["provenance_id"], result["finished"], json.dumps(result)) for result in results]
+            )
+            # Results older than ttl seconds are not fetched anymore
+            self.conn.execute("DELETE FROM provenance WHERE finished < ?", [time.time() - self.ttl])
+            self.conn.commit()
+
+
+class ProvenanceWorker:
+    """
+    Scores provenance off the request path. Jobs are collected on a background thread until they have
+    batch_size documents between them or max_wait seconds have passed and then scored in one call of
+    score_batch, which takes a list of (query, docs, answer) and returns the scores per job in the order of
+    its docs. Scores are keyed by chunk id and also set as metadata['provenance'] on the docs of the job.
+    The last max_jobs jobs can be looked up by id, finished jobs are also written to the store (if any),
+    where the other workers find them.
+    """
+
+    def __init__(self, score_batch, batch_size=64, max_wait=0.02, max_jobs=10000, store=None):
+        self.score_batch = score_batch
+        self.store = store
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.max_jobs = max_jobs
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.jobs_scored = 0
+        self.jobs_failed = 0
+        self.batches = 0
+        self.worker = threading.Thread(target=self._work, name="provenance", daemon=True)
+        self.worker.start()
+
+    def submit(self, query, docs, answer):
+        job = ProvenanceJob(query, docs, answer)
+        with self.lock:
+            self.jobs[job.id] = job
+            while len(self.jobs) > self.max_jobs:
+                self.jobs.popitem(last=False)
+        self.queue.put(job)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    async def wait(self, job):
+        """Waits until the job is scored (or failed) without blocking the event loop."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self.lock:
+            if job.done.is_set():
+                return job
+            job.waiters.append((loop, future))
+        await future
+        return job
+
+    async def fetch(self, job_id, wait=0):
+        """Result (to_dict) of a job, waiting up to wait seconds for it to finish, None when it is unknown."""
+        job = self.get(job_id)
+        if job is not None:
+            if wait > 0:
+                try:
+                    await asyncio.wait_for(self.wait(job), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+            return job.to_dict()
+        # Submitted to another worker, it is in the store once it is finished
+        deadline = time.monotonic() + wait
+        while self.store is not None:
+            result = self.store.get(job_id)
+            if result is not None or time.monotonic() >= deadline:
+                return result
+            await asyncio.sleep(0.1)
+        return None
+
+    def _work(self):
+        while True:
+            jobs = [self.queue.get()]
+            n_docs = len(jobs[0].docs)
+            # Wait a little for more jobs, so they are scored in one batch
+            deadline = time.monotonic() + self.max_wait
+            while n_docs < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    jobs.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+                n_docs += len(jobs[-1].docs)
+            self._score(jobs)
+
+    def _score(self, jobs):
+        for job in jobs:
+            job.status = "running"
+        try:
+            results = self.score_batch([(job.query, job.docs, job.answer) for job in jobs])
+            for job, scores in zip(jobs, results):
+                job.scores = dict(zip(job.ids, scores))
+                for doc in job.docs:
+                    if job.scores.get(chunk_id(doc)) is not None:
+                        doc.metadata['provenance'] = job.scores[chunk_id(doc)]
+                job.status = "done"
+        except Exception as e:
+            logger.exception(f"Provenance scoring of {len(jobs)} jobs failed")
+            for job in jobs:
+                job.status = "failed"
+                job.error = str(e)
+
+        with self.lock:
+            self.batches += 1
+            for job in jobs:
+                if job.status == "done":
+                    self.jobs_scored += 1
+                else:
+                    self.jobs_failed += 1
+                job.finished = time.time()
+                # The scores are kept, the inputs are not needed anymore
+                (job.query, job.docs, job.answer) = (None, [], None)
+                job.done.set()
+                for (loop, future) in job.waiters:
+                    loop.call_soon_threadsafe(_resolve, future, job)
+                job.waiters = []
+
+        if self.store is not None:
+            try:
+                self.store.put_many([job.to_dict() for job in jobs])
+            except Exception:
+                logger.exception(f"Storing the provenance of {len(jobs)} jobs failed")
+
+    def stats(self):
+        with self.lock:
+            return {
+                "pending": self.queue.qsize(),
+                "jobs_scored": self.jobs_scored,
+                "jobs_failed": self.jobs_failed,
+                "batches": self.batches,
+                "jobs_per_batch": (self.jobs_scored + self.jobs_failed) / self.batches if self.batches else 0.0,
+            }
+
+
+def _resolve(future, job):
+    # The waiter may have been cancelled (timeout) in the meantime
+    if not future.done():
+        future.set_result(job)
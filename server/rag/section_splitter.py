@@ -0,0 +1,114 @@
+import re
+
+from langchain_core.documents.base import Document
+
+# "## 3 用法及用量" -> "用法及用量", the numbers differ between label versions, the titles do not
+NUMBERED_HEADER = re.compile(r"^##\s+\d+(?:\.\d+)*\s*(.*)$")
+HEADER = re.compile(r"^(#{1,2})\s+(.*)$")
+
+
+def section_title(line):
+    match = NUMBERED_HEADER.match(line)
+    if match:
+        return match.group(1).strip(), True
+    match = HEADER.match(line)
+    return match.group(2).strip(), False
+
+
+class MarkdownSectionSplitter:
+    """
+    Single pass splitter for the drug label markdown written by e_to_md.py. Every "## N title" header and every
+    "# title" header starts a section, unnumbered "##" headers under a "#" header (中文品名, 英文品名, 許可證號, ...)
+    stay in that section. Sections are packed into chunks of whole lines up to chunk_size characters, each
+    chunk starts with the section title and has it in metadata['section'] and its offset in metadata['start_index'].
+
+    Needs the raw markdown, UnstructuredMarkdownLoader drops the headers.
+    """
+
+    def __init__(self, chunk_size=1000, chunk_overlap=100):
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+
+    def split_documents(self, docs):
+        chunks = []
+        for doc in docs:
+            for (section, start_index, text) in self.split_text(doc.page_content):
+                metadata = {**doc.metadata, "start_index": start_index}
+                if section is not None:
+                    metadata["section"] = section
+                chunks.append(Document(page_content=text, metadata=metadata))
+        return chunks
+
+    def split_text(self, text):
+        """Yields (section, offset, text) per chunk."""
+        section = None
+        section_is_h1 = False
+        lines = []
+        offset = 0
+        for line in text.splitlines(keepends=True):
+            stripped = line.strip()
+            if stripped.startswith("#") and HEADER.match(stripped):
+                (title, numbered) = section_title(stripped)
+                is_h1 = stripped.startswith("# ")
+                if is_h1 or numbered or not section_is_h1:
+                    yield from self.pack(section, lines)
+                    (section, section_is_h1, lines) = (title, is_h1, [])
+                else:
+                    # e.g. "## 中文品名" under "# 藥品資訊", kept as a line of text
+                    lines.append((offset, title + "\n"))
+            elif stripped:
+                lines.append((offset, line))
+            offset += len(line)
+        yield from self.pack(section, lines)
+
+    def pack(self, section, lines):
+        if not lines:
+            return
+        prefix = f"{section}\n" if section else ""
+        budget = max(self.chunk_size - len(prefix), 1)
+        pieces = []
+        for (offset, line) in lines:
+            # Lines longer than a chunk are cut, with overlap
+            step = max(budget - self.chunk_overlap, 1)
+            for start in range(0, len(line), step if len(line) > budget else len(line)):
+                pieces.append((offset + start, line[start:start + budget]))
+
+        chunk = []
+        length = 0
+        for piece in pieces:
+            if chunk and length + len(piece[1]) > budget:
+                yield section, chunk[0][0], prefix + "".join(text for _, text in chunk).strip()
+                # Carry the trailing lines that fit in the overlap over to the next chunk
+                overlap = []
+                overlap_length = 0
+                for previous in reversed(chunk):
+                    if overlap_length + len(previous[1]) > self.chunk_overlap:
+                        break
+                    overlap.insert(0, previous)
+                    overlap_length += len(previous[1])
+                (chunk, length) = (overlap, overlap_length)
+            chunk.append(piece)
+            length += len(piece[1])
+        if chunk:
+            yield section, chunk[0][0], prefix + "".join(text for _, text in chunk).strip()
+
+
+# Label sections a question is likely about, by keywords in the question
+SECTION_KEYWORDS = {
+    "用法及用量": ["用法", "用量", "劑量", "怎麼吃", "怎麼用", "如何服用", "服用方式", "一天幾次", "吃幾顆", "dose", "dosage"],
+    "副作用/不良反應": ["副作用", "不良反應", "side effect"],
+    "禁忌": ["禁忌", "不能使用", "不可使用", "不能吃"],
+    "交互作用": ["交互作用", "併用", "一起吃", "一起服用", "interaction"],
+    "適應症": ["適應症", "治療什麼", "治什麼", "用途", "功效"],
+    "警語及注意事項": ["警語", "注意事項", "警告"],
+    "特殊族群注意事項": ["懷孕", "孕婦", "哺乳", "餵奶", "兒童", "老年"],
+    "過量": ["過量", "吃太多"],
+    "包裝及儲存": ["儲存", "保存", "包裝"],
+    "藥品資訊": ["許可證", "劑型", "有效日期", "藥品類別", "英文品名"],
+}
+
+
+def detect_sections(query):
+    query = query.lower()
+    return {section for section, keywords in SECTION_KEYWORDS.items()
+            if any(keyword in query for keyword in keywords)}
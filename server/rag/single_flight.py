@@ -0,0 +1,105 @@
+import asyncio
+import hashlib
+import contextvars
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+# LLM calls made by the flight the current task belongs to
+flight_llm_calls = contextvars.ContextVar("flight_llm_calls", default=None)
+
+
+class LLMCallCounter(BaseCallbackHandler):
+    """Counts the LLM calls made inside a flight, attached to the LLM of the RAG helper."""
+
+    run_inline = True
+
+    def _count(self):
+        calls = flight_llm_calls.get()
+        if calls is not None:
+            calls[0] += 1
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        self._count()
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        self._count()
+
+
+def config_fingerprint(keys, environ):
+    """Hash of the configuration that shapes an answer, so differently configured answers are never shared."""
+    return hashlib.sha256("\0".join(f"{key}={environ.get(key)}" for key in keys).encode("utf-8")).hexdigest()
+
+
+class Flight:
+    def __init__(self):
+        self.task = None
+        self.waiters = 0
+        self.followers = 0
+        # Mutable, the callbacks of the flight's LLM calls increment it
+        self.llm_calls = [0]
+
+
+class SingleFlight:
+    """
+    Concurrent identical requests share one computation: the first caller of a key starts it, callers arriving
+    while it runs wait for the same result. Nothing is kept once it finishes (that is the answer cache's job).
+    The computation only gets cancelled when every caller waiting for it has given up.
+    """
+
+    def __init__(self):
+        self.flights = {}
+        self.leaders = 0
+        self.followers = 0
+        self.llm_calls_saved = 0
+
+    def join(self, key):
+        """Awaitable for the result of the computation running for key, None when there is none."""
+        flight = self.flights.get(key)
+        if flight is None:
+            return None
+        flight.followers += 1
+        self.followers += 1
+        flight.waiters += 1
+        return self._wait(flight)
+
+    async def run(self, key, factory):
+        """Result of factory() for key, shared with the callers of the same key while it runs."""
+        joined = self.join(key)
+        if joined is not None:
+            return await joined
+
+        flight = Flight()
+        # The task copies the context it is created in, it gets its own LLM call counter
+        context = contextvars.copy_context()
+        context.run(flight_llm_calls.set, flight.llm_calls)
+        flight.task = context.run(asyncio.ensure_future, factory())
+        self.flights[key] = flight
+        flight.task.add_done_callback(lambda _: self._land(key, flight))
+        self.leaders += 1
+        flight.waiters += 1
+        return await self._wait(flight)
+
+    async def _wait(self, flight):
+        # The waiter was counted when it joined
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                # Nobody is waiting anymore
+                flight.task.cancel()
+
+    def _land(self, key, flight):
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+        if not flight.task.cancelled() and flight.task.exception() is None:
+            self.llm_calls_saved += flight.followers * flight.llm_calls[0]
+
+    def stats(self):
+        return {
+            "in_flight": len(self.flights),
+            "computations": self.leaders,
+            "shared": self.followers,
+            "llm_calls_saved": self.llm_calls_saved,
+        }
+
@@ -0,0 +1,325 @@
+import os
+import re
+import json
+import shutil
+import hashlib
+import unicodedata
+from collections import Counter
+import threading
+from typing import Any, List
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+
+def whitespace_tokenize(text):
+    # Same as BM25Retriever's default preprocessing
+    return text.split()
+
+
+# Runs of CJK ideographs, or latin words / numbers like license numbers and English product names
+CJK_TOKEN_PATTERN = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+|[a-z0-9]+(?:[.\-][a-z0-9]+)*")
+
+
+def cjk_tokenize(text):
+    # Whitespace is rare in Chinese label text, so index ideographs as unigrams plus bigrams instead
+    tokens = []
+    for match in CJK_TOKEN_PATTERN.finditer(unicodedata.normalize("NFKC", text).lower()):
+        token = match.group()
+        if token[0].isascii():
+            tokens.append(token)
+        else:
+            tokens.extend(token)
+            tokens.extend(token[i:i + 2] for i in range(len(token) - 1))
+    return tokens
+
+
+def jieba_tokenize(text):
+    # Dictionary based word segmentation, jieba is an optional dependency
+    import jieba
+    return [token for token in jieba.lcut_for_search(unicodedata.normalize("NFKC", text).lower()) if token.strip()]
+
+
+TOKENIZERS = {
+    "whitespace": whitespace_tokenize,
+    "cjk": cjk_tokenize,
+    "jieba": jieba_tokenize,
+}
+
+
+def corpus_fingerprint(ids):
+    return hashlib.md5("\n".join(ids).encode()).hexdigest()
+
+
+class SparseIndex:
+    """
+    BM25 inverted index kept in flat numpy arrays so it can be saved once and memory-mapped by every worker:
+
+    - term_bytes/term_offsets: sorted vocabulary as concatenated utf-8, binary searched to find a term id
+    - indptr: postings of term i are doc_ids[indptr[i]:indptr[i + 1]] and weights[indptr[i]:indptr[i + 1]]
+    - weights: the BM25 term frequency component tf * (k1 + 1) / (tf + k1 * (1 - b + b * dl / avgdl))
+    - doc_lengths: number of tokens per document
+
+    Together indptr, doc_ids and weights form a terms x documents CSR matrix, a query is scored as the
+    product of the rows of its terms with the vector of their idf values.
+
+    Documents added later go into a small in-memory delta segment with the same layout per term, so
+    appending does not touch the (immutable, memory-mapped) base. Document ids of the delta continue
+    after the base, idf uses the document frequencies of both. Deleted documents are tombstones that are
+    left out of the results, their postings stay until the index is rebuilt.
+    """
+
+    FILES = ["term_bytes", "term_offsets", "indptr", "doc_ids", "weights", "doc_lengths"]
+
+    def __init__(self, term_bytes, term_offsets, indptr, doc_ids, weights, doc_lengths, tokenizer="whitespace",
+                 fingerprint=None, k1=1.5, b=0.75):
+        self.term_bytes = term_bytes
+        self.term_offsets = term_offsets
+        self.n_terms = len(term_offsets) - 1
+        self.indptr = indptr
+        self.doc_ids = doc_ids
+        self.weights = weights
+        self.doc_lengths = doc_lengths
+        self.tokenizer = tokenizer
+        self.tokenize = TOKENIZERS[tokenizer]
+        self.fingerprint = fingerprint
+        self.k1 = k1
+        self.b = b
+        self.n_base = len(doc_lengths)
+        self.avgdl = float(doc_lengths.mean()) if self.n_base else 0.0
+        # No copy of the (memory-mapped) postings as long as indptr and doc_ids share an index dtype
+        self.matrix = csr_matrix((weights, doc_ids, indptr), shape=(self.n_terms, self.n_base), copy=False)
+        self.df = np.diff(indptr)
+        # Delta segment: term -> ([doc ids], [weights]) and the number of delta documents
+        self.delta_postings = {}
+        self.n_delta = 0
+        self.deleted = np.zeros(0, dtype=np.int64)
+        self.lock = threading.Lock()
+
+    @property
+    def n_docs(self):
+        return self.n_base + self.n_delta
+
+    @classmethod
+    def build(cls, texts, tokenizer="whitespace", fingerprint=None, k1=1.5, b=0.75):
+        tokenize = TOKENIZERS[tokenizer]
+        vocabulary = {}
+        term_col, doc_col, tf_col = [], [], []
+        doc_lengths = np.zeros(len(texts), dtype=np.int32)
+        for doc_id, text in enumerate(texts):
+            tokens = tokenize(text)
+            doc_lengths[doc_id] = len(tokens)
+            for term, tf in Counter(tokens).items():
+                term_col.append(vocabulary.setdefault(term, len(vocabulary)))
+                doc_col.append(doc_id)
+                tf_col.append(tf)
+
+        # Renumber the terms in (utf-8 byte) sorted order so the vocabulary can be binary searched
+        terms = sorted(vocabulary, key=lambda term: term.encode("utf-8"))
+        remap = np.zeros(len(vocabulary), dtype=np.int64)
+        remap[[vocabulary[term] for term in terms]] = np.arange(len(vocabulary))
+        term_col = remap[np.asarray(term_col, dtype=np.int64)]
+        doc_col = np.asarray(doc_col, dtype=np.int32)
+        order = np.lexsort((doc_col, term_col))
+
+        encoded = [term.encode("utf-8") for term in terms]
+        term_bytes = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        term_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum([len(term) for term in encoded], out=term_offsets[1:])
+
+        # Postings fit int32 for anything but huge corpora, matching scipy's preferred index dtype
+        index_dtype = np.int32 if len(doc_col) < np.iinfo(np.int32).max else np.int64
+        indptr = np.zeros(len(terms) + 1, dtype=index_dtype)
+        np.cumsum(np.bincount(term_col, minlength=len(terms)), out=indptr[1:])
+
+        doc_col = doc_col[order].astype(index_dtype)
+        tfs = np.asarray(tf_col, dtype=np.float32)[order]
+        avgdl = doc_lengths.mean() if len(texts) else 1.0
+        weights = tfs * (k1 + 1) / (tfs + k1 * (1 - b + b * doc_lengths[doc_col] / avgdl))
+        return cls(term_bytes, term_offsets, indptr, doc_col, weights.astype(np.float32), doc_lengths,
+                   tokenizer=tokenizer, fingerprint=fingerprint, k1=k1, b=b)
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        for name in self.FILES:
+            np.save(os.path.join(directory, f"{name}.npy"), getattr(self, name))
+        with open(os.path.join(directory, "meta.json"), "w") as f:
+            json.dump({"tokenizer": self.tokenizer, "fingerprint": self.fingerprint, "k1": self.k1, "b": self.b}, f)
+
+    @classmethod
+    def load(cls, directory):
+        # Memory-map the arrays read-only, startup does not depend on the size of the index
+        with open(os.path.join(directory, "meta.json")) as f:
+            meta = json.load(f)
+        arrays = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r") for name in cls.FILES}
+        return cls(**arrays, **meta)
+
+    @classmethod
+    def exists(cls, directory):
+        return all(os.path.exists(os.path.join(directory, f"{name}.npy")) for name in cls.FILES) and \
+            os.path.exists(os.path.join(directory, "meta.json"))
+
+    def term(self, term_id):
+        return self.term_bytes[self.term_offsets[term_id]:self.term_offsets[term_id + 1]].tobytes()
+
+    def term_id(self, term):
+        term = term.encode("utf-8")
+        low, high = 0, self.n_terms
+        while low < high:
+            middle = (low + high) // 2
+            if self.term(middle) < term:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.n_terms and self.term(low) == term:
+            return low
+        return -1
+
+    def append(self, texts):
+        """Add documents to the delta segment, the cost only depends on the new documents."""
+        avgdl = self.avgdl or 1.0
+        with self.lock:
+            for text in texts:
+                tokens = self.tokenize(text)
+                norm = self.k1 * (1 - self.b + self.b * len(tokens) / avgdl)
+                for term, tf in Counter(tokens).items():
+                    (doc_ids, weights) = self.delta_postings.setdefault(term, ([], []))
+                    doc_ids.append(self.n_delta)
+                    weights.append(tf * (self.k1 + 1) / (tf + norm))
+                self.n_delta += 1
+
+    def set_deleted(self, doc_ids):
+        with self.lock:
+            self.deleted = np.unique(np.asarray(doc_ids, dtype=np.int64))
+
+    def delete(self, doc_ids):
+        with self.lock:
+            self.deleted = np.union1d(self.deleted, np.asarray(doc_ids, dtype=np.int64))
+
+    def score(self, query):
+        counts = Counter(self.tokenize(query))
+        base_term_ids, base_query_weights = [], []
+        with self.lock:
+            n_delta = self.n_delta
+            delta_scores = np.zeros(n_delta, dtype=np.float32)
+            for term, frequency in counts.items():
+                term_id = self.term_id(term)
+                (doc_ids, weights) = self.delta_postings.get(term, ([], []))
+                df = (self.df[term_id] if term_id >= 0 else 0) + len(doc_ids)
+                if df == 0:
+                    continue
+                # Query vector entry: Lucene's idf variant (never negative) times the query term frequency
+                query_weight = np.log(1 + (self.n_base + n_delta - df + 0.5) / (df + 0.5)) * frequency
+                if term_id >= 0:
+                    base_term_ids.append(term_id)
+                    base_query_weights.append(query_weight)
+                if doc_ids:
+                    delta_scores[doc_ids] += np.asarray(weights, dtype=np.float32) * query_weight
+
+        if base_term_ids:
+            base_scores = self.matrix[base_term_ids].T @ np.asarray(base_query_weights, dtype=np.float32)
+        else:
+            base_scores = np.zeros(self.n_base, dtype=np.float32)
+        scores = np.concatenate([base_scores, delta_scores])
+        deleted = self.deleted
+        scores[deleted[deleted < len(scores)]] = 0
+        return scores
+
+    def search(self, query, k, allowed=None):
+        """
+        Returns the top k (doc id, score) pairs with a positive BM25 score, best first. With allowed, an array
+        of doc ids, only those documents are ranked.
+        """
+        scores = self.score(query)
+        if allowed is not None:
+            mask = np.zeros_like(scores)
+            allowed = allowed[allowed < len(scores)]
+            mask[allowed] = scores[allowed]
+            scores = mask
+        k = min(k, self.n_docs)
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(doc_id), float(scores[doc_id])) for doc_id in top if scores[doc_id] > 0]
+
+
+class SparseIndexRetriever(BaseRetriever):
+    """Retriever over a SparseIndex, drop-in replacement for BM25Retriever in the ensemble."""
+
+    index: SparseIndex
+    documents: Any
+    """Sequence of documents in the same order as the index, kept by reference so appends show up."""
+    k: int = 4
+    allowed: Any = None
+    """Optional array of doc ids to restrict the search to, e.g. the chunks of some label sections."""
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        return [self.documents[doc_id] for doc_id, _ in self.index.search(query, self.k, allowed=self.allowed)]
+
+
+def current_segment(directory):
+    try:
+        with open(os.path.join(directory, "CURRENT")) as f:
+            return os.path.join(directory, f.read().strip())
+    except FileNotFoundError:
+        return None
+
+
+def publish_segment(directory, index):
+    """
+    Save the index as a new immutable segment next to the existing ones and point CURRENT to it. Workers that
+    mapped an older segment keep using it, its files are never overwritten, only unlinked.
+    """
+    os.makedirs(directory, exist_ok=True)
+    name = f"segment-{index.fingerprint[:12]}-{index.n_base}"
+    tmp = os.path.join(directory, f"tmp-{os.getpid()}")
+    shutil.rmtree(tmp, ignore_errors=True)
+    index.save(tmp)
+    if os.path.exists(os.path.join(directory, name)):
+        shutil.rmtree(tmp, ignore_errors=True)
+    else:
+        os.replace(tmp, os.path.join(directory, name))
+    with open(os.path.join(directory, "CURRENT.tmp"), "w") as f:
+        f.write(name)
+    os.replace(os.path.join(directory, "CURRENT.tmp"), os.path.join(directory, "CURRENT"))
+    # Also drops the arrays of the old single directory layout
+    for entry in os.listdir(directory):
+        path = os.path.join(directory, entry)
+        if entry in (name, "CURRENT"):
+            continue
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.remove(path)
+    return os.path.join(directory, name)
+
+
+def load_or_build_sparse_index(directory, documents, tokenizer="cjk", max_delta_ratio=0.2):
+    """
+    Memory-maps the current segment if it matches the first documents and appends the rest to its delta segment.
+    Otherwise, or when the delta would exceed max_delta_ratio of the base, (re)builds and publishes a new segment.
+    """
+    # A ChunkStore reads just the id column
+    ids = documents.ids() if hasattr(documents, "ids") else [doc.metadata.get('id', '') for doc in documents]
+    segment = current_segment(directory)
+    if segment is not None and SparseIndex.exists(segment):
+        index = SparseIndex.load(segment)
+        n_new = len(ids) - index.n_base
+        if index.tokenizer == tokenizer and 0 <= n_new <= max_delta_ratio * index.n_base \
+                and index.fingerprint == corpus_fingerprint(ids[:index.n_base]):
+            index.append([doc.page_content for doc in documents[index.n_base:len(ids)]])
+            return index
+    fingerprint = corpus_fingerprint(ids)
+    index = SparseIndex.build([doc.page_content for doc in documents[:len(ids)]], tokenizer=tokenizer,
+                              fingerprint=fingerprint)
+    # Map the published segment like every other worker instead of keeping the built arrays in memory
+    return SparseIndex.load(publish_segment(directory, index))
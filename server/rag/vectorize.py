@@ -0,0 +1,99 @@
+import os
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """Spaces calls out to at most requests_per_second, 0 disables the limit."""
+
+    def __init__(self, requests_per_second=0):
+        self.interval = 1.0 / requests_per_second if requests_per_second > 0 else 0.0
+        self.next_time = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Checkpoint:
+    """Append-only file with the ids of chunks that have been written to the vector store."""
+
+    def __init__(self, path):
+        self.path = path
+        self.ids = set()
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self.ids = {line.strip() for line in f if line.strip()}
+
+    def add(self, ids):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write("".join(f"{chunk_id}\n" for chunk_id in ids))
+        self.ids.update(ids)
+
+    def clear(self):
+        self.ids = set()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def vectorize_chunks(collection, embeddings, chunks, batch_size=64, max_workers=4, requests_per_second=0,
+                     checkpoint=None, show_progress=True):
+    """
+    Embed chunks in batches with up to max_workers embedding requests in flight and upsert every batch
+    into the Chroma collection in one go, under the chunk ids. Batches that made it are recorded in the
+    checkpoint so an interrupted load can resume. Returns the throughput in chunks per second.
+    """
+    if checkpoint is not None:
+        chunks = [doc for doc in chunks if doc.metadata['id'] not in checkpoint.ids]
+    if not chunks:
+        return 0.0
+
+    rate_limiter = RateLimiter(requests_per_second)
+    batches = [chunks[i:i + batch_size] for i in range(0, len(chunks), batch_size)]
+
+    def embed(batch):
+        rate_limiter.wait()
+        return embeddings.embed_documents([doc.page_content for doc in batch])
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="vectorize") as pool, \
+            tqdm(total=len(chunks), desc="Vectorizing documents", unit="chunk", disable=not show_progress) as pbar:
+        pending = {}
+        remaining = iter(batches)
+        while True:
+            # Keep a bounded number of batches in flight so memory use does not depend on corpus size
+            for batch in remaining:
+                pending[pool.submit(embed, batch)] = batch
+                if len(pending) >= max_workers * 2:
+                    break
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                batch = pending.pop(future)
+                ids = [doc.metadata['id'] for doc in batch]
+                collection.upsert(
+                    ids=ids,
+                    embeddings=future.result(),
+                    metadatas=[doc.metadata for doc in batch],
+                    documents=[doc.page_content for doc in batch],
+                )
+                if checkpoint is not None:
+                    checkpoint.add(ids)
+                pbar.update(len(batch))
+
+    elapsed = time.perf_counter() - start
+    throughput = len(chunks) / elapsed if elapsed > 0 else 0.0
+    logger.info(f"Vectorized {len(chunks)} chunks in {elapsed:.1f}s ({throughput:.1f} chunks/s)")
+    return throughput
@@ -0,0 +1,103 @@
+import threading
+
+import pytest
+from langchain_core.documents import Document
+
+from rag.RAGHelper_cloud import RAGHelperCloud
+from rag.chunk_store import ChunkStore
+from rag.drug_dictionary import DrugDictionary
+from rag.ingest_jobs import IngestionJob, IngestionJobManager
+from rag.sparse_index import SparseIndex
+
+
+def chunk(text, source):
+    return Document(page_content=text, metadata={"id": text, "source": source})
+
+
+def make_helper(tmp_path, fail_embedding):
+    helper = RAGHelperCloud.__new__(RAGHelperCloud)
+    helper.chunked_documents = ChunkStore(str(tmp_path / "chunks.sqlite"))
+    helper.chunked_documents.extend([chunk("普拿疼 退燒 止痛", "rag/data/A-普拿疼.md")])
+    helper.sparse_index = SparseIndex.build(["普拿疼 退燒 止痛"], tokenizer="cjk")
+    helper.drug_dictionary = DrugDictionary()
+    helper.index_version = 0
+    helper.ingest_lock = threading.Lock()
+    helper.lock_path = str(tmp_path / "chunks.sqlite.lock")
+
+    def add_to_vector_store(chunks):
+        if fail_embedding[0]:
+            raise RuntimeError("429 Too Many Requests")
+    helper.add_to_vector_store = add_to_vector_store
+    return helper
+
+
+def test_failed_embedding_leaves_the_indexes_aligned(tmp_path):
+    fail_embedding = [True]
+    helper = make_helper(tmp_path, fail_embedding)
+    new_chunks = [chunk("康緒平 憂鬱症 用法", "rag/data/B-康緒平.md")]
+
+    with pytest.raises(RuntimeError):
+        helper.add_chunks(new_chunks)
+    assert len(helper.chunked_documents) == helper.sparse_index.n_docs == 1
+
+    # The retry adds the chunk to both, BM25 doc ids are still chunk store positions
+    fail_embedding[0] = False
+    helper.add_chunks(new_chunks)
+    assert len(helper.chunked_documents) == helper.sparse_index.n_docs == 2
+    (doc_id, _) = helper.sparse_index.search("康緒平", 1)[0]
+    assert helper.chunked_documents[doc_id].page_content == "康緒平 憂鬱症 用法"
+
+
+class StubVectorStore:
+    def __init__(self, vectors):
+        # id -> metadata
+        self.vectors = vectors
+
+    def get(self, ids=None, where=None, include=None):
+        sources = where["source"]["$in"] if where else None
+        return {"ids": [vector_id for vector_id, metadata in self.vectors.items()
+                        if (ids is None or vector_id in ids) and (sources is None or metadata["source"] in sources)]}
+
+    def delete(self, ids):
+        for vector_id in ids:
+            self.vectors.pop(vector_id, None)
+
+
+def test_removed_file_drops_vectors_with_random_ids(tmp_path):
+    helper = make_helper(tmp_path, [False])
+    # Loaded before chunk ids were content hashes, with the source of a pickle built on Windows
+    helper.db = StubVectorStore({"0b5e-uuid": {"source": "rag\\data\\A-普拿疼.md"},
+                                 "普拿疼 退燒 止痛": {"source": "rag/data/A-普拿疼.md"},
+                                 "6f1d-uuid": {"source": "rag\\data\\B-康緒平.md"}})
+
+    helper.remove_files(["rag/data/A-普拿疼.md"])
+    assert list(helper.db.vectors) == ["6f1d-uuid"]
+    assert helper.chunked_documents.live_chunks(["rag/data/A-普拿疼.md"]) == []
+
+
+def test_sync_leaves_the_index_lock_free_while_embedding(tmp_path, monkeypatch):
+    fcntl = pytest.importorskip("fcntl")
+    (tmp_path / "data").mkdir()
+    (tmp_path / "data" / "B-康緒平.txt").write_text("康緒平 憂鬱症 用法", encoding="utf-8")
+    for (key, value) in {"data_directory": str(tmp_path / "data"), "file_types": "txt", "splitter": "",
+                         "use_blank_line_as_separator": "False", "chunk_size": "512", "chunk_overlap": "0"}.items():
+        monkeypatch.setenv(key, value)
+    helper = make_helper(tmp_path, [False])
+    helper.db = StubVectorStore({})
+    lock_free = []
+
+    def add_to_vector_store(chunks):
+        # What a worker starting up (loadData) does meanwhile
+        with open(helper.lock_path, "w") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                fcntl.flock(f, fcntl.LOCK_UN)
+                lock_free.append(True)
+            except BlockingIOError:
+                lock_free.append(False)
+    helper.add_to_vector_store = add_to_vector_store
+
+    job = IngestionJob([], sync=True)
+    IngestionJobManager(helper, processes=0)._run(job)
+    assert job.status == "done" and lock_free == [True]
+    assert list(helper.chunked_documents.manifest()) == [str(tmp_path / "data" / "B-康緒平.txt")]
@@ -0,0 +1,38 @@
+from rag.answer_cache import AnswerCache
+from rag.drug_dictionary import DrugDictionary
+
+
+class StubEmbeddings:
+    """Every question about side effects embeds the same, whatever drug it names."""
+
+    def embed_query(self, text):
+        return [1.0, 0.0] if "副作用" in text else [0.0, 1.0]
+
+
+def make_cache():
+    dictionary = DrugDictionary()
+    dictionary.add({"rag/data/A-普拿疼.md": (None, "普拿疼膜衣錠", None),
+                    "rag/data/B-康緒平.md": (None, "康緒平緩釋膠囊", None)})
+    return AnswerCache(StubEmbeddings(), entities=dictionary.match)
+
+
+def test_exact_and_semantic_hits():
+    cache = make_cache()
+    (value, key) = cache.lookup("普拿疼的副作用？", 0)
+    assert value is None
+    cache.store(key, 0, "answer")
+    assert cache.lookup("普拿疼的副作用", 0)[0] == "answer"
+    assert cache.lookup("普拿疼有什麼副作用", 0)[0] == "answer"
+    assert cache.stats()["exact_hits"] == 1 and cache.stats()["semantic_hits"] == 1
+
+
+def test_similar_question_about_another_drug_misses():
+    cache = make_cache()
+    cache.store(cache.lookup("普拿疼的副作用", 0)[1], 0, "answer")
+    assert cache.lookup("康緒平的副作用", 0)[0] is None
+
+
+def test_new_index_version_drops_the_answers():
+    cache = make_cache()
+    cache.store(cache.lookup("普拿疼的副作用", 0)[1], 0, "answer")
+    assert cache.lookup("普拿疼的副作用", 1)[0] is None
@@ -0,0 +1,67 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from langchain_core.embeddings import Embeddings
+
+from rag.batching import CoalescingEmbeddings, MicroBatcher
+
+
+class RecordingEmbeddings(Embeddings):
+    def __init__(self):
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def embed_documents(self, texts):
+        with self.lock:
+            self.calls.append(list(texts))
+        return [[float(len(text)), float(ord(text[-1]))] for text in texts]
+
+    def embed_query(self, text):
+        raise AssertionError("queries are embedded as documents")
+
+
+def test_each_caller_gets_its_own_vector():
+    provider = RecordingEmbeddings()
+    embeddings = CoalescingEmbeddings(provider, max_batch_size=16, max_wait=0.05)
+    texts = [f"question {i}" * (i + 1) for i in range(12)]
+    expected = RecordingEmbeddings().embed_documents(texts)
+    with ThreadPoolExecutor(max_workers=12) as pool:
+        vectors = list(pool.map(embeddings.embed_query, texts))
+    assert vectors == expected
+    # Fewer provider calls than queries, every query was embedded once
+    assert len(provider.calls) < len(texts)
+    assert sorted(text for call in provider.calls for text in call) == sorted(texts)
+
+
+def test_identical_texts_are_embedded_once():
+    provider = RecordingEmbeddings()
+    embeddings = CoalescingEmbeddings(provider)
+    assert embeddings.embed_batch(["a", "bb", "a"]) == [[1.0, 97.0], [2.0, 98.0], [1.0, 97.0]]
+    assert provider.calls == [["a", "bb"]]
+
+
+def test_embed_documents_passes_through():
+    provider = RecordingEmbeddings()
+    embeddings = CoalescingEmbeddings(provider)
+    assert embeddings.embed_documents(["a", "a"]) == [[1.0, 97.0], [1.0, 97.0]]
+    assert provider.calls == [["a", "a"]]
+    assert embeddings.stats()["batches"] == 0
+
+
+def test_batches_are_bounded_and_results_routed():
+    batcher = MicroBatcher(lambda items: [item * 2 for item in items], max_batch_size=4, max_wait=0.05)
+    assert batcher.map(list(range(10))) == [item * 2 for item in range(10)]
+    stats = batcher.stats()
+    assert stats["items"] == 10 and stats["largest_batch"] <= 4
+
+
+def test_errors_reach_every_caller_of_the_batch():
+    def process(items):
+        raise ValueError("provider unavailable")
+
+    batcher = MicroBatcher(process)
+    futures = [batcher.submit(item) for item in range(3)]
+    for future in futures:
+        with pytest.raises(ValueError, match="provider unavailable"):
+            future.result(timeout=5)
@@ -0,0 +1,89 @@
+import sqlite3
+
+from langchain_core.documents import Document
+
+from rag.chunk_store import ChunkStore
+from rag.ingest_pipeline import discover_files
+
+
+def chunk(text, source):
+    return Document(page_content=text, metadata={"id": text, "source": source})
+
+
+def test_extend_appends_and_round_trips_metadata(tmp_path):
+    store = ChunkStore(str(tmp_path / "chunks.sqlite"))
+    first = Document(page_content="普拿疼 用於 退燒", metadata={
+        "id": "a", "source": "rag/data/A-普拿疼.md", "start_index": 0, "section": "適應症", "page": 1})
+    assert store.extend([first, chunk("普拿疼 用法", "rag/data/A-普拿疼.md")]) == []
+    assert store.extend([chunk("康緒平 用法", "rag/data/B-康緒平.md")]) == []
+
+    assert len(store) == 3 and store.ids() == ["a", "普拿疼 用法", "康緒平 用法"]
+    assert store[0].metadata == first.metadata and store[0].page_content == first.page_content
+    assert [doc.page_content for doc in store[1:]] == ["普拿疼 用法", "康緒平 用法"]
+    assert store[-1].page_content == "康緒平 用法"
+    assert [doc.metadata["id"] for doc in store] == store.ids()
+
+
+def test_reopened_store_has_the_chunks(tmp_path):
+    path = str(tmp_path / "chunks.sqlite")
+    ChunkStore.build(path, [[chunk("普拿疼", "a.md")], [chunk("康緒平", "b.md")]])
+    assert not ChunkStore.exists(f"{path}.tmp")
+    assert ChunkStore(path).ids() == ["普拿疼", "康緒平"]
+
+
+def test_deleted_chunks_keep_their_positions(tmp_path):
+    store = ChunkStore(str(tmp_path / "chunks.sqlite"))
+    store.extend([chunk("普拿疼", "a.md"), chunk("康緒平", "b.md"), chunk("普拿疼", "c.md")])
+    store.delete([0])
+    assert store[1].page_content == "康緒平"
+    assert store.deleted_positions() == [0] and store.deleted_count() == 1
+    assert store.live_chunks(["a.md", "c.md"]) == [(2, "普拿疼")]
+    # The vector of 普拿疼 is still used by the chunk of c.md
+    assert store.live_ids(["普拿疼", "康緒平", "x"]) == {"普拿疼", "康緒平"}
+
+
+def test_windows_sources_match_discovered_files(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "rag" / "data").mkdir(parents=True)
+    (tmp_path / "rag" / "data" / "A-普拿疼.md").write_text("普拿疼", encoding="utf-8")
+    [path] = discover_files("rag/data", ["md"])
+
+    # Chunks migrated from a pickle built on Windows
+    ChunkStore.build("chunks.sqlite", [[chunk("普拿疼", "rag\\data\\A-普拿疼.md")]])
+    store = ChunkStore("chunks.sqlite")
+    assert store[0].metadata["source"] == path == "rag/data/A-普拿疼.md"
+    assert store.live_chunks([path]) == [(0, "普拿疼")]
+    store.update_manifest({"rag\\data\\A-普拿疼.md": (1, 1.0, "hash")})
+    assert list(store.manifest()) == [path]
+
+
+def test_sources_of_existing_stores_are_normalized_on_open(tmp_path):
+    path = str(tmp_path / "chunks.sqlite")
+    ChunkStore(path).close()
+    conn = sqlite3.connect(path)
+    conn.execute("INSERT INTO chunks (pos, id, source, text) VALUES (0, 'a', 'rag\\data\\A-普拿疼.md', '普拿疼')")
+    conn.commit()
+    conn.close()
+    assert ChunkStore(path).live_chunks(["rag/data/A-普拿疼.md"]) == [(0, "a")]
+
+
+def test_workers_sharing_a_store_see_each_others_chunks_in_order(tmp_path):
+    path = str(tmp_path / "chunks.sqlite")
+    first = ChunkStore(path)
+    second = ChunkStore(path)
+    first.extend([chunk("普拿疼", "a.md")])
+    assert len(second) == 0
+
+    # The chunks the other worker appended come first, they are returned to add them to the other indexes
+    assert [doc.page_content for doc in second.extend([chunk("康緒平", "b.md")])] == ["普拿疼"]
+    assert second.ids() == ["普拿疼", "康緒平"]
+    assert [doc.page_content for doc in first.refresh()] == ["康緒平"]
+    assert first.refresh() == [] and first.ids() == second.ids()
+
+
+def test_manifest_round_trip(tmp_path):
+    store = ChunkStore(str(tmp_path / "chunks.sqlite"))
+    store.update_manifest({"rag/data/a.md": (1, 1.0, "x"), "rag/data/b.md": (2, 2.0, "y")})
+    store.update_manifest({"rag/data/a.md": (3, 3.0, "z")})
+    store.remove_from_manifest(["rag/data/b.md"])
+    assert store.manifest() == {"rag/data/a.md": (3, 3.0, "z")}
@@ -0,0 +1,68 @@
+import asyncio
+
+import pytest
+
+from rag.deadline import Deadline, DeadlineExceeded
+
+
+def test_allows_every_stage_without_a_budget():
+    deadline = Deadline()
+    assert deadline.allows("rewrite") and deadline.allows("rerank")
+    assert deadline.remaining() == float("inf") and deadline.skipped == []
+
+
+def test_allows_a_stage_only_with_its_reserve_left(monkeypatch):
+    monkeypatch.setenv("deadline_reserve_rewrite", "45")
+    monkeypatch.setenv("deadline_reserve_rerank", "20")
+    deadline = Deadline(30)
+    assert not deadline.allows("rewrite")
+    assert deadline.allows("rerank")
+    assert not deadline.allows("rewrite")
+    # Asked twice, recorded once
+    assert deadline.skipped == ["rewrite"]
+
+
+def test_from_env(monkeypatch):
+    monkeypatch.setenv("request_budget", "")
+    assert Deadline.from_env().expires_at is None
+    monkeypatch.setenv("request_budget", "10")
+    assert 9 < Deadline.from_env().remaining() <= 10
+
+
+def test_run_returns_within_the_budget():
+    async def answer():
+        await asyncio.sleep(0.01)
+        return "answer"
+    assert asyncio.run(Deadline(5).run(answer())) == "answer"
+
+
+def test_run_cancels_what_exceeds_the_budget():
+    cancelled = []
+
+    async def slow():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    with pytest.raises(DeadlineExceeded):
+        asyncio.run(Deadline(0.05).run(slow()))
+    assert cancelled == [True]
+
+
+def test_iterate_stops_a_stream_at_the_deadline():
+    async def tokens():
+        for token in ["a", "b"]:
+            yield token
+        await asyncio.sleep(10)
+        yield "c"
+
+    async def consume(deadline):
+        received = []
+        with pytest.raises(DeadlineExceeded):
+            async for token in deadline.iterate(tokens()):
+                received.append(token)
+        return received
+
+    assert asyncio.run(consume(Deadline(0.05))) == ["a", "b"]
@@ -0,0 +1,56 @@
+from langchain_core.documents import Document
+
+from rag.drug_dictionary import AhoCorasick, DrugDictionary, drug_entries, name_variants, parse_source
+
+CAPSULE = "rag/data/衛署藥製字第048875號_康緒平緩釋膠囊 75 毫克.md"
+INJECTION = "rag/data/衛署藥製字第012345號-康緒平注射液.md"
+TABLET = "rag/data/衛署藥製字第050432號-普拿疼膜衣錠.md"
+
+
+def make_dictionary():
+    dictionary = DrugDictionary()
+    dictionary.add({
+        CAPSULE: ("衛署藥製字第048875號", "康緒平緩釋膠囊 75 毫克", "Calmdown Sustained-Release Capsules 75mg"),
+        INJECTION: ("衛署藥製字第012345號", "康緒平注射液", None),
+        TABLET: ("衛署藥製字第050432號", "普拿疼膜衣錠", None),
+    })
+    return dictionary
+
+
+def test_parse_source():
+    assert parse_source(CAPSULE) == ("衛署藥製字第048875號", "康緒平緩釋膠囊 75 毫克")
+    assert parse_source("rag/data/notes.md") == (None, None)
+
+
+def test_drug_entries_fall_back_to_the_label_fields():
+    chunk = Document(page_content="許可證號\n衛署藥製字第050432號\n英文品名\nPanadol Film Coated Tablets",
+                     metadata={"source": "rag/data/label.md"})
+    assert drug_entries([chunk]) == {"rag/data/label.md": ("衛署藥製字第050432號", None,
+                                                           "Panadol Film Coated Tablets")}
+
+
+def test_name_variants_without_strength_and_form():
+    variants = name_variants(None, "康緒平緩釋膠囊 75 毫克", "Calmdown Sustained-Release Capsules 75mg")
+    assert {"康緒平緩釋膠囊 75 毫克", "康緒平緩釋膠囊", "康緒平", "calmdown"} <= variants
+    # Too short to be matched safely
+    assert name_variants(None, "散", None) == set()
+
+
+def test_match_finds_the_labels_a_question_mentions():
+    dictionary = make_dictionary()
+    assert dictionary.match("普拿疼可以空腹吃嗎") == {TABLET}
+    assert dictionary.match("衛署藥製字第048875號的用法") == {CAPSULE}
+    assert dictionary.match("CALMDOWN 的副作用") == {CAPSULE}
+    assert dictionary.match("康緒平和普拿疼可以一起吃嗎") == {CAPSULE, INJECTION, TABLET}
+    assert dictionary.match("感冒該吃什麼藥") == set()
+
+
+def test_longest_name_wins_where_names_overlap():
+    dictionary = make_dictionary()
+    assert dictionary.match("康緒平注射液的劑量") == {INJECTION}
+    assert dictionary.match("康緒平緩釋膠囊的劑量") == {CAPSULE}
+
+
+def test_aho_corasick_finds_overlapping_patterns():
+    automaton = AhoCorasick({"he": 1, "she": 2, "hers": 3})
+    assert sorted(automaton.find("ushers")) == [(1, 4, 2), (2, 4, 1), (2, 6, 3)]
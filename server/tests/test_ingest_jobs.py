@@ -0,0 +1,84 @@
+import time
+
+import pytest
+
+from rag.ingest_jobs import IngestionJobManager
+
+
+class StubRAGHelper:
+    def __init__(self, lock_path, changes=([], [])):
+        self.lock_path = lock_path
+        self.embeddings = None
+        self.changes = changes
+        self.batches = []
+        self.removed = []
+
+    def add_file_chunks(self, filenames, chunks):
+        self.batches.append((list(filenames), len(chunks)))
+
+    def diff_files(self):
+        return self.changes
+
+    def remove_files(self, filenames):
+        self.removed.extend(filenames)
+
+
+@pytest.fixture(autouse=True)
+def environment(monkeypatch):
+    for (key, value) in {"splitter": "", "use_blank_line_as_separator": "False", "chunk_size": "512",
+                         "chunk_overlap": "0"}.items():
+        monkeypatch.setenv(key, value)
+
+
+def write_labels(directory, count):
+    paths = []
+    for i in range(count):
+        path = directory / f"label-{i}.txt"
+        path.write_text(f"藥品 {i} 的說明書", encoding="utf-8")
+        paths.append(str(path))
+    return paths
+
+
+def wait_for(job, timeout=30):
+    deadline = time.monotonic() + timeout
+    while job.status in ("queued", "running") and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return job
+
+
+@pytest.mark.parametrize("processes", [0, 2])
+def test_job_adds_files_in_batches_and_reports_bad_files(tmp_path, processes):
+    helper = StubRAGHelper(str(tmp_path / "chunks.sqlite.lock"))
+    manager = IngestionJobManager(helper, batch_size=2, processes=processes)
+    filenames = write_labels(tmp_path, 3) + [str(tmp_path / "label.xyz")]
+
+    job = wait_for(manager.submit(filenames))
+    assert job.status == "done"
+    assert sorted(name for (names, _) in helper.batches for name in names) == filenames[:3]
+    assert [len(names) for (names, _) in helper.batches] == [2, 1]
+    assert (job.files_processed, job.chunks_processed) == (3, 3)
+    assert [error["file"] for error in job.errors] == [filenames[3]]
+    assert manager.get(job.id).to_dict()["files_total"] == 4
+
+
+def test_sync_job_ingests_changed_files_and_removes_deleted_ones(tmp_path):
+    changed = write_labels(tmp_path, 1)
+    helper = StubRAGHelper(str(tmp_path / "chunks.sqlite.lock"), changes=(changed, ["rag/data/gone.txt"]))
+    manager = IngestionJobManager(helper, processes=0)
+
+    job = wait_for(manager.submit_sync())
+    assert job.status == "done"
+    assert helper.removed == ["rag/data/gone.txt"] and helper.batches == [(changed, 1)]
+    assert job.to_dict()["files_deleted"] == 1
+
+
+def test_failed_job_is_reported(tmp_path):
+    helper = StubRAGHelper(str(tmp_path / "chunks.sqlite.lock"))
+
+    def add_file_chunks(filenames, chunks):
+        raise RuntimeError("429 Too Many Requests")
+    helper.add_file_chunks = add_file_chunks
+    manager = IngestionJobManager(helper, processes=0)
+
+    job = wait_for(manager.submit(write_labels(tmp_path, 1)))
+    assert job.status == "failed" and job.errors[-1]["error"] == "429 Too Many Requests"
@@ -0,0 +1,46 @@
+import os
+
+from rag.manifest import diff_manifest, file_entry, normalize_source, scan_files
+
+
+def test_diff_finds_added_modified_and_deleted_files(tmp_path):
+    (kept, changed, removed) = [str(tmp_path / name) for name in ["kept.md", "changed.md", "removed.md"]]
+    for path in (kept, changed, removed):
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(path)
+    previous = scan_files([kept, changed, removed], {})
+
+    with open(changed, "w", encoding="utf-8") as f:
+        f.write("new content")
+    os.remove(removed)
+    added = str(tmp_path / "added.md")
+    with open(added, "w", encoding="utf-8") as f:
+        f.write("added")
+    current = scan_files([kept, changed, added], previous)
+
+    assert diff_manifest(previous, current) == ([added], [changed], [removed])
+
+
+def test_touched_file_is_not_modified(tmp_path):
+    path = str(tmp_path / "label.md")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("label")
+    previous = scan_files([path], {})
+    os.utime(path, (1, 1))
+    current = scan_files([path], previous)
+    # New mtime, so the entry is updated, but the same content hash
+    assert current[path] != previous[path]
+    assert diff_manifest(previous, current) == ([], [], [])
+
+
+def test_hash_is_only_computed_again_when_size_or_mtime_changed(tmp_path):
+    path = str(tmp_path / "label.md")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("label")
+    (size, mtime, _) = file_entry(path)
+    assert file_entry(path, (size, mtime, "cached")) == (size, mtime, "cached")
+
+
+def test_normalize_source():
+    assert normalize_source("rag\\data\\A-普拿疼.md") == normalize_source("./rag/data//A-普拿疼.md") == \
+        "rag/data/A-普拿疼.md"
@@ -0,0 +1,91 @@
+import asyncio
+import threading
+
+from langchain_core.documents import Document
+
+from rag.provenance_worker import ProvenanceStore, ProvenanceWorker
+
+
+def docs(*ids):
+    return [Document(page_content=f"label text {doc_id}", metadata={"id": doc_id}) for doc_id in ids]
+
+
+class Scorer:
+    def __init__(self, release=None):
+        self.batches = []
+        self.release = release
+
+    def __call__(self, batch):
+        if self.release is not None:
+            self.release.wait()
+        self.batches.append(batch)
+        return [[len(answer) + i for i in range(len(job_docs))] for (_, job_docs, answer) in batch]
+
+
+def test_jobs_are_scored_in_one_batch():
+    release = threading.Event()
+    scorer = Scorer(release)
+    worker = ProvenanceWorker(scorer, batch_size=64, max_wait=0.5)
+    # The first job blocks the worker until the other two are queued behind it
+    first = worker.submit("q0", docs("a"), "x")
+    jobs = [worker.submit(f"q{i}", docs(f"b{i}", f"c{i}"), "answer") for i in (1, 2)]
+    release.set()
+    for job in [first] + jobs:
+        assert job.done.wait(5)
+    assert [len(batch) for batch in scorer.batches] in ([1, 2], [3])
+    assert jobs[0].to_dict()["documents"] == [{"id": "b1", "provenance": 6}, {"id": "c1", "provenance": 7}]
+    assert worker.stats()["jobs_scored"] == 3
+
+
+def test_scores_are_set_on_the_docs():
+    job_docs = docs("a", "b")
+    job = ProvenanceWorker(Scorer()).submit("q", job_docs, "yes")
+    assert job.done.wait(5)
+    assert [doc.metadata["provenance"] for doc in job_docs] == [3, 4]
+    assert job.status == "done" and job.docs == []
+
+
+def test_failed_scoring_marks_the_jobs_failed():
+    def fail(batch):
+        raise RuntimeError("model not loaded")
+
+    worker = ProvenanceWorker(fail)
+    job = worker.submit("q", docs("a"), "answer")
+    assert job.done.wait(5)
+    assert job.to_dict()["status"] == "failed" and job.to_dict()["error"] == "model not loaded"
+    assert worker.stats()["jobs_failed"] == 1
+
+
+def test_fetch_waits_for_the_job():
+    release = threading.Event()
+    worker = ProvenanceWorker(Scorer(release))
+    job = worker.submit("q", docs("a"), "answer")
+
+    async def fetch():
+        pending = await worker.fetch(job.id)
+        threading.Timer(0.1, release.set).start()
+        return pending, await worker.fetch(job.id, wait=5)
+
+    (pending, done) = asyncio.run(fetch())
+    assert pending["status"] in ("queued", "running") and pending["documents"] == []
+    assert done["status"] == "done" and done["documents"] == [{"id": "a", "provenance": 6}]
+    assert asyncio.run(worker.fetch("unknown")) is None
+
+
+def test_store_is_shared_across_workers(tmp_path):
+    path = str(tmp_path / "provenance.db")
+    scoring = ProvenanceWorker(Scorer(), store=ProvenanceStore(path))
+    other = ProvenanceWorker(Scorer(), store=ProvenanceStore(path))
+    job = scoring.submit("q", docs("a"), "answer")
+    # The other worker finds the job in the store once it is finished
+    result = asyncio.run(other.fetch(job.id, wait=5))
+    assert result["status"] == "done" and result["documents"] == [{"id": "a", "provenance": 6}]
+    assert other.get(job.id) is None
+
+
+def test_store_drops_expired_results(tmp_path):
+    store = ProvenanceStore(str(tmp_path / "provenance.db"), ttl=60)
+    store.put_many([{"provenance_id": "old", "finished": 0.0}])
+    store.put_many([{"provenance_id": "new", "finished": 1e12}])
+    assert store.get("old") is None
+    assert store.get("new")["provenance_id"] == "new"
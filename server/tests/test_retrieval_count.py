@@ -0,0 +1,88 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from langchain_core.documents.base import Document
+from langchain_core.language_models import FakeListChatModel
+from langchain_core.runnables import RunnableLambda
+
+from rag.RAGHelper_cloud import RAGHelperCloud
+from rag.deadline import Deadline
+from rag.single_flight import SingleFlight
+
+
+class CountingRetriever:
+    def __init__(self):
+        self.queries = []
+
+    def invoke(self, query):
+        self.queries.append(query)
+        return [Document(page_content=f"label text for {query}", metadata={"source": "data/A000001-drug.md"})]
+
+
+def make_helper(rewrite):
+    # Only the attributes handle_user_interaction touches, no models or indexes are loaded
+    helper = RAGHelperCloud.__new__(RAGHelperCloud)
+    helper.next_overlay_sync = float("inf")
+    helper.index_version = 0
+    helper.answer_cache = None
+    helper.provenance_worker = None
+    helper.ensemble_retriever = CountingRetriever()
+    helper.llm = FakeListChatModel(responses=["the answer"])
+    helper.rewrite_ask_chain = RunnableLambda(lambda inputs: "yes" if rewrite else "no")
+    helper.rewrite_chain = RunnableLambda(lambda question: f"rewritten {question}")
+    helper.executor = ThreadPoolExecutor(max_workers=2)
+    helper.single_flight = None
+    return helper
+
+
+@pytest.fixture(autouse=True)
+def environment(monkeypatch):
+    monkeypatch.setenv("use_rewrite_loop", "True")
+    monkeypatch.setenv("use_re2", "False")
+    monkeypatch.setenv("rerank", "False")
+    monkeypatch.setenv("use_drug_fast_path", "False")
+    monkeypatch.setenv("use_section_filter", "False")
+    monkeypatch.setenv("provenance_method", "none")
+    monkeypatch.setenv("rag_instruction", "Answer from these documents: {context}")
+    monkeypatch.setenv("rag_question_initial", "{question}")
+
+
+@pytest.mark.parametrize("rewrite, retrievals", [(False, 1), (True, 2)])
+def test_retrieval_count(rewrite, retrievals):
+    helper = make_helper(rewrite)
+    (_, reply) = helper.handle_user_interaction("dosage of drug", [])
+    assert len(helper.ensemble_retriever.queries) == retrievals
+    assert reply["answer"] == "the answer"
+    if rewrite:
+        # The answer is generated from the docs of the rewritten question
+        assert helper.ensemble_retriever.queries[-1] == "rewritten dosage of drug"
+        assert reply["docs"][0].page_content == "label text for rewritten dosage of drug"
+
+
+@pytest.mark.parametrize("rewrite, retrievals", [(False, 1), (True, 2)])
+@pytest.mark.parametrize("speculative", [False, True])
+def test_async_retrieval_count(monkeypatch, rewrite, retrievals, speculative):
+    monkeypatch.setenv("use_speculative_execution", str(speculative))
+    helper = make_helper(rewrite)
+    (_, reply) = asyncio.run(helper.ahandle_user_interaction("dosage of drug", [], Deadline()))
+    assert len(helper.ensemble_retriever.queries) == retrievals
+    # The answer is generated from the docs of the last retrieval
+    assert reply["docs"][0].page_content == f"label text for {helper.ensemble_retriever.queries[-1]}"
+
+
+@pytest.mark.parametrize("rewrite, retrievals", [(False, 1), (True, 2)])
+def test_single_flight_retrieval_count(monkeypatch, rewrite, retrievals):
+    # Identical questions asked at the same time are retrieved for once between them
+    monkeypatch.setenv("use_speculative_execution", "False")
+    helper = make_helper(rewrite)
+    helper.single_flight = SingleFlight()
+    helper.flight_config = "test"
+
+    async def ask_three_times():
+        return await asyncio.gather(*[helper.ahandle_user_interaction("dosage of drug", [], Deadline())
+                                      for _ in range(3)])
+
+    replies = asyncio.run(ask_three_times())
+    assert len(helper.ensemble_retriever.queries) == retrievals
+    assert all(reply is replies[0] for reply in replies)
@@ -0,0 +1,53 @@
+from langchain_core.documents import Document
+
+from rag.section_splitter import MarkdownSectionSplitter, detect_sections
+
+LABEL = """# 藥品資訊
+## 中文品名
+康緒平緩釋膠囊
+## 許可證號
+衛署藥製字第048875號
+## 1 適應症
+憂鬱症。
+## 3 用法及用量
+每日一次，每次一顆。
+"""
+
+
+def test_sections_start_at_h1_and_numbered_headers():
+    chunks = list(MarkdownSectionSplitter(chunk_size=1000, chunk_overlap=0).split_text(LABEL))
+    assert [section for section, _, _ in chunks] == ["藥品資訊", "適應症", "用法及用量"]
+    # Unnumbered headers under a "#" header stay in its section as text
+    assert chunks[0][2] == "藥品資訊\n中文品名\n康緒平緩釋膠囊\n許可證號\n衛署藥製字第048875號"
+    assert chunks[2][2] == "用法及用量\n每日一次，每次一顆。"
+
+
+def test_start_index_is_the_offset_of_the_first_line():
+    for (_, start_index, text) in MarkdownSectionSplitter(chunk_size=1000, chunk_overlap=0).split_text(LABEL):
+        # Kept "##" headers point at their header line
+        first_line = text.split("\n")[1]
+        assert LABEL[start_index:].lstrip("# ").startswith(first_line)
+
+
+def test_long_sections_are_packed_into_chunks_with_overlap():
+    lines = [f"第{i}行說明文字。\n" for i in range(20)]
+    text = "## 4 警語及注意事項\n" + "".join(lines)
+    chunks = list(MarkdownSectionSplitter(chunk_size=60, chunk_overlap=10).split_text(text))
+    assert len(chunks) > 1
+    for (section, _, chunk) in chunks:
+        assert section == "警語及注意事項" and chunk.startswith("警語及注意事項\n") and len(chunk) <= 60
+    # Every line is in a chunk, the last line of a chunk starts the next one
+    assert all(any(line.strip() in chunk for _, _, chunk in chunks) for line in lines)
+    assert chunks[0][2].split("\n")[-1] == chunks[1][2].split("\n")[1]
+
+
+def test_split_documents_sets_the_section_metadata():
+    [doc] = MarkdownSectionSplitter().split_documents([Document(page_content="## 3 用法及用量\n每日一次。",
+                                                                metadata={"source": "a.md"})])
+    assert doc.metadata == {"source": "a.md", "start_index": 11, "section": "用法及用量"}
+
+
+def test_detect_sections():
+    assert detect_sections("康緒平一天吃幾顆？") == {"用法及用量"}
+    assert detect_sections("孕婦可以吃普拿疼嗎，有什麼副作用") == {"特殊族群注意事項", "副作用/不良反應"}
+    assert detect_sections("康緒平") == set()
@@ -0,0 +1,100 @@
+import asyncio
+
+from rag.single_flight import LLMCallCounter, SingleFlight, config_fingerprint
+
+
+class Computation:
+    def __init__(self):
+        self.started = 0
+        self.cancelled = False
+        self.release = None
+
+    async def __call__(self):
+        self.started += 1
+        self.release = asyncio.Event()
+        try:
+            await self.release.wait()
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        # The LLM call of the computation, the followers are spared it
+        LLMCallCounter().on_llm_start({}, ["prompt"])
+        return {"answer": "shared"}
+
+
+def test_concurrent_callers_share_one_computation():
+    flights = SingleFlight()
+    computation = Computation()
+
+    async def ask():
+        callers = [asyncio.ensure_future(flights.run("key", computation)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        assert flights.stats()["in_flight"] == 1
+        computation.release.set()
+        return await asyncio.gather(*callers)
+
+    results = asyncio.run(ask())
+    assert computation.started == 1
+    assert all(result is results[0] for result in results)
+    assert flights.stats() == {"in_flight": 0, "computations": 1, "shared": 2, "llm_calls_saved": 2}
+
+
+def test_nothing_is_kept_after_landing():
+    flights = SingleFlight()
+    computation = Computation()
+
+    async def ask_twice():
+        for _ in range(2):
+            caller = asyncio.ensure_future(flights.run("key", computation))
+            await asyncio.sleep(0.01)
+            computation.release.set()
+            await caller
+        return flights.join("key")
+
+    assert asyncio.run(ask_twice()) is None
+    assert computation.started == 2
+
+
+def test_follower_giving_up_does_not_cancel_the_computation():
+    flights = SingleFlight()
+    computation = Computation()
+
+    async def ask():
+        leader = asyncio.ensure_future(flights.run("key", computation))
+        await asyncio.sleep(0.01)
+        follower = asyncio.ensure_future(flights.run("key", computation))
+        await asyncio.sleep(0.01)
+        follower.cancel()
+        await asyncio.sleep(0.01)
+        computation.release.set()
+        return await leader, follower.cancelled()
+
+    (result, follower_cancelled) = asyncio.run(ask())
+    assert result == {"answer": "shared"} and follower_cancelled
+    assert not computation.cancelled
+
+
+def test_computation_is_cancelled_when_every_caller_gave_up():
+    flights = SingleFlight()
+    computation = Computation()
+
+    async def ask():
+        callers = [asyncio.ensure_future(flights.run("key", computation)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        callers[0].cancel()
+        await asyncio.sleep(0.01)
+        assert not computation.cancelled
+        callers[1].cancel()
+        await asyncio.sleep(0.01)
+
+    asyncio.run(ask())
+    assert computation.cancelled
+    assert flights.stats()["in_flight"] == 0
+
+
+def test_config_fingerprint():
+    keys = ["llm_model", "rerank"]
+    assert config_fingerprint(keys, {"llm_model": "a", "rerank": "True"}) == \
+        config_fingerprint(keys, {"llm_model": "a", "rerank": "True", "other": "1"})
+    assert config_fingerprint(keys, {"llm_model": "a", "rerank": "True"}) != \
+        config_fingerprint(keys, {"llm_model": "b", "rerank": "True"})
@@ -0,0 +1,103 @@
+import os
+
+import numpy as np
+from langchain_core.documents import Document
+
+from rag.sparse_index import (SparseIndex, SparseIndexRetriever, cjk_tokenize, corpus_fingerprint, current_segment,
+                              load_or_build_sparse_index, publish_segment)
+
+TEXTS = [
+    "普拿疼 用於 退燒 及 止痛",
+    "康緒平 用於 治療 憂鬱症",
+    "泰克胃通 用於 治療 胃潰瘍",
+]
+
+
+def test_cjk_tokenize_indexes_unigrams_and_bigrams():
+    assert cjk_tokenize("退燒藥 ABC-12") == ["退", "燒", "藥", "退燒", "燒藥", "abc-12"]
+
+
+def test_search_ranks_the_matching_document_first():
+    index = SparseIndex.build(TEXTS, tokenizer="cjk")
+    assert [doc_id for doc_id, _ in index.search("憂鬱症", 3)] == [1]
+    # Documents without any query term are left out
+    assert sorted(doc_id for doc_id, _ in index.search("治療", 3)) == [1, 2]
+    assert index.search("不存在", 3) == []
+
+
+def test_saved_index_is_memory_mapped_and_scores_the_same(tmp_path):
+    index = SparseIndex.build(TEXTS, tokenizer="cjk", fingerprint="abc")
+    index.save(str(tmp_path))
+    loaded = SparseIndex.load(str(tmp_path))
+    assert isinstance(loaded.doc_ids, np.memmap)
+    assert loaded.fingerprint == "abc"
+    assert np.allclose(loaded.score("治療 憂鬱症"), index.score("治療 憂鬱症"))
+
+
+def test_appended_documents_continue_the_doc_ids():
+    index = SparseIndex.build(TEXTS[:2], tokenizer="cjk")
+    index.append(TEXTS[2:])
+    assert index.n_base == 2 and index.n_delta == 1 and index.n_docs == 3
+    assert [doc_id for doc_id, _ in index.search("胃潰瘍", 3)] == [2]
+    # idf counts the documents of both segments
+    base_only = SparseIndex.build(TEXTS[:2], tokenizer="cjk")
+    assert index.score("憂鬱症")[1] > base_only.score("憂鬱症")[1]
+
+
+def test_deleted_documents_are_left_out():
+    index = SparseIndex.build(TEXTS, tokenizer="cjk")
+    index.append(["康緒平 膠囊 的 用法"])
+    index.delete([1])
+    assert [doc_id for doc_id, _ in index.search("康緒平", 4)] == [3]
+    index.delete([3])
+    assert index.search("康緒平", 4) == []
+    # set_deleted replaces the tombstones with those of the chunk store
+    index.set_deleted([3])
+    assert [doc_id for doc_id, _ in index.search("康緒平", 4)] == [1]
+
+
+def test_retriever_returns_the_documents_in_rank_order_within_allowed():
+    index = SparseIndex.build(TEXTS, tokenizer="cjk")
+    documents = [Document(page_content=text) for text in TEXTS]
+    retriever = SparseIndexRetriever(index=index, documents=documents, k=3)
+    assert [doc.page_content for doc in retriever.invoke("憂鬱症")] == [TEXTS[1]]
+    retriever = SparseIndexRetriever(index=index, documents=documents, k=3, allowed=np.array([2]))
+    assert [doc.page_content for doc in retriever.invoke("治療")] == [TEXTS[2]]
+
+
+def test_published_segment_is_mapped_and_extended_by_the_next_worker(tmp_path):
+    directory = str(tmp_path / "bm25")
+    documents = [Document(page_content=text, metadata={"id": str(i)}) for i, text in enumerate(TEXTS)]
+    index = load_or_build_sparse_index(directory, documents[:2])
+    segment = current_segment(directory)
+    assert index.n_base == 2 and isinstance(index.doc_ids, np.memmap)
+
+    # One more chunk is within max_delta_ratio: the segment is reused, the chunk goes to the delta
+    index = load_or_build_sparse_index(directory, documents, max_delta_ratio=0.5)
+    assert (index.n_base, index.n_delta) == (2, 1) and current_segment(directory) == segment
+    assert [doc_id for doc_id, _ in index.search("胃潰瘍", 3)] == [2]
+
+
+def test_segment_is_rebuilt_when_the_chunks_changed_or_the_delta_is_too_large(tmp_path):
+    directory = str(tmp_path / "bm25")
+    documents = [Document(page_content=text, metadata={"id": str(i)}) for i, text in enumerate(TEXTS)]
+    load_or_build_sparse_index(directory, documents[:2])
+    segment = current_segment(directory)
+
+    index = load_or_build_sparse_index(directory, documents, max_delta_ratio=0.2)
+    assert (index.n_base, index.n_delta) == (3, 0) and current_segment(directory) != segment
+    assert not os.path.exists(segment)
+
+    reordered = documents[::-1]
+    index = load_or_build_sparse_index(directory, reordered)
+    assert index.fingerprint == corpus_fingerprint([doc.metadata["id"] for doc in reordered])
+    assert [doc_id for doc_id, _ in index.search("胃潰瘍", 3)] == [0]
+
+
+def test_publishing_keeps_a_mapped_segment_readable(tmp_path):
+    directory = str(tmp_path / "bm25")
+    mapped = SparseIndex.load(publish_segment(directory, SparseIndex.build(TEXTS[:2], tokenizer="cjk",
+                                                                           fingerprint="a")))
+    publish_segment(directory, SparseIndex.build(TEXTS, tokenizer="cjk", fingerprint="b"))
+    # Its files were unlinked, not overwritten
+    assert [doc_id for doc_id, _ in mapped.search("憂鬱症", 3)] == [1]